@@ -0,0 +1,288 @@
+"""
+Turnaround and technician throughput analytics.
+
+Every status change is a row in the status history. Window functions over
+each battery's history (``LAG`` for the previous status and when it was
+set, ``MIN`` for the intake time, ``ROW_NUMBER`` for the first time it
+reached a status) turn those rows into measured intervals:
+
+- ``intake_to_ready``: intake to the first time the battery was Ready
+- ``ready_to_delivered``: Ready to Delivered or Returned
+- ``in:<status>``: how long a battery stayed Received, Pending or Ready
+
+The intervals are aggregated per shop and day, in SQL, into histogram buckets
+(``turnaround_daily``) and per-user counts (``technician_daily``), so the
+report pages only read a few rows per day however long the history is, and
+percentiles are estimated from the buckets. A refresh recomputes whole days
+and only reads the history of batteries that changed on those days;
+archived history is included.
+
+Pages refresh the days since the last refresh when it is older than
+ANALYTICS_REFRESH_MINUTES. ``flask analytics-refresh`` does the same from
+cron, and ``--rebuild`` recomputes everything (run it once after upgrading).
+"""
+import logging
+import threading
+from datetime import datetime, time, timedelta
+
+import click
+from flask import current_app
+from sqlalchemy import Date, case, cast, delete, extract, func, insert, literal, literal_column, select, union_all
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from metrics import estimate_quantile
+from models import (BatteryStatusHistory, ArchivedBatteryStatusHistory, SystemSettings, TechnicianDaily,
+                    TurnaroundDaily, User)
+
+# Upper bounds of the histogram buckets; the last bucket (index len(BUCKET_HOURS)) is everything longer
+BUCKET_HOURS = (1, 2, 4, 8, 12, 24, 36, 48, 72, 96, 120, 168, 240, 336, 504, 720, 1440)
+
+TRACKED_STATUSES = ('Received', 'Pending', 'Ready')
+DELIVERED_STATUSES = ('Delivered', 'Returned')
+
+METRICS = [
+    ('intake_to_ready', 'Intake to Ready'),
+    ('ready_to_delivered', 'Ready to Delivered/Returned'),
+] + [(f'in:{status}', f'Time in {status}') for status in TRACKED_STATUSES]
+
+QUANTILES = (0.5, 0.9, 0.95)
+
+REFRESHED_SETTING = 'analytics_refreshed_at'
+REBUILD_CHUNK_DAYS = 31
+
+_refresh_lock = threading.Lock()
+
+
+def _hours_between(later, earlier):
+    if db.engine.dialect.name == 'sqlite':
+        return (func.julianday(later) - func.julianday(earlier)) * 24.0
+    return extract('epoch', later - earlier) / 3600.0
+
+
+def _day(column):
+    # SQLite has no DATE type; date() gives the 'YYYY-MM-DD' text the Date column stores
+    if db.engine.dialect.name == 'sqlite':
+        return func.date(column)
+    return cast(column, Date)
+
+
+def _bucket(hours):
+    # Inlined rather than bound, so Postgres sees the same expression in SELECT and GROUP BY
+    return case(
+        *[(hours <= literal_column(str(bound)), literal_column(str(index))) for index, bound in enumerate(BUCKET_HOURS)],
+        else_=literal_column(str(len(BUCKET_HOURS)))
+    )
+
+
+def _transitions(start, end):
+    """Status history rows changed in [start, end) with the previous status and intake time of their battery"""
+    parts = []
+    for model in (BatteryStatusHistory, ArchivedBatteryStatusHistory):
+        table = model.__table__
+        touched = select(table.c.battery_id).where(table.c.updated_at >= start, table.c.updated_at < end)
+        parts.append(select(table.c.id, table.c.shop_id, table.c.battery_id, table.c.status, table.c.updated_by,
+                            table.c.updated_at)
+                     .where(table.c.battery_id.in_(touched)))
+    history = union_all(*parts).subquery('history')
+
+    # The windows need every row of those batteries, so the date range is applied outside them
+    order = (history.c.updated_at, history.c.id)
+    windowed = select(
+        history.c.shop_id,
+        history.c.battery_id,
+        history.c.status,
+        history.c.updated_by,
+        history.c.updated_at,
+        func.lag(history.c.status).over(partition_by=history.c.battery_id, order_by=order).label('prev_status'),
+        func.lag(history.c.updated_at).over(partition_by=history.c.battery_id, order_by=order).label('prev_at'),
+        func.min(history.c.updated_at).over(partition_by=history.c.battery_id).label('intake_at'),
+        func.row_number().over(partition_by=(history.c.battery_id, history.c.status), order_by=order).label('status_seq'),
+    ).subquery('windowed')
+    return select(windowed).where(windowed.c.updated_at >= start, windowed.c.updated_at < end).subquery('transitions')
+
+
+def _turnaround_select(transitions):
+    t = transitions
+    day = _day(t.c.updated_at)
+    since_previous = _hours_between(t.c.updated_at, t.c.prev_at)
+    samples = union_all(
+        select(t.c.shop_id, day.label('day'), literal('intake_to_ready').label('metric'),
+               _hours_between(t.c.updated_at, t.c.intake_at).label('hours'))
+        .where(t.c.status == 'Ready', t.c.status_seq == 1),
+        select(t.c.shop_id, day, literal('ready_to_delivered'), since_previous)
+        .where(t.c.status.in_(DELIVERED_STATUSES), t.c.prev_status == 'Ready'),
+        select(t.c.shop_id, day, literal('in:') + t.c.prev_status, since_previous)
+        .where(t.c.prev_status.in_(TRACKED_STATUSES), t.c.prev_status != t.c.status),
+    ).subquery('samples')
+    bucket = _bucket(samples.c.hours)
+    return (select(samples.c.shop_id, samples.c.day, samples.c.metric, bucket, func.count(), func.sum(samples.c.hours))
+            .group_by(samples.c.shop_id, samples.c.day, samples.c.metric, bucket))
+
+
+def _technician_select(transitions):
+    t = transitions
+    day = _day(t.c.updated_at)
+
+    def count_where(condition):
+        return func.sum(case((condition, 1), else_=0))
+
+    repair_hours = func.coalesce(_hours_between(t.c.updated_at, t.c.prev_at), 0)
+    return (select(t.c.shop_id, day, t.c.updated_by, func.count(),
+                   count_where(t.c.status == 'Ready'),
+                   count_where(t.c.status == 'Not Repairable'),
+                   count_where(t.c.status.in_(DELIVERED_STATUSES)),
+                   func.sum(case((t.c.status == 'Ready', repair_hours), else_=0)))
+            .group_by(t.c.shop_id, day, t.c.updated_by))
+
+
+def refresh_days(first_day, last_day):
+    """Recompute the daily summaries of first_day..last_day (inclusive) for every shop, without committing"""
+    start = datetime.combine(first_day, time.min)
+    end = datetime.combine(last_day + timedelta(days=1), time.min)
+    for model in (TurnaroundDaily, TechnicianDaily):
+        db.session.execute(delete(model.__table__).where(model.day >= first_day, model.day <= last_day))
+
+    transitions = _transitions(start, end)
+    db.session.execute(insert(TurnaroundDaily.__table__).from_select(
+        ['shop_id', 'day', 'metric', 'bucket', 'count', 'total_hours'], _turnaround_select(transitions)))
+    db.session.execute(insert(TechnicianDaily.__table__).from_select(
+        ['shop_id', 'day', 'user_id', 'updates', 'ready', 'not_repairable', 'delivered', 'repair_hours'],
+        _technician_select(transitions)))
+
+
+def _history_start():
+    days = [db.session.query(func.min(model.updated_at)).execution_options(all_shops=True).scalar()
+            for model in (BatteryStatusHistory, ArchivedBatteryStatusHistory)]
+    days = [value.date() for value in days if value]
+    return min(days) if days else None
+
+
+def last_refreshed():
+    value = SystemSettings.get_setting(REFRESHED_SETTING)
+    return datetime.fromisoformat(value) if value else None
+
+
+def refresh(rebuild=False, progress=None):
+    """Bring the summaries up to date: days since the last refresh, or all of history. Returns days refreshed."""
+    today = datetime.utcnow().date()
+    refreshed_at = None if rebuild else last_refreshed()
+    # The day of the last refresh is redone: it was still in progress then
+    first_day = refreshed_at.date() if refreshed_at else _history_start()
+    if first_day is None:
+        first_day = today
+
+    now = datetime.utcnow()
+    chunk_start = first_day
+    while chunk_start <= today:
+        chunk_end = min(chunk_start + timedelta(days=REBUILD_CHUNK_DAYS - 1), today)
+        try:
+            refresh_days(chunk_start, chunk_end)
+            if chunk_end == today:
+                SystemSettings.set_setting(REFRESHED_SETTING, now.isoformat())
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        if progress:
+            progress(chunk_start, chunk_end)
+        chunk_start = chunk_end + timedelta(days=1)
+    return (today - first_day).days + 1
+
+
+def ensure_fresh():
+    """Refresh the summaries if the last refresh is older than ANALYTICS_REFRESH_MINUTES"""
+    refreshed_at = last_refreshed()
+    max_age = timedelta(minutes=current_app.config.get('ANALYTICS_REFRESH_MINUTES', 15))
+    if refreshed_at and datetime.utcnow() - refreshed_at < max_age:
+        return
+    # One refresh per process at a time; a concurrent one in another process loses the insert race
+    if not _refresh_lock.acquire(blocking=False):
+        return
+    try:
+        refresh()
+    except IntegrityError:
+        logging.info('Analytics summaries were refreshed concurrently by another process')
+    finally:
+        _refresh_lock.release()
+
+
+def turnaround_summary(first_day, last_day):
+    """[{metric, label, count, mean_hours, p50/p90/p95 hours}] over first_day..last_day, in the current shop"""
+    rows = db.session.query(TurnaroundDaily.metric, TurnaroundDaily.bucket,
+                            func.sum(TurnaroundDaily.count), func.sum(TurnaroundDaily.total_hours)).filter(
+        TurnaroundDaily.day >= first_day, TurnaroundDaily.day <= last_day
+    ).group_by(TurnaroundDaily.metric, TurnaroundDaily.bucket).all()
+
+    per_metric = {}
+    for metric, bucket, count, total_hours in rows:
+        entry = per_metric.setdefault(metric, {'counts': [0] * (len(BUCKET_HOURS) + 1), 'total_hours': 0.0})
+        entry['counts'][bucket] += count
+        entry['total_hours'] += total_hours or 0
+
+    summary = []
+    for metric, label in METRICS:
+        entry = per_metric.get(metric)
+        count = sum(entry['counts']) if entry else 0
+        row = {'metric': metric, 'label': label, 'count': count,
+               'mean_hours': entry['total_hours'] / count if count else None}
+        if count:
+            # Same estimate as the request latency metrics: cumulative buckets, interpolated
+            cumulative, running = [], 0
+            for bucket_count in entry['counts'][:len(BUCKET_HOURS)]:
+                running += bucket_count
+                cumulative.append(running)
+            hist = {'buckets': list(BUCKET_HOURS), 'counts': cumulative, 'count': count}
+            for q in QUANTILES:
+                row[f'p{int(q * 100)}_hours'] = estimate_quantile(hist, q)
+        summary.append(row)
+    return summary
+
+
+def technician_throughput(first_day, last_day):
+    """Per-user totals over first_day..last_day in the current shop, busiest first"""
+    rows = db.session.query(
+        TechnicianDaily.user_id,
+        func.sum(TechnicianDaily.updates),
+        func.sum(TechnicianDaily.ready),
+        func.sum(TechnicianDaily.not_repairable),
+        func.sum(TechnicianDaily.delivered),
+        func.sum(TechnicianDaily.repair_hours),
+        func.count(TechnicianDaily.day),
+    ).filter(
+        TechnicianDaily.day >= first_day, TechnicianDaily.day <= last_day
+    ).group_by(TechnicianDaily.user_id).all()
+
+    users = {user.id: user for user in User.query.filter(User.id.in_([row[0] for row in rows])).all()} if rows else {}
+    throughput = []
+    for user_id, updates, ready, not_repairable, delivered, repair_hours, active_days in rows:
+        user = users.get(user_id)
+        throughput.append({
+            'user_id': user_id,
+            'name': user.full_name if user else f'User #{user_id}',
+            'role': user.role if user else '',
+            'updates': updates,
+            'ready': ready,
+            'not_repairable': not_repairable,
+            'delivered': delivered,
+            'active_days': active_days,
+            'ready_per_day': ready / active_days if active_days else 0,
+            'mean_repair_hours': repair_hours / ready if ready else None,
+        })
+    throughput.sort(key=lambda row: (row['ready'], row['updates']), reverse=True)
+    return throughput
+
+
+def report_range(days):
+    """(first_day, last_day) of the last ``days`` days, today included"""
+    last_day = datetime.utcnow().date()
+    return last_day - timedelta(days=days - 1), last_day
+
+
+def register_analytics_commands(app):
+    @app.cli.command('analytics-refresh')
+    @click.option('--rebuild', is_flag=True, help='Recompute all of history instead of the days since the last refresh')
+    def analytics_refresh_command(rebuild):
+        """Materialise turnaround and technician throughput summaries from the status history."""
+        days = refresh(rebuild, progress=lambda first, last: click.echo(f'  {first} .. {last}'))
+        click.echo(f'Refreshed analytics for {days} days.')
@@ -0,0 +1,145 @@
+"""
+Hot/cold archival of closed batteries.
+
+Delivered, returned and not repairable batteries whose intake is older than
+ARCHIVE_AFTER_DAYS are moved, together with their status history and staff
+notes, into the ``*_archive`` tables, ARCHIVE_BATCH_SIZE batteries per
+transaction. Rows keep their ids, so existing links to a battery keep
+working. Search, battery details, receipts, the yearly report, exports and
+backups read archived rows too; adding a note to an archived battery or
+reopening it for warranty moves it back to the hot tables first.
+
+Run ``flask --app main archive`` periodically (e.g. nightly from cron).
+"""
+import logging
+from datetime import datetime, timedelta
+
+import click
+from flask import abort, current_app
+from sqlalchemy import delete, func, insert, literal, select
+
+from app import db
+from models import (Battery, BatteryStatusHistory, BatteryStaffNote, Customer,
+                    ArchivedBattery, ArchivedBatteryStatusHistory, ArchivedBatteryStaffNote)
+
+CLOSED_STATUSES = ('Delivered', 'Returned', 'Not Repairable')
+
+# (hot model, archive model) with parents first
+TABLE_PAIRS = [
+    (Battery, ArchivedBattery),
+    (BatteryStatusHistory, ArchivedBatteryStatusHistory),
+    (BatteryStaffNote, ArchivedBatteryStaffNote),
+]
+
+
+def _battery_key(model):
+    table = model.__table__
+    return table.c.id if model in (Battery, ArchivedBattery) else table.c.battery_id
+
+
+def _move(battery_ids, to_archive):
+    """Copy the batteries and their children to the other side, then delete the originals"""
+    now = datetime.utcnow()
+    for hot, cold in TABLE_PAIRS:
+        source, target = (hot, cold) if to_archive else (cold, hot)
+        columns = [column.name for column in hot.__table__.columns]
+        selected = [source.__table__.c[name] for name in columns]
+        if to_archive:
+            columns.append('archived_at')
+            selected.append(literal(now))
+        db.session.execute(
+            insert(target.__table__).from_select(columns, select(*selected).where(_battery_key(source).in_(battery_ids)))
+        )
+    for hot, cold in reversed(TABLE_PAIRS):
+        source = hot if to_archive else cold
+        db.session.execute(delete(source.__table__).where(_battery_key(source).in_(battery_ids)))
+
+
+def archive_closed_batteries(older_than_days=None, batch_size=None, progress=None):
+    """Move closed batteries older than the cutoff to the archive. Returns how many were moved."""
+    if older_than_days is None:
+        older_than_days = current_app.config.get('ARCHIVE_AFTER_DAYS', 365)
+    if batch_size is None:
+        batch_size = current_app.config.get('ARCHIVE_BATCH_SIZE', 500)
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+
+    # Batteries owning the newest row of each hot table stay hot: SQLite hands out
+    # max(id) + 1 for new rows, which must never collide with an archived id
+    keep_ids = {
+        db.session.query(func.max(Battery.id)).scalar(),
+        db.session.query(BatteryStatusHistory.battery_id).order_by(BatteryStatusHistory.id.desc()).limit(1).scalar(),
+        db.session.query(BatteryStaffNote.battery_id).order_by(BatteryStaffNote.id.desc()).limit(1).scalar(),
+    } - {None}
+    moved = 0
+    while True:
+        battery_ids = [row[0] for row in db.session.query(Battery.id).filter(
+            Battery.status.in_(CLOSED_STATUSES),
+            Battery.inward_date < cutoff,
+            Battery.id.notin_(keep_ids)
+        ).order_by(Battery.id).limit(batch_size)]
+        if not battery_ids:
+            break
+        try:
+            _move(battery_ids, to_archive=True)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        moved += len(battery_ids)
+        if progress:
+            progress(moved)
+    return moved
+
+
+def get_battery(battery_id):
+    """A battery by primary key from the hot or the archive table, or 404"""
+    battery = db.session.get(Battery, battery_id) or db.session.get(ArchivedBattery, battery_id)
+    if battery is None:
+        abort(404)
+    return battery
+
+
+def get_hot_battery(battery_id):
+    """A battery by primary key, moving it back from the archive if needed, or 404.
+
+    The move is flushed but not committed, so it is saved together with the
+    caller's change.
+    """
+    battery = db.session.get(Battery, battery_id)
+    if battery is None and db.session.query(ArchivedBattery.id).filter_by(id=battery_id).scalar() is not None:
+        _move([battery_id], to_archive=False)
+        logging.info(f'Battery {battery_id} moved back from the archive')
+        battery = db.session.get(Battery, battery_id)
+    if battery is None:
+        abort(404)
+    return battery
+
+
+def search_archived(search_query):
+    """Archived batteries matching a search by battery ID, customer mobile or name"""
+    return ArchivedBattery.query.join(Customer).filter(
+        db.or_(
+            ArchivedBattery.battery_id.ilike(f'%{search_query}%'),
+            Customer.mobile.ilike(f'%{search_query}%'),
+            Customer.name.ilike(f'%{search_query}%')
+        )
+    ).order_by(ArchivedBattery.inward_date.desc()).all()
+
+
+def archived_status_counts():
+    """{status: count} of archived batteries"""
+    return dict(db.session.query(ArchivedBattery.status, func.count(ArchivedBattery.id))
+                .group_by(ArchivedBattery.status).all())
+
+
+def register_archive_commands(app):
+    @app.cli.command('archive')
+    @click.option('--older-than-days', type=int, help='Default: ARCHIVE_AFTER_DAYS')
+    @click.option('--batch-size', type=int, help='Default: ARCHIVE_BATCH_SIZE')
+    def archive_command(older_than_days, batch_size):
+        """Move old closed batteries, with history and notes, to the archive tables."""
+        moved = archive_closed_batteries(
+            older_than_days, batch_size,
+            progress=lambda count: click.echo(f'  {count} batteries archived')
+        )
+        click.echo(f'Archived {moved} batteries.')
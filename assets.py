@@ -0,0 +1,111 @@
+"""
+Fingerprinted, precompressed static assets.
+
+``tools/build_assets.py`` minifies everything under ``static/`` (including
+the vendored Bootstrap and Font Awesome files in ``static/vendor``), writes
+each file to ``static/dist`` under a name containing a hash of its content,
+precompresses text files to ``.gz`` (and ``.br`` when the brotli module is
+installed) and records the names in ``static/dist/manifest.json``.
+
+Templates call ``asset_url('offline-styles.css')``. With a manifest the URL
+points at ``/assets/<hashed name>``, served with a one-year immutable cache
+lifetime and the precompressed variant the browser accepts. Without one
+(e.g. a development checkout) it falls back to the plain ``/static`` file,
+or for a vendored asset that was never fetched to its public CDN address;
+in OFFLINE_MODE such an asset is left out instead, so pages never wait for a
+CDN that cannot be reached.
+"""
+import json
+import logging
+import mimetypes
+import os
+
+from flask import Blueprint, abort, current_app, request, send_from_directory, url_for
+
+logger = logging.getLogger('assets')
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+CACHE_SECONDS = 365 * 24 * 3600
+
+# Vendored third-party assets: path under static/ -> where tools/build_assets.py --fetch gets them
+VENDOR_ASSETS = {
+    'vendor/bootstrap-agent-dark-theme.min.css': 'https://cdn.replit.com/agent/bootstrap-agent-dark-theme.min.css',
+    'vendor/fontawesome/css/all.min.css': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css',
+    'vendor/bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js',
+}
+
+# Content-Encoding -> suffix of the precompressed file, in order of preference
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+assets_bp = Blueprint('assets', __name__)
+
+_manifest = {}
+
+
+def load_manifest(app):
+    """The {logical name: fingerprinted name} map written by the last asset build"""
+    path = os.path.join(app.static_folder, DIST_DIR, MANIFEST_NAME)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f'Ignoring unreadable asset manifest {path}: {e}')
+        return {}
+
+
+def asset_url(name):
+    """URL of a static asset, or None when it is unavailable offline"""
+    hashed = _manifest.get(name)
+    if hashed:
+        return url_for('assets.asset', filename=hashed)
+    if os.path.exists(os.path.join(current_app.static_folder, name)):
+        return url_for('static', filename=name)
+    if name in VENDOR_ASSETS and not current_app.config.get('OFFLINE_MODE'):
+        return VENDOR_ASSETS[name]
+    return None
+
+
+def _accepted_encodings():
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = part.strip().partition(';')
+        if coding and params.replace(' ', '') not in ('q=0', 'q=0.0'):
+            accepted.add(coding.lower())
+    return accepted
+
+
+@assets_bp.route('/assets/<path:filename>')
+def asset(filename):
+    directory = os.path.join(current_app.static_folder, DIST_DIR)
+    if filename == MANIFEST_NAME or filename.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    accepted = _accepted_encodings()
+    encoding = None
+    served = filename
+    for coding, suffix in ENCODINGS:
+        if coding in accepted and os.path.isfile(os.path.join(directory, filename + suffix)):
+            encoding, served = coding, filename + suffix
+            break
+
+    response = send_from_directory(directory, served, mimetype=mimetype, max_age=CACHE_SECONDS)
+    # The name changes whenever the content does, so the browser never needs to revalidate
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def init_assets(app):
+    """Load the asset manifest and expose ``asset_url`` to templates"""
+    global _manifest
+    _manifest = load_manifest(app)
+    if _manifest:
+        logger.info(f'Serving {len(_manifest)} fingerprinted assets')
+    app.jinja_env.globals['asset_url'] = asset_url
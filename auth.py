@@ -1,7 +1,8 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash
 from flask_login import login_user, logout_user, login_required, current_user
-from werkzeug.security import check_password_hash
 from models import User
+from metrics import registry
+from passwords import check_password, take_attempt, reset_attempts
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -14,16 +15,26 @@ def login():
         if not username or not password:
             flash('Please enter both username and password.', 'error')
             return render_template('login.html')
-        
+
+        # Refused before the database or any hashing is touched (see passwords.py)
+        wait = take_attempt(username, request.remote_addr)
+        if wait:
+            registry.inc('login_attempts_total', {'result': 'throttled'})
+            flash(f'Too many login attempts. Please try again in {wait} seconds.', 'error')
+            return render_template('login.html'), 429, {'Retry-After': str(wait)}
+
         user = User.query.filter_by(username=username).first()
         
-        if user and check_password_hash(user.password_hash, password):
+        if check_password(user, password):
+            registry.inc('login_attempts_total', {'result': 'success'})
+            reset_attempts(username)
             login_user(user)
             next_page = request.args.get('next')
             if next_page:
                 return redirect(next_page)
             return redirect(url_for('main.dashboard'))
         else:
+            registry.inc('login_attempts_total', {'result': 'failure'})
             flash('Invalid username or password.', 'error')
     
     return render_template('login.html')
@@ -0,0 +1,321 @@
+"""
+Full and incremental JSON backups.
+
+Users, customers, batteries, status history and staff notes carry a
+``modified_at`` column that is set whenever a row is written, and rows
+deleted from those tables leave a ``deleted_row`` record. A full backup
+exports everything; an incremental one only the rows modified, and the ids
+deleted, since the ``watermark`` of the previous backup, so a nightly
+incremental is proportional to the day's activity.
+
+Every backup records its watermark (when the export started) and the
+watermark after the latest backup is kept in the ``backup_watermark``
+setting. Incrementals reach BACKUP_OVERLAP_SECONDS further back than the
+watermark, to pick up changes that were committed (or replicated) after the
+previous export had read past them; rows exported twice are harmless, as a
+restore applies them by id.
+
+Restore takes a full backup plus the incrementals taken after it, checks
+that each incremental starts at the watermark of the one before, folds them
+into one full backup and loads that as usual. Archived batteries keep their
+ids and ``modified_at``, so archival itself is not a change. Backups cover
+every shop; rows carry their ``shop_id`` and the (few) shops are exported in
+full every time. A backup made by a user bound to a shop only holds that
+shop's rows (and no system settings) and keeps a watermark of its own; it
+can't be restored over the whole deployment.
+
+    flask --app main backup /backups/full.json
+    flask --app main backup --incremental /backups/$(date +%F).json
+"""
+import json
+from datetime import datetime, timedelta
+from itertools import chain
+
+import click
+from flask import current_app
+from sqlalchemy import event, insert, update
+
+from app import db
+from replica import RoutingSession
+from models import (User, Customer, Battery, BatteryStatusHistory, BatteryStaffNote, SystemSettings, DeletedRow, Shop,
+                    ArchivedBattery, ArchivedBatteryStatusHistory, ArchivedBatteryStaffNote)
+
+WATERMARK_SETTING = 'backup_watermark'
+# Followed by the shop id, for the chain of backups of a single shop
+SHOP_WATERMARK_PREFIX = 'backup_watermark_shop_'
+
+# Settings that describe this database rather than the shop; a restore leaves them out
+LOCAL_SETTINGS = {WATERMARK_SETTING, 'analytics_refreshed_at'}
+
+# Tracked table -> backup section
+SECTIONS = {
+    'user': 'users',
+    'customer': 'customers',
+    'battery': 'batteries',
+    'battery_status_history': 'status_history',
+    'battery_staff_note': 'staff_notes',
+}
+
+
+def _isoformat(value):
+    return value.isoformat() if value else None
+
+
+def _shop(shop):
+    return {
+        'id': shop.id,
+        'code': shop.code,
+        'name': shop.name,
+        'battery_id_prefix': shop.battery_id_prefix,
+        'battery_id_start': shop.battery_id_start,
+        'battery_id_padding': shop.battery_id_padding,
+        'last_battery_number': shop.last_battery_number,
+        'is_active': shop.is_active
+    }
+
+
+def _user(user):
+    # Without passwords for security
+    return {
+        'id': user.id,
+        'shop_id': user.shop_id,
+        'username': user.username,
+        'full_name': user.full_name,
+        'role': user.role,
+        'created_at': _isoformat(user.created_at),
+        'is_active': user.is_active
+    }
+
+
+def _customer(customer):
+    return {
+        'id': customer.id,
+        'shop_id': customer.shop_id,
+        'name': customer.name,
+        'mobile': customer.mobile,
+        'mobile_secondary': customer.mobile_secondary,
+        'created_at': _isoformat(customer.created_at)
+    }
+
+
+def _battery(battery):
+    return {
+        'id': battery.id,
+        'shop_id': battery.shop_id,
+        'battery_id': battery.battery_id,
+        'customer_id': battery.customer_id,
+        'battery_type': battery.battery_type,
+        'voltage': battery.voltage,
+        'capacity': battery.capacity,
+        'status': battery.status,
+        'inward_date': _isoformat(battery.inward_date),
+        'service_price': battery.service_price
+    }
+
+
+def _history(history):
+    return {
+        'id': history.id,
+        'shop_id': history.shop_id,
+        'battery_id': history.battery_id,
+        'status': history.status,
+        'comments': history.comments,
+        'updated_by': history.updated_by,
+        'updated_at': _isoformat(history.updated_at)
+    }
+
+
+def _note(note):
+    return {
+        'id': note.id,
+        'shop_id': note.shop_id,
+        'battery_id': note.battery_id,
+        'note': note.note,
+        'note_type': note.note_type,
+        'created_by': note.created_by,
+        'created_at': _isoformat(note.created_at),
+        'is_resolved': note.is_resolved
+    }
+
+
+def _setting(setting):
+    return {
+        'setting_key': setting.setting_key,
+        'setting_value': setting.setting_value,
+        'updated_at': _isoformat(setting.updated_at)
+    }
+
+
+# section -> (models, row serialiser), archived rows included; a restore puts them all back in the hot tables
+EXPORTS = [
+    ('users', (User,), _user),
+    ('customers', (Customer,), _customer),
+    ('batteries', (Battery, ArchivedBattery), _battery),
+    ('status_history', (BatteryStatusHistory, ArchivedBatteryStatusHistory), _history),
+    ('staff_notes', (BatteryStaffNote, ArchivedBatteryStaffNote), _note),
+]
+
+
+def is_local_setting(key):
+    return key in LOCAL_SETTINGS or key.startswith(SHOP_WATERMARK_PREFIX)
+
+
+def watermark_setting(shop_id=None):
+    return WATERMARK_SETTING if shop_id is None else f'{SHOP_WATERMARK_PREFIX}{shop_id}'
+
+
+def export_backup(since=None, progress=None, shop_id=None):
+    """The backup as a dict: everything, or with ``since`` only what changed after that watermark.
+
+    With ``shop_id`` only that shop and its users, customers, batteries, history and notes.
+    """
+    progress = progress or (lambda pct, message: None)
+    watermark = datetime.utcnow()
+    cutoff = None
+    if since:
+        cutoff = datetime.fromisoformat(since) - timedelta(seconds=current_app.config.get('BACKUP_OVERLAP_SECONDS', 300))
+
+    backup_data = {
+        'timestamp': datetime.now().isoformat(),
+        'kind': 'incremental' if since else 'full',
+        'watermark': watermark.isoformat(),
+    }
+    if since:
+        backup_data['since'] = since
+    shops = Shop.query.order_by(Shop.id)
+    if shop_id is not None:
+        backup_data['shop_id'] = shop_id
+        shops = shops.filter(Shop.id == shop_id)
+    backup_data['shops'] = [_shop(shop) for shop in shops]
+
+    for number, (section, models, serialise) in enumerate(EXPORTS):
+        queries = [model.query.order_by(model.id) for model in models]
+        if shop_id is not None:
+            # Users are not scoped to the current shop like the rest, so filtered here for all of them
+            queries = [query.filter(model.shop_id == shop_id) for query, model in zip(queries, models)]
+        if cutoff:
+            queries = [query.filter(model.modified_at >= cutoff) for query, model in zip(queries, models)]
+        backup_data[section] = [serialise(row) for row in chain.from_iterable(queries)]
+        progress(10 + 80 * number // len(EXPORTS), f'Exported {section.replace("_", " ")}')
+
+    backup_data['settings'] = []
+    if shop_id is None:
+        settings = SystemSettings.query.filter(SystemSettings.setting_key.notin_(LOCAL_SETTINGS),
+                                               SystemSettings.setting_key.notlike(f'{SHOP_WATERMARK_PREFIX}%'))
+        if cutoff:
+            settings = settings.filter(SystemSettings.updated_at >= cutoff)
+        backup_data['settings'] = [_setting(setting) for setting in settings]
+
+    if cutoff:
+        deleted = {section: [] for section in SECTIONS.values()}
+        for row in DeletedRow.query.filter(DeletedRow.deleted_at >= cutoff).order_by(DeletedRow.id):
+            if row.table_name in SECTIONS:
+                deleted[SECTIONS[row.table_name]].append(row.row_id)
+        backup_data['deleted'] = deleted
+    return backup_data
+
+
+def get_watermark(shop_id=None):
+    """Watermark of the latest backup (of the shop), which the next incremental starts from"""
+    return SystemSettings.get_setting(watermark_setting(shop_id)) or None
+
+
+def record_watermark(watermark, shop_id=None):
+    # On its own primary connection: backups run as read-only jobs, possibly on the replica
+    table = SystemSettings.__table__
+    key = watermark_setting(shop_id)
+    values = {'setting_value': watermark, 'updated_at': datetime.utcnow()}
+    with db.engine.begin() as conn:
+        if not conn.execute(update(table).where(table.c.setting_key == key).values(**values)).rowcount:
+            conn.execute(insert(table).values(setting_key=key, **values))
+
+
+def _row_key(section, row):
+    return row['setting_key'] if section == 'settings' else row['id']
+
+
+def merge_backups(backups):
+    """Fold a full backup and the incrementals taken after it into a single full backup.
+
+    Raises ValueError when the backups do not form an unbroken chain.
+    """
+    ordered = sorted(backups, key=lambda backup: backup.get('watermark') or '')
+    base, incrementals = ordered[0], ordered[1:]
+    if any(backup.get('shop_id') is not None for backup in ordered):
+        raise ValueError('A backup of a single shop cannot be restored over the whole deployment')
+    if base.get('kind', 'full') != 'full':
+        raise ValueError('A full backup is needed to restore incremental backups')
+    if not incrementals:
+        return base
+    if not base.get('watermark'):
+        raise ValueError('The full backup was taken before incremental backups were supported')
+
+    sections = list(SECTIONS.values()) + ['settings']
+    rows = {section: {_row_key(section, row): row for row in base.get(section, [])} for section in sections}
+    watermark = base.get('watermark')
+    for backup in incrementals:
+        if backup.get('kind') != 'incremental':
+            raise ValueError('Only one full backup can be restored at a time')
+        if backup.get('since') != watermark:
+            raise ValueError(f"The incremental backup taken at {backup.get('watermark')} follows the backup "
+                             f"taken at {backup.get('since')}, which is not among the uploaded files")
+        # Rows present in the backup existed when it was taken, whatever was deleted before
+        for section, ids in backup.get('deleted', {}).items():
+            for row_id in ids:
+                rows[section].pop(row_id, None)
+        for section in sections:
+            for row in backup.get(section, []):
+                rows[section][_row_key(section, row)] = row
+        watermark = backup['watermark']
+
+    # Shops are exported in full every time
+    merged = dict(base, timestamp=ordered[-1].get('timestamp'), watermark=watermark,
+                  shops=ordered[-1].get('shops', base.get('shops', [])))
+    for section in sections:
+        merged[section] = sorted(rows[section].values(), key=lambda row: _row_key(section, row))
+    return merged
+
+
+def record_deleted(conn, table_name, row_ids):
+    """Leave ``deleted_row`` records for rows deleted with a Core statement on ``conn``"""
+    if row_ids:
+        now = datetime.utcnow()
+        conn.execute(insert(DeletedRow.__table__),
+                     [{'table_name': table_name, 'row_id': row_id, 'deleted_at': now} for row_id in row_ids])
+
+
+def _after_flush(session, flush_context):
+    deleted = {}
+    for obj in session.deleted:
+        table_name = getattr(obj, '__tablename__', None)
+        if table_name in SECTIONS:
+            deleted.setdefault(table_name, []).append(obj.id)
+    for table_name, row_ids in deleted.items():
+        record_deleted(session.connection(), table_name, row_ids)
+
+
+def init_backups(app):
+    """Record rows the ORM deletes from tracked tables"""
+    if not event.contains(RoutingSession, 'after_flush', _after_flush):
+        event.listen(RoutingSession, 'after_flush', _after_flush)
+
+
+def register_backup_commands(app):
+    @app.cli.command('backup')
+    @click.argument('path', type=click.Path(dir_okay=False, writable=True))
+    @click.option('--incremental', is_flag=True, help='Only what changed since the latest backup')
+    @click.option('--since', 'previous', type=click.File(encoding='utf-8'),
+                  help='With --incremental, start from the watermark of this backup file instead')
+    def backup_command(path, incremental, previous):
+        """Write a full or incremental JSON backup to PATH."""
+        since = None
+        if incremental:
+            since = json.load(previous).get('watermark') if previous else get_watermark()
+            if not since:
+                click.echo('No previous backup watermark; writing a full backup.')
+        backup_data = export_backup(since)
+        with open(path, 'w', encoding='utf-8') as output:
+            json.dump(backup_data, output, indent=2)
+        record_watermark(backup_data['watermark'])
+        counts = ', '.join(f'{len(backup_data[section])} {section.replace("_", " ")}' for section in SECTIONS.values())
+        click.echo(f"Wrote {backup_data['kind']} backup {path} ({counts}).")
@@ -0,0 +1,337 @@
+"""
+Database schema bootstrap, migrations and seeding.
+
+Creating tables and seeding default users is done by the ``flask bootstrap``
+command (or ``flask migrate`` for schema changes only). At import time the
+app only runs ``check_schema()``, a single query comparing the stored schema
+version with ``SCHEMA_VERSION``; when it is current nothing else happens.
+
+To change the schema, bump ``SCHEMA_VERSION`` and add a function to
+``MIGRATIONS`` under the new version number. Migrations must be idempotent
+because databases created from scratch get the new tables from
+``create_all()`` before migrations run.
+"""
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+
+import click
+from flask import current_app
+from sqlalchemy import delete, func, insert, inspect, select, text
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.schema import CreateIndex
+
+from app import db
+from models import (User, Customer, Battery, BatteryStatusHistory, BatteryStaffNote, SystemSettings, Job, Shop,
+                    ArchivedBattery, ArchivedBatteryStatusHistory, ArchivedBatteryStaffNote,
+                    TurnaroundDaily, TechnicianDaily)
+from customers import dedupe_customers
+from analytics import REFRESHED_SETTING
+from shops import SHOP_SETTINGS, sync_battery_counter
+from passwords import hash_password
+
+SCHEMA_VERSION = 10
+
+
+def _add_archive_index(conn):
+    # The archive tables themselves are new, so create_all() has already made them
+    conn.execute(text('CREATE INDEX IF NOT EXISTS ix_battery_status_inward_date ON battery (status, inward_date)'))
+
+
+def _create_index(conn, index):
+    # Unlike executing CreateIndex, this skips indexes kept to another dialect with ddl_if()
+    index.create(conn, checkfirst=True)
+
+
+def _create_customer_indexes(conn, *names):
+    for index in Customer.__table__.indexes:
+        if index.name in names:
+            _create_index(conn, index)
+
+
+def _add_customer_prefix_indexes(conn):
+    # The indexes lead with shop_id, which arrived later (version 7)
+    _add_shop_columns(conn)
+    _create_customer_indexes(conn, 'ix_customer_shop_mobile_prefix', 'ix_customer_shop_name_prefix')
+
+
+def _make_customer_mobiles_unique(conn):
+    # Its updates stamp modified_at and it merges within a shop, which both arrived later (versions 6 and 7)
+    _add_modified_at_columns(conn)
+    _add_shop_columns(conn)
+    stats = dedupe_customers(conn)
+    logging.info(f"Merged {stats['merged']} duplicate customers, normalised {stats['normalised']} mobiles")
+    _create_customer_indexes(conn, 'uq_customer_shop_mobile')
+
+
+def _add_history_indexes(conn):
+    # The turnaround_daily and technician_daily tables are new, so create_all() has already made them
+    for model in (BatteryStatusHistory, ArchivedBatteryStatusHistory):
+        for index in model.__table__.indexes:
+            # The shop-leading one comes with the shop_id column (version 7)
+            if 'updated' in index.name and '_shop_' not in index.name:
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _add_modified_at_columns(conn):
+    created = {User: 'created_at', Customer: 'created_at', Battery: 'inward_date', BatteryStatusHistory: 'updated_at',
+               BatteryStaffNote: 'created_at', ArchivedBattery: 'inward_date',
+               ArchivedBatteryStatusHistory: 'updated_at', ArchivedBatteryStaffNote: 'created_at'}
+    for model, created_column in created.items():
+        table = model.__table__
+        if 'modified_at' in {column['name'] for column in inspect(conn).get_columns(table.name)}:
+            continue
+        name = conn.dialect.identifier_preparer.format_table(table)
+        column_type = table.c.modified_at.type.compile(dialect=conn.dialect)
+        conn.execute(text(f'ALTER TABLE {name} ADD COLUMN modified_at {column_type}'))
+        # Existing rows count as changed when they were created
+        conn.execute(table.update().values(modified_at=table.c[created_column]))
+
+
+def _add_modified_at(conn):
+    # The deleted_row table is new, so create_all() has already made it
+    _add_modified_at_columns(conn)
+    for model in (User, Customer, Battery, BatteryStatusHistory, BatteryStaffNote,
+                  ArchivedBattery, ArchivedBatteryStatusHistory, ArchivedBatteryStaffNote):
+        for index in model.__table__.indexes:
+            if index.name.endswith('modified_at'):
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _add_shop_columns(conn):
+    """The first shop, from the shop settings, and the shop_id columns holding it for existing rows"""
+    shop = Shop.__table__
+    shop_id = conn.execute(select(func.min(shop.c.id))).scalar()
+    created = shop_id is None
+    if created:
+        settings = SystemSettings.__table__
+        stored = dict(conn.execute(select(settings.c.setting_key, settings.c.setting_value)
+                                   .where(settings.c.setting_key.in_(SHOP_SETTINGS))).all())
+        shop_id = conn.execute(insert(shop).values(
+            code='MAIN',
+            name=stored.get('shop_name') or 'Battery Repair Service',
+            battery_id_prefix=stored.get('battery_id_prefix') or 'BAT',
+            battery_id_start=int(stored.get('battery_id_start') or 1),
+            battery_id_padding=int(stored.get('battery_id_padding') or 4),
+            last_battery_number=0,
+            is_active=True,
+            created_at=datetime.utcnow()
+        ).returning(shop.c.id)).scalar()
+        conn.execute(delete(settings).where(settings.c.setting_key.in_(SHOP_SETTINGS)))
+
+    scoped = [Customer, Battery, BatteryStatusHistory, BatteryStaffNote,
+              ArchivedBattery, ArchivedBatteryStatusHistory, ArchivedBatteryStaffNote]
+    for model in [User, Job] + scoped:
+        table = model.__table__
+        if 'shop_id' in {column['name'] for column in inspect(conn).get_columns(table.name)}:
+            continue
+        name = conn.dialect.identifier_preparer.format_table(table)
+        # Users and jobs without a shop are head office ones
+        definition = f'INTEGER NOT NULL DEFAULT {shop_id}' if model in scoped else 'INTEGER'
+        if model is not Job and conn.dialect.name != 'sqlite':
+            definition += ' REFERENCES shop (id)'
+        conn.execute(text(f'ALTER TABLE {name} ADD COLUMN shop_id {definition}'))
+    if created:
+        sync_battery_counter(conn, shop_id)
+
+
+def _add_shops(conn):
+    # The shop table is new, so create_all() has already made it
+    _add_shop_columns(conn)
+    # Derived tables keyed by shop now; rebuilt by the next report view (or `flask analytics-refresh`)
+    for model in (TurnaroundDaily, TechnicianDaily):
+        if 'shop_id' not in {column['name'] for column in inspect(conn).get_columns(model.__tablename__)}:
+            model.__table__.drop(conn)
+            model.__table__.create(conn)
+    settings = SystemSettings.__table__
+    conn.execute(delete(settings).where(settings.c.setting_key == REFRESHED_SETTING))
+
+    # Replaced by indexes leading with shop_id
+    for name in ('uq_customer_mobile', 'ix_customer_mobile_prefix', 'ix_customer_name_prefix'):
+        conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+    for model in (Customer, Battery, BatteryStatusHistory, ArchivedBattery):
+        for index in model.__table__.indexes:
+            if '_shop_' in index.name:
+                _create_index(conn, index)
+
+
+def _add_battery_versions(conn):
+    for model in (Battery, ArchivedBattery):
+        table = model.__table__
+        if 'version' in {column['name'] for column in inspect(conn).get_columns(table.name)}:
+            continue
+        name = conn.dialect.identifier_preparer.format_table(table)
+        conn.execute(text(f'ALTER TABLE {name} ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+
+
+def _add_write_keys(conn):
+    for model in (BatteryStatusHistory, BatteryStaffNote, ArchivedBatteryStatusHistory, ArchivedBatteryStaffNote):
+        table = model.__table__
+        if 'write_key' not in {column['name'] for column in inspect(conn).get_columns(table.name)}:
+            name = conn.dialect.identifier_preparer.format_table(table)
+            conn.execute(text(f'ALTER TABLE {name} ADD COLUMN write_key VARCHAR(32)'))
+        for index in table.indexes:
+            if index.name.endswith('write_key'):
+                conn.execute(CreateIndex(index, if_not_exists=True))
+
+
+def _drop_sqlite_prefix_indexes(conn):
+    # Postgres only now (see models.py); on SQLite they cost writes without serving a lookup
+    if conn.dialect.name == 'sqlite':
+        for name in ('ix_customer_shop_mobile_prefix', 'ix_customer_shop_name_prefix'):
+            conn.execute(text(f'DROP INDEX IF EXISTS {name}'))
+
+
+# version -> function(connection) that upgrades the previous version to it
+MIGRATIONS = {
+    2: _add_archive_index,
+    3: _add_customer_prefix_indexes,
+    4: _make_customer_mobiles_unique,
+    5: _add_history_indexes,
+    6: _add_modified_at,
+    7: _add_shops,
+    8: _add_battery_versions,
+    9: _add_write_keys,
+    10: _drop_sqlite_prefix_indexes,
+}
+
+# Arbitrary key for pg_advisory_lock so concurrent bootstraps run one at a time
+BOOTSTRAP_LOCK_KEY = 715_200_101
+
+
+def get_schema_version():
+    """Return the stored schema version, or 0 if the database is not bootstrapped"""
+    try:
+        value = db.session.execute(
+            text("SELECT setting_value FROM system_settings WHERE setting_key = 'schema_version'")
+        ).scalar()
+    except (OperationalError, ProgrammingError):
+        db.session.rollback()
+        return 0
+    try:
+        return int(value) if value is not None else 0
+    except ValueError:
+        return 0
+
+
+def check_schema():
+    """Fast startup check: one query, and a bootstrap only if the schema is behind.
+
+    Set AUTO_BOOTSTRAP=0 to never touch the schema from a web process and
+    rely on running ``flask bootstrap`` during deployment instead.
+    """
+    version = get_schema_version()
+    db.session.rollback()  # don't hold the read transaction open in the master process
+    if version >= SCHEMA_VERSION:
+        return True
+
+    if not current_app.config.get('AUTO_BOOTSTRAP', True):
+        logging.error(f"Database schema is at version {version}, expected {SCHEMA_VERSION}. "
+                      f"Run 'flask --app main bootstrap'.")
+        return False
+
+    bootstrap_database()
+    return True
+
+
+@contextmanager
+def _bootstrap_lock():
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+    with db.engine.connect() as conn:
+        conn.execute(text('SELECT pg_advisory_lock(:key)'), {'key': BOOTSTRAP_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': BOOTSTRAP_LOCK_KEY})
+            conn.commit()
+
+
+def _migrate():
+    version = get_schema_version()
+    db.session.rollback()
+    db.create_all()
+    with db.engine.begin() as conn:
+        for target in sorted(MIGRATIONS):
+            if version < target <= SCHEMA_VERSION:
+                logging.info(f"Applying schema migration {target}")
+                MIGRATIONS[target](conn)
+    SystemSettings.set_setting('schema_version', str(SCHEMA_VERSION))
+    db.session.commit()
+
+
+def migrate_database():
+    """Create missing tables and apply pending migrations"""
+    with _bootstrap_lock():
+        _migrate()
+
+
+def bootstrap_database(force=False):
+    """Migrate the schema and seed default users and settings.
+
+    Skipped when another process already brought the schema up to date
+    while this one waited for the lock, unless ``force`` is set.
+    """
+    with _bootstrap_lock():
+        if not force and get_schema_version() >= SCHEMA_VERSION:
+            return
+        _migrate()
+        initialize_database()
+
+
+def initialize_database():
+    """Initialize database with default users and settings"""
+    # Create default users if they don't exist
+    if not User.query.filter_by(username='admin').first():
+        admin_user = User()
+        admin_user.username = 'admin'
+        admin_user.password_hash = hash_password('admin123')
+        admin_user.role = 'admin'
+        admin_user.full_name = 'Administrator'
+        db.session.add(admin_user)
+
+    if not User.query.filter_by(username='staff').first():
+        staff_user = User()
+        staff_user.username = 'staff'
+        staff_user.password_hash = hash_password('staff123')
+        staff_user.role = 'shop_staff'
+        staff_user.full_name = 'Shop Staff'
+        db.session.add(staff_user)
+
+    if not User.query.filter_by(username='technician').first():
+        tech_user = User()
+        tech_user.username = 'technician'
+        tech_user.password_hash = hash_password('tech123')
+        tech_user.role = 'technician'
+        tech_user.full_name = 'Technician'
+        db.session.add(tech_user)
+
+    # The shop name and battery ID settings live on the first shop, created by migration 7
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        logging.error(f"Error creating default users and settings: {e}")
+        db.session.rollback()
+
+
+def register_commands(app):
+    @app.cli.command('bootstrap')
+    def bootstrap_command():
+        """Create tables, apply migrations and seed default users and settings."""
+        version = get_schema_version()
+        bootstrap_database(force=True)
+        click.echo(f'Database bootstrapped (schema version {version} -> {SCHEMA_VERSION}).')
+
+    @app.cli.command('migrate')
+    def migrate_command():
+        """Create missing tables and apply pending schema migrations."""
+        version = get_schema_version()
+        migrate_database()
+        click.echo(f'Schema migrated from version {version} to {SCHEMA_VERSION}.')
+
+    @app.cli.command('schema-version')
+    def schema_version_command():
+        """Show the stored and expected schema versions."""
+        click.echo(f'Stored: {get_schema_version()}  Expected: {SCHEMA_VERSION}')
@@ -0,0 +1,165 @@
+"""
+gzip/brotli compression of responses, as WSGI middleware.
+
+Responses are compressed when the browser accepts it and the response is
+at least COMPRESS_MIN_SIZE bytes (or of unknown length, i.e. streamed) and
+has one of COMPRESS_MIMETYPES. Bodies are compressed chunk by chunk as the
+app produces them, so a streamed export goes out compressed without being
+collected in memory first. Brotli is preferred when the brotli module is
+installed and the browser supports it.
+
+Left alone: responses that are already encoded (e.g. precompressed
+``/assets`` files), partial content, ``Cache-Control: no-transform``,
+HEAD requests and server-sent event streams, which must reach the browser
+event by event.
+"""
+import logging
+import zlib
+
+from werkzeug.datastructures import Headers
+from werkzeug.wsgi import ClosingIterator
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger('compression')
+
+DEFAULT_MIMETYPES = (
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/javascript', 'application/javascript',
+    'application/json', 'application/xml', 'text/xml', 'image/svg+xml',
+)
+
+
+def _parse_accept_encoding(value):
+    """{coding: quality} from an Accept-Encoding header"""
+    accepted = {}
+    for part in value.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            accepted[coding.lower()] = quality
+    return accepted
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        # wbits=31: gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class CompressionMiddleware:
+    def __init__(self, wsgi_app, level=6, brotli_quality=4, min_size=1024, mimetypes=DEFAULT_MIMETYPES):
+        self.wsgi_app = wsgi_app
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.min_size = min_size
+        self.mimetypes = set(mimetypes)
+
+    def _choose_encoding(self, environ):
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return None
+        accepted = _parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if brotli is not None and accepted.get('br', 0) > 0:
+            return 'br'
+        if accepted.get('gzip', 0) > 0 or (accepted.get('*', 0) > 0 and 'gzip' not in accepted):
+            return 'gzip'
+        return None
+
+    def _should_compress(self, status, headers):
+        if not status.startswith('200'):
+            return False
+        if 'Content-Encoding' in headers or 'no-transform' in headers.get('Cache-Control', ''):
+            return False
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip().lower()
+        if mimetype not in self.mimetypes:
+            return False
+        length = headers.get('Content-Length')
+        return length is None or not length.isdigit() or int(length) >= self.min_size
+
+    def _compressor(self, encoding):
+        if encoding == 'br':
+            return BrotliCompressor(self.brotli_quality)
+        return GzipCompressor(self.level)
+
+    def __call__(self, environ, start_response):
+        encoding = self._choose_encoding(environ)
+        if encoding is None:
+            return self.wsgi_app(environ, start_response)
+
+        state = {}
+
+        def compressing_start_response(status, response_headers, exc_info=None):
+            headers = Headers(response_headers)
+            if self._should_compress(status, headers):
+                state['compressor'] = self._compressor(encoding)
+                vary = headers.get('Vary')
+                if not vary:
+                    headers['Vary'] = 'Accept-Encoding'
+                elif 'accept-encoding' not in vary.lower():
+                    headers['Vary'] = vary + ', Accept-Encoding'
+                headers['Content-Encoding'] = encoding
+                headers.remove('Content-Length')
+                headers.remove('Accept-Ranges')
+                # The compressed body is a different representation of the same resource
+                etag = headers.get('ETag')
+                if etag and not etag.startswith('W/'):
+                    headers['ETag'] = 'W/' + etag
+            write = start_response(status, headers.to_wsgi_list(), exc_info)
+            if 'compressor' not in state:
+                return write
+            compressor = state['compressor']
+            return lambda data: write(compressor.compress(data))
+
+        app_iter = self.wsgi_app(environ, compressing_start_response)
+        compressor = state.get('compressor')
+        if compressor is None:
+            return app_iter
+        return ClosingIterator(self._compress(app_iter, compressor), getattr(app_iter, 'close', None))
+
+    @staticmethod
+    def _compress(app_iter, compressor):
+        for chunk in app_iter:
+            data = compressor.compress(chunk)
+            # The compressor holds small chunks back until it has a block worth sending
+            if data:
+                yield data
+        yield compressor.finish()
+
+
+def init_compression(app):
+    """Wrap the app in CompressionMiddleware according to the COMPRESS_* settings"""
+    if not app.config.get('COMPRESS_ENABLED', True):
+        return
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        level=app.config.get('COMPRESS_LEVEL', 6),
+        brotli_quality=app.config.get('COMPRESS_BROTLI_QUALITY', 4),
+        min_size=app.config.get('COMPRESS_MIN_SIZE', 1024),
+        mimetypes=app.config.get('COMPRESS_MIMETYPES', DEFAULT_MIMETYPES),
+    )
+    logger.info(f'Response compression enabled (gzip{", brotli" if brotli is not None else ""})')
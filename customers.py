@@ -0,0 +1,196 @@
+"""
+Customer lookup and creation helpers.
+
+Mobile numbers are stored normalised (digits only, without the country code
+or a trunk 0) under an index unique within each shop (a customer of two
+shops is two customers), and intake, restore and the seeder go
+through ``upsert_customer``, a single ``INSERT ... ON CONFLICT DO UPDATE ...
+RETURNING id`` on both Postgres and SQLite, so two desks registering the same
+number at once end up with one customer. ``flask dedupe-customers`` merges
+the duplicates created before the index existed.
+
+Autocomplete matches a mobile number or name prefix and is bounded to
+CUSTOMER_AUTOCOMPLETE_LIMIT rows, so each keystroke burst is one indexed
+range scan of the current shop's customers. The prefix indexes, which lead
+with ``shop_id``, are declared on the Customer model: on
+Postgres they use ``text_pattern_ops`` so ``LIKE 'prefix%'`` can use them
+under any collation; on SQLite the same prefix is matched with ``GLOB``,
+which uses a plain index.
+"""
+import re
+from collections import defaultdict
+from datetime import datetime
+
+import click
+from flask import current_app
+from sqlalchemy import case, func, select, update, delete
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from backups import record_deleted
+from models import Customer, Battery, ArchivedBattery, DEFAULT_SHOP_ID
+from shops import current_shop_id
+
+LOCAL_NUMBER_LENGTH = 10
+
+LIKE_SPECIAL = ('\\', '%', '_')
+GLOB_SPECIAL = ('*', '?', '[', ']')
+
+
+def prefix_match(expression, prefix):
+    """A filter matching values that start with ``prefix`` which can use a prefix index"""
+    if db.engine.dialect.name == 'sqlite':
+        for char in GLOB_SPECIAL:
+            prefix = prefix.replace(char, '')
+        return expression.op('GLOB')(prefix + '*')
+    for char in LIKE_SPECIAL:
+        prefix = prefix.replace(char, '\\' + char)
+    return expression.like(prefix + '%', escape='\\')
+
+
+def normalize_mobile(value, country_code=None):
+    """Digits only, without the country code or a leading trunk 0 (e.g. '+91 98450-12345' -> '9845012345')"""
+    if country_code is None:
+        country_code = current_app.config.get('MOBILE_COUNTRY_CODE', '91')
+    digits = re.sub(r'\D', '', value or '')
+    if country_code and digits.startswith(country_code) and len(digits) == len(country_code) + LOCAL_NUMBER_LENGTH:
+        digits = digits[len(country_code):]
+    elif digits.startswith('0') and len(digits) == LOCAL_NUMBER_LENGTH + 1:
+        digits = digits[1:]
+    return digits
+
+
+def upsert_customer(name, mobile, mobile_secondary=None, created_at=None, shop_id=None):
+    """Return the id of the shop's customer with this mobile, creating it if needed, in one statement.
+
+    The shop defaults to the current one. An existing customer keeps its
+    name; a missing secondary mobile is filled in.
+    """
+    values = {
+        'shop_id': shop_id or current_shop_id() or DEFAULT_SHOP_ID,
+        'name': name,
+        'mobile': normalize_mobile(mobile),
+        'mobile_secondary': normalize_mobile(mobile_secondary) or None,
+        'created_at': created_at or datetime.utcnow(),
+    }
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+        table = Customer.__table__
+        statement = insert(table).values(**values)
+        # Only a newly filled in secondary mobile counts as a change for incremental backups
+        fills_secondary = table.c.mobile_secondary.is_(None) & statement.excluded.mobile_secondary.isnot(None)
+        statement = statement.on_conflict_do_update(
+            index_elements=['shop_id', 'mobile'],
+            set_={
+                'mobile_secondary': func.coalesce(table.c.mobile_secondary, statement.excluded.mobile_secondary),
+                'modified_at': case((fills_secondary, datetime.utcnow()), else_=table.c.modified_at),
+            }
+        ).returning(table.c.id)
+        return db.session.execute(statement).scalar_one()
+
+    # Other databases: insert and fall back to the row that won the race
+    existing = db.session.query(Customer.id).filter_by(shop_id=values['shop_id'], mobile=values['mobile']).scalar()
+    if existing:
+        return existing
+    try:
+        with db.session.begin_nested():
+            customer = Customer(**values)
+            db.session.add(customer)
+        return customer.id
+    except IntegrityError:
+        return db.session.query(Customer.id).filter_by(shop_id=values['shop_id'], mobile=values['mobile']).scalar()
+
+
+def dedupe_customers(conn, country_code=None):
+    """Normalise every stored mobile and merge customers of a shop sharing one into the oldest.
+
+    Batteries (hot and archived) of the merged customers are moved to the one
+    kept, which also takes the first secondary mobile it was missing. Runs on
+    ``conn`` without committing. Returns counts of what changed.
+    """
+    customer = Customer.__table__
+    rows = conn.execute(select(customer.c.id, customer.c.shop_id, customer.c.mobile, customer.c.mobile_secondary)
+                        .order_by(customer.c.id)).all()
+
+    groups = defaultdict(list)
+    for row in rows:
+        groups[row.shop_id, normalize_mobile(row.mobile, country_code) or row.mobile].append(row)
+
+    stats = {'customers': len(rows), 'merged': 0, 'normalised': 0}
+    for (_, mobile), members in groups.items():
+        keep, duplicates = members[0], members[1:]
+        secondary = normalize_mobile(keep.mobile_secondary, country_code) or None
+        if duplicates:
+            duplicate_ids = [row.id for row in duplicates]
+            for table in (Battery.__table__, ArchivedBattery.__table__):
+                conn.execute(update(table).where(table.c.customer_id.in_(duplicate_ids)).values(customer_id=keep.id))
+            conn.execute(delete(customer).where(customer.c.id.in_(duplicate_ids)))
+            record_deleted(conn, 'customer', duplicate_ids)
+            for row in duplicates:
+                candidate = normalize_mobile(row.mobile_secondary, country_code)
+                if not secondary and candidate and candidate != mobile:
+                    secondary = candidate
+            stats['merged'] += len(duplicates)
+        if mobile != keep.mobile or secondary != keep.mobile_secondary:
+            conn.execute(update(customer).where(customer.c.id == keep.id).values(mobile=mobile, mobile_secondary=secondary))
+            stats['normalised'] += 1
+    return stats
+
+
+def normalize_mobile_prefix(term, country_code=None):
+    """The start of a mobile as typed, normalised like stored mobiles (e.g. '+91 9845' -> '9845'); None if not digits"""
+    if country_code is None:
+        country_code = current_app.config.get('MOBILE_COUNTRY_CODE', '91')
+    term = term.replace(' ', '').replace('-', '')
+    international = term.startswith('+')
+    digits = term.lstrip('+')
+    if not digits.isdigit():
+        return None
+    if digits.startswith('00'):
+        international, digits = True, digits[2:]
+    # Without a + the country code is only told apart from the number once more digits than a number has are typed
+    if country_code and digits.startswith(country_code) and (international or len(digits) > LOCAL_NUMBER_LENGTH):
+        digits = digits[len(country_code):]
+    elif digits.startswith('0'):
+        digits = digits[1:]
+    return digits
+
+
+def autocomplete_customers(term, limit=None):
+    """Customers whose mobile (for digits) or name starts with ``term``"""
+    if limit is None:
+        limit = current_app.config.get('CUSTOMER_AUTOCOMPLETE_LIMIT', 8)
+    term = term.strip()
+    digits = normalize_mobile_prefix(term)
+    if digits:
+        query = Customer.query.filter(prefix_match(Customer.mobile, digits)).order_by(Customer.mobile)
+    else:
+        query = Customer.query.filter(prefix_match(func.lower(Customer.name), term.lower())).order_by(func.lower(Customer.name))
+    return query.limit(limit).all()
+
+
+def customer_to_dict(customer):
+    return {
+        'id': customer.id,
+        'name': customer.name,
+        'mobile': customer.mobile,
+        'mobile_secondary': customer.mobile_secondary
+    }
+
+
+def register_customer_commands(app):
+    @app.cli.command('dedupe-customers')
+    @click.option('--dry-run', is_flag=True, help='Report what would change without saving it')
+    def dedupe_customers_command(dry_run):
+        """Normalise customer mobiles and merge customers that share one."""
+        with db.engine.connect() as conn:
+            stats = dedupe_customers(conn)
+            if dry_run:
+                conn.rollback()
+            else:
+                conn.commit()
+        prefix = 'Would merge' if dry_run else 'Merged'
+        click.echo(f"{prefix} {stats['merged']} duplicate customers and normalise {stats['normalised']} "
+                   f"mobiles ({stats['customers']} customers checked).")
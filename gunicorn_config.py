@@ -0,0 +1,40 @@
+"""
+Gunicorn production profile.
+
+    gunicorn -c gunicorn_config.py main:app
+
+Workers default to cores * 2 + 1 (WEB_WORKERS), each running WEB_THREADS
+request threads, plus LIVE_MAX_STREAMS threads for the live event streams.
+gthread does not set those aside, so live.py lets no more than WEB_THREADS
+other requests run at once; streams hold no database connection, so the pool
+is sized for WEB_THREADS alone. The app is imported once in the master (preload_app) and
+forked, so workers start quickly; code reloading is off.
+"""
+import os
+
+from serving import get_worker_count, get_thread_count, get_live_stream_count
+
+bind = os.environ.get("WEB_BIND", "0.0.0.0:5000")
+workers = get_worker_count()
+# Live event streams (live.py) each keep a thread busy but idle
+threads = get_thread_count() + get_live_stream_count()
+worker_class = "gthread"
+timeout = int(os.environ.get("WEB_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+preload_app = True
+reload = False
+
+# Recycle workers now and then so slow leaks cannot build up
+max_requests = int(os.environ.get("WEB_MAX_REQUESTS", 2000))
+max_requests_jitter = 200
+
+accesslog = os.environ.get("WEB_ACCESS_LOG", "-")
+
+
+def post_fork(server, worker):
+    # Connections opened in the master while preloading must not be shared
+    # with the forked workers; drop them so each worker opens its own.
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
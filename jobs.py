@@ -0,0 +1,551 @@
+"""
+Background job runner for exports, backups, restores and reports.
+
+Heavy operations are recorded as rows in the ``job`` table and executed on a
+per-process thread pool, so request workers only enqueue work and poll for
+its status. Results are written to files under ``instance/jobs`` and removed
+once they expire. Because state lives in the database, any worker can answer
+status and download requests for a job started by another worker.
+"""
+import csv
+import json
+import logging
+import os
+import threading
+import uuid
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app, render_template
+from flask_login import login_user
+from sqlalchemy import extract, func, update
+from sqlalchemy.orm import contains_eager
+
+from app import db
+from replica import use_replica, wrote_recently
+from shops import SHOP_SETTINGS, current_shop_id, use_shop, sync_battery_counter
+from customers import upsert_customer
+from backups import export_backup, is_local_setting, merge_backups, record_watermark
+from passwords import hash_password
+from models import (User, Customer, Battery, BatteryStatusHistory, BatteryStaffNote, SystemSettings, Job, DeletedRow, Shop,
+                    ArchivedBattery, ArchivedBatteryStatusHistory, ArchivedBatteryStaffNote,
+                    TurnaroundDaily, TechnicianDaily)
+
+JOB_HANDLERS = {}
+
+_executor = None
+_executor_lock = threading.Lock()
+_last_cleanup = None
+
+CLEANUP_INTERVAL = timedelta(minutes=5)
+
+
+class JobContext:
+    """Handed to job handlers so they can report progress and find their output file"""
+
+    def __init__(self, job):
+        self.id = job.id
+        self.user_id = job.created_by
+        self.result_path = os.path.join(get_jobs_dir(), f'{job.id}.out')
+        self._last_progress = -1
+
+    def report(self, progress, message=None):
+        """Record progress (0-100) on a separate connection so it is visible mid-job"""
+        progress = max(0, min(int(progress), 99))
+        if progress == self._last_progress and message is None:
+            return
+        self._last_progress = progress
+        values = {'progress': progress}
+        if message is not None:
+            values['message'] = message[:255]
+        if _holds_sqlite_write_lock():
+            # SQLite allows a single writer; the job's own open transaction has it
+            return
+        try:
+            _update_job(self.id, **values)
+        except Exception as e:
+            logging.debug(f'Could not record progress for job {self.id}: {e}')
+
+
+def job_handler(kind, roles=None, read_only=False, all_shops=False, head_office=False):
+    """Register a function as the handler for a job kind.
+
+    ``roles`` restricts which user roles may submit the job; ``None`` allows
+    any logged in user, and ``head_office`` only users bound to no shop.
+    ``read_only`` handlers may run against the read replica. Jobs run in the
+    shop they were submitted from; ``all_shops`` ones cover every shop when
+    head office submits them, and only their own shop for users bound to one.
+    """
+    def decorator(func):
+        JOB_HANDLERS[kind] = {'func': func, 'roles': roles, 'read_only': read_only, 'all_shops': all_shops,
+                              'head_office': head_office}
+        return func
+    return decorator
+
+
+def can_submit(kind, user):
+    handler = JOB_HANDLERS.get(kind)
+    if not handler:
+        return False
+    if handler['head_office'] and user.shop_id is not None:
+        return False
+    return handler['roles'] is None or user.role in handler['roles']
+
+
+def get_jobs_dir():
+    jobs_dir = os.path.join(current_app.instance_path, 'jobs')
+    os.makedirs(jobs_dir, exist_ok=True)
+    return jobs_dir
+
+
+def _get_executor():
+    # Created lazily so a preloaded master process never owns pool threads
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=current_app.config.get('JOB_WORKERS', 2),
+                thread_name_prefix='job'
+            )
+        return _executor
+
+
+def _update_job(job_id, **values):
+    with db.engine.begin() as conn:
+        conn.execute(update(Job.__table__).where(Job.__table__.c.id == job_id).values(**values))
+
+
+def _holds_sqlite_write_lock():
+    session = db.session()
+    if db.engine.dialect.name != 'sqlite' or not session.in_transaction():
+        return False
+    return session.connection().connection.driver_connection.in_transaction
+
+
+def submit_job(kind, user_id, **params):
+    """Create a job row and schedule it on the pool. Returns the Job."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f'Unknown job kind: {kind}')
+
+    cleanup_expired_jobs()
+
+    ttl = timedelta(hours=current_app.config.get('JOB_RESULT_TTL_HOURS', 24))
+    job = Job()
+    job.id = uuid.uuid4().hex
+    job.kind = kind
+    job.status = 'queued'
+    job.progress = 0
+    job.params = json.dumps(params)
+    job.created_by = user_id
+    if JOB_HANDLERS[kind]['all_shops']:
+        user = db.session.get(User, user_id)
+        job.shop_id = user.shop_id if user is not None else current_shop_id()
+    else:
+        job.shop_id = current_shop_id()
+    job.created_at = datetime.utcnow()
+    job.expires_at = job.created_at + ttl
+    db.session.add(job)
+    db.session.commit()
+
+    # A user who just changed something should see it in their export or report
+    _get_executor().submit(_run_job, current_app._get_current_object(), job.id, wrote_recently())
+    return job
+
+
+def _run_job(app, job_id, primary_only=False):
+    with app.app_context():
+        job = db.session.get(Job, job_id)
+        if job is None:
+            return
+
+        _update_job(job_id, status='running', started_at=datetime.utcnow())
+        ctx = JobContext(job)
+        handler = JOB_HANDLERS[job.kind]
+        params = json.loads(job.params or '{}')
+
+        try:
+            with use_shop(job.shop_id):
+                if handler['read_only']:
+                    with use_replica(primary_only):
+                        result = handler['func'](ctx, **params) or {}
+                else:
+                    result = handler['func'](ctx, **params) or {}
+            _update_job(
+                job_id,
+                status='finished',
+                progress=100,
+                message=result.get('message'),
+                result_path=os.path.basename(ctx.result_path) if os.path.exists(ctx.result_path) else None,
+                result_name=result.get('filename'),
+                result_mimetype=result.get('mimetype'),
+                finished_at=datetime.utcnow()
+            )
+        except Exception as e:
+            db.session.rollback()
+            logging.exception(f'Job {job_id} ({job.kind}) failed')
+            if os.path.exists(ctx.result_path):
+                os.remove(ctx.result_path)
+            _update_job(job_id, status='failed', message=str(e)[:255], finished_at=datetime.utcnow())
+
+
+def get_result_file(job):
+    if not job.result_path:
+        return None
+    path = os.path.join(get_jobs_dir(), job.result_path)
+    return path if os.path.exists(path) else None
+
+
+def cleanup_expired_jobs(force=False):
+    """Delete expired job rows with their files and fail jobs that never finished.
+
+    Runs at most once every few minutes per process unless ``force`` is set.
+    """
+    global _last_cleanup
+    now = datetime.utcnow()
+    if not force and _last_cleanup and now - _last_cleanup < CLEANUP_INTERVAL:
+        return 0
+    _last_cleanup = now
+
+    # Jobs left queued/running by a worker that was killed or restarted
+    timeout = timedelta(minutes=current_app.config.get('JOB_TIMEOUT_MINUTES', 60))
+    Job.query.filter(
+        Job.status.in_(['queued', 'running']),
+        Job.created_at < now - timeout
+    ).update({'status': 'failed', 'message': 'Interrupted', 'finished_at': now}, synchronize_session=False)
+
+    expired = Job.query.filter(Job.expires_at < now).all()
+    jobs_dir = get_jobs_dir()
+    for job in expired:
+        upload_paths = json.loads(job.params or '{}').get('upload_paths', [])
+        for name in [job.result_path] + upload_paths:
+            path = os.path.join(jobs_dir, os.path.basename(name)) if name else None
+            if path and os.path.exists(path):
+                os.remove(path)
+        db.session.delete(job)
+
+    db.session.commit()
+    return len(expired)
+
+
+def job_to_dict(job):
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'progress': job.progress or 0,
+        'message': job.message,
+        'result_name': job.result_name,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'expires_at': job.expires_at.isoformat() if job.expires_at else None
+    }
+
+
+@job_handler('export_csv', read_only=True)
+def _export_rows(model, history_model):
+    """(battery, time of its last status update) with the customer loaded, in one query"""
+    latest = db.session.query(
+        history_model.battery_id, func.max(history_model.updated_at).label('updated_at')
+    ).group_by(history_model.battery_id).subquery()
+    return (db.session.query(model, latest.c.updated_at)
+            .join(model.customer)
+            .outerjoin(latest, latest.c.battery_id == model.id)
+            .options(contains_eager(model.customer))
+            .order_by(model.id)
+            .yield_per(500))
+
+
+def export_csv_job(ctx):
+    total = (Battery.query.count() + ArchivedBattery.query.count()) or 1
+    batteries = chain(
+        _export_rows(Battery, BatteryStatusHistory),
+        _export_rows(ArchivedBattery, ArchivedBatteryStatusHistory)
+    )
+
+    with open(ctx.result_path, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output)
+
+        # Write header
+        writer.writerow([
+            'Battery ID', 'Customer Name', 'Mobile', 'Battery Type',
+            'Voltage', 'Capacity', 'Status', 'Inward Date',
+            'Service Price', 'Last Updated'
+        ])
+
+        # Write data
+        for index, (battery, last_update) in enumerate(batteries, 1):
+            last_update = last_update or battery.inward_date
+            writer.writerow([
+                battery.battery_id,
+                battery.customer.name,
+                battery.customer.mobile,
+                battery.battery_type,
+                battery.voltage,
+                battery.capacity,
+                battery.status,
+                battery.inward_date.strftime('%Y-%m-%d %H:%M'),
+                battery.service_price,
+                last_update.strftime('%Y-%m-%d %H:%M')
+            ])
+            if index % 500 == 0:
+                ctx.report(index * 100 / total)
+
+    return {
+        'filename': f'battery_records_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv',
+        'mimetype': 'text/csv'
+    }
+
+
+@job_handler('backup', roles=['admin', 'shop_staff'], read_only=True, all_shops=True)
+def backup_job(ctx, since=None):
+    # None (every shop) for head office, else the shop of the user who asked for it
+    shop_id = current_shop_id()
+    backup_data = export_backup(since, progress=ctx.report, shop_id=shop_id)
+    with open(ctx.result_path, 'w', encoding='utf-8') as output:
+        json.dump(backup_data, output, indent=2)
+    record_watermark(backup_data['watermark'], shop_id)
+
+    scope = f'shop{shop_id}_' if shop_id else ''
+    return {
+        'filename': f'battery_erp_{scope}{backup_data["kind"]}_backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json',
+        'mimetype': 'application/json'
+    }
+
+
+@job_handler('snapshot', roles=['admin'], read_only=True, all_shops=True, head_office=True)
+def snapshot_job(ctx):
+    from snapshot import write_snapshot
+    write_snapshot(ctx.result_path, progress=ctx.report)
+    return {
+        'filename': f'battery_erp_snapshot_{datetime.now().strftime("%Y%m%d_%H%M%S")}.sqlite',
+        'mimetype': 'application/vnd.sqlite3'
+    }
+
+
+@job_handler('restore', roles=['admin'], all_shops=True, head_office=True)
+def restore_job(ctx, upload_paths):
+    backups = []
+    try:
+        for upload_path in upload_paths:
+            with open(os.path.join(get_jobs_dir(), os.path.basename(upload_path)), encoding='utf-8') as f:
+                backups.append(json.load(f))
+    finally:
+        for upload_path in upload_paths:
+            upload_file = os.path.join(get_jobs_dir(), os.path.basename(upload_path))
+            if os.path.exists(upload_file):
+                os.remove(upload_file)
+    # A full backup and the incremental backups taken after it
+    backup_data = merge_backups(backups)
+
+    admin = db.session.get(User, ctx.user_id)
+    if admin is None or admin.role != 'admin' or admin.shop_id is not None:
+        raise ValueError('Restore must be run by a head office admin user')
+
+    # Clear existing data (preserve current admin)
+    ArchivedBatteryStaffNote.query.delete()
+    ArchivedBatteryStatusHistory.query.delete()
+    ArchivedBattery.query.delete()
+    BatteryStaffNote.query.delete()
+    BatteryStatusHistory.query.delete()
+    Battery.query.delete()
+    Customer.query.delete()
+    SystemSettings.query.delete()
+    # Derived from the history; rebuilt by the next report view (or `flask analytics-refresh`)
+    TurnaroundDaily.query.delete()
+    TechnicianDaily.query.delete()
+    # Ids are assigned afresh, so deletions recorded so far mean nothing any more
+    DeletedRow.query.delete()
+    # Don't delete current admin user
+    User.query.filter(User.id != admin.id).delete()
+    ctx.report(10, 'Cleared existing data')
+
+    # Restore shops, matched by code; shops missing from the backup go, except the admin's own
+    shop_id_mapping = {}
+    backup_shops = backup_data.get('shops', [])
+    if backup_shops:
+        Shop.query.filter(Shop.code.notin_([shop_data['code'] for shop_data in backup_shops]),
+                          Shop.id != admin.shop_id).delete(synchronize_session=False)
+    for shop_data in backup_shops:
+        shop = Shop.query.filter_by(code=shop_data['code']).first() or Shop(code=shop_data['code'])
+        shop.name = shop_data['name']
+        shop.battery_id_prefix = shop_data['battery_id_prefix']
+        shop.battery_id_start = shop_data.get('battery_id_start', 1)
+        shop.battery_id_padding = shop_data.get('battery_id_padding', 4)
+        shop.last_battery_number = shop_data.get('last_battery_number', 0)
+        shop.is_active = shop_data.get('is_active', True)
+        db.session.add(shop)
+        db.session.flush()
+        shop_id_mapping[shop_data['id']] = shop.id
+
+    # Older backups have no shops: everything goes to the first shop, which takes their shop settings
+    first_shop_id = db.session.query(func.min(Shop.id)).scalar()
+    if not backup_shops:
+        legacy = {setting_data['setting_key']: setting_data['setting_value']
+                  for setting_data in backup_data.get('settings', []) if setting_data['setting_key'] in SHOP_SETTINGS}
+        shop = db.session.get(Shop, first_shop_id)
+        shop.name = legacy.get('shop_name', shop.name)
+        shop.battery_id_prefix = legacy.get('battery_id_prefix', shop.battery_id_prefix)
+        shop.battery_id_start = int(legacy.get('battery_id_start', shop.battery_id_start))
+        shop.battery_id_padding = int(legacy.get('battery_id_padding', shop.battery_id_padding))
+
+    def shop_of(row_data):
+        return shop_id_mapping.get(row_data.get('shop_id'), first_shop_id)
+
+    # Restore customers
+    customer_id_mapping = {}
+    for customer_data in backup_data.get('customers', []):
+        # Customers of a shop sharing a mobile in older backups are merged into one
+        customer_id_mapping[customer_data['id']] = upsert_customer(
+            customer_data['name'],
+            customer_data['mobile'],
+            customer_data.get('mobile_secondary'),
+            datetime.fromisoformat(customer_data['created_at']) if customer_data.get('created_at') else None,
+            shop_id=shop_of(customer_data)
+        )
+    ctx.report(30, 'Restored customers')
+
+    # Restore batteries
+    battery_id_mapping = {}
+    battery_shops = {}
+    for battery_data in backup_data.get('batteries', []):
+        battery = Battery()
+        battery.shop_id = shop_of(battery_data)
+        battery.battery_id = battery_data['battery_id']
+        battery.customer_id = customer_id_mapping.get(battery_data['customer_id'])
+        battery.battery_type = battery_data['battery_type']
+        battery.voltage = battery_data['voltage']
+        battery.capacity = battery_data['capacity']
+        battery.status = battery_data['status']
+        battery.service_price = battery_data.get('service_price', 0.0)
+        if battery_data.get('inward_date'):
+            battery.inward_date = datetime.fromisoformat(battery_data['inward_date'])
+        db.session.add(battery)
+        db.session.flush()
+        battery_id_mapping[battery_data['id']] = battery.id
+        battery_shops[battery.id] = battery.shop_id
+    # Counters from before a battery in the backup was registered must not hand out its ID again
+    for shop_id in set(shop_id_mapping.values()) | {first_shop_id}:
+        sync_battery_counter(db.session.connection(), shop_id)
+    ctx.report(60, 'Restored batteries')
+
+    # Restore users (except passwords)
+    default_hash = hash_password('password123')
+    for user_data in backup_data.get('users', []):
+        if user_data['username'] != admin.username:  # Don't overwrite current admin
+            user = User()
+            user.username = user_data['username']
+            user.full_name = user_data['full_name']
+            user.role = user_data['role']
+            # Head office users (and everyone in older backups) have no shop
+            user.shop_id = shop_id_mapping.get(user_data.get('shop_id'))
+            user.password_hash = default_hash
+            user.active = user_data.get('is_active', True)
+            if user_data.get('created_at'):
+                user.created_at = datetime.fromisoformat(user_data['created_at'])
+            db.session.add(user)
+
+    # Restore status history
+    for history_data in backup_data.get('status_history', []):
+        if battery_id_mapping.get(history_data['battery_id']):
+            history = BatteryStatusHistory()
+            history.battery_id = battery_id_mapping[history_data['battery_id']]
+            history.shop_id = battery_shops[history.battery_id]
+            history.status = history_data['status']
+            history.comments = history_data.get('comments', '')
+            history.updated_by = admin.id  # Assign to current admin
+            if history_data.get('updated_at'):
+                history.updated_at = datetime.fromisoformat(history_data['updated_at'])
+            db.session.add(history)
+    ctx.report(80, 'Restored status history')
+
+    # Restore staff notes
+    for note_data in backup_data.get('staff_notes', []):
+        if battery_id_mapping.get(note_data['battery_id']):
+            note = BatteryStaffNote()
+            note.battery_id = battery_id_mapping[note_data['battery_id']]
+            note.shop_id = battery_shops[note.battery_id]
+            note.note = note_data['note']
+            note.note_type = note_data.get('note_type') or 'followup'
+            note.created_by = admin.id  # Assign to current admin
+            note.is_resolved = note_data.get('is_resolved', False)
+            if note_data.get('created_at'):
+                note.created_at = datetime.fromisoformat(note_data['created_at'])
+            db.session.add(note)
+    ctx.report(90, 'Restored staff notes')
+
+    # Restore system settings (a new chain of incremental backups starts with the next full backup)
+    for setting_data in backup_data.get('settings', []):
+        if is_local_setting(setting_data['setting_key']) or setting_data['setting_key'] in SHOP_SETTINGS:
+            continue
+        setting = SystemSettings()
+        setting.setting_key = setting_data['setting_key']
+        setting.setting_value = setting_data['setting_value']
+        if setting_data.get('updated_at'):
+            setting.updated_at = datetime.fromisoformat(setting_data['updated_at'])
+        db.session.add(setting)
+
+    db.session.commit()
+    return {'message': 'Data restored successfully! Note: Restored user passwords have been reset to "password123".'}
+
+
+@job_handler('yearly_report', read_only=True)
+def yearly_report_job(ctx, year, include_archived=False):
+    yearly_batteries = Battery.query.filter(
+        extract('year', Battery.inward_date) == year
+    ).all()
+    if include_archived:
+        # Archived batteries are closed, so they only add to the list, never to the Ready totals
+        yearly_batteries += ArchivedBattery.query.filter(
+            extract('year', ArchivedBattery.inward_date) == year
+        ).order_by(ArchivedBattery.inward_date).all()
+
+    yearly_completed = Battery.query.filter(
+        Battery.status == 'Ready',
+        extract('year', Battery.inward_date) == year
+    ).count()
+
+    yearly_revenue = db.session.query(func.sum(Battery.service_price)).filter(
+        Battery.status == 'Ready',
+        extract('year', Battery.inward_date) == year
+    ).scalar() or 0
+    ctx.report(30, 'Loaded yearly totals')
+
+    # Get monthly breakdown
+    monthly_breakdown = []
+    for month in range(1, 13):
+        month_revenue = db.session.query(func.sum(Battery.service_price)).filter(
+            Battery.status == 'Ready',
+            extract('month', Battery.inward_date) == month,
+            extract('year', Battery.inward_date) == year
+        ).scalar() or 0
+
+        month_count = Battery.query.filter(
+            Battery.status == 'Ready',
+            extract('month', Battery.inward_date) == month,
+            extract('year', Battery.inward_date) == year
+        ).count()
+
+        monthly_breakdown.append({
+            'month': datetime(year, month, 1).strftime('%B'),
+            'revenue': float(month_revenue),
+            'count': month_count
+        })
+    ctx.report(60, 'Rendering report')
+
+    # Render as the submitting user so the navigation matches their role
+    user = db.session.get(User, ctx.user_id)
+    with current_app.test_request_context():
+        if user:
+            login_user(user)
+        html = render_template('reports/yearly.html',
+                               batteries=yearly_batteries,
+                               completed_count=yearly_completed,
+                               total_revenue=float(yearly_revenue),
+                               year=year,
+                               monthly_breakdown=monthly_breakdown)
+
+    with open(ctx.result_path, 'w', encoding='utf-8') as output:
+        output.write(html)
+
+    return {'filename': f'yearly_report_{year}.html', 'mimetype': 'text/html'}
@@ -0,0 +1,317 @@
+"""
+Live battery events for the technician panel and dashboard (server-sent events).
+
+Every committed battery intake, status change and delivery becomes a small
+JSON event. On Postgres it is sent with ``pg_notify`` inside the writing
+transaction, so it is only delivered if the transaction commits, and each
+worker process runs one listener thread (on its own connection) that fans
+the notifications out to the streams it serves. Elsewhere (SQLite) events go
+straight to the streams of the process that committed them, which is enough
+for a single-process development server.
+
+Streams hold no database connection and sit idle on a queue between events.
+gunicorn_config.py gives every worker LIVE_MAX_STREAMS extra threads for
+them, and a worker answers 204 (the browser stops retrying and the page stays
+static) once they are all taken. gthread hands any request to any thread, so
+other requests wait for one of WEB_THREADS slots before they start; the
+database pool is only sized for that many (serving.py). Each stream ends after LIVE_STREAM_SECONDS
+and the browser reconnects with the id of the last event it saw; events it
+missed meanwhile are replayed from a short per-process history, or the page
+is told to reload when the history does not reach back that far.
+"""
+import json
+import logging
+import queue
+import select
+import threading
+import time
+from collections import deque
+
+from flask import Blueprint, Response, current_app, g, request
+from flask_login import login_required
+from sqlalchemy import event, inspect, text
+
+from replica import RoutingSession
+
+logger = logging.getLogger('live')
+
+CHANNEL = 'battery_events'
+NOTIFY_SQL = text('SELECT pg_notify(:channel, :payload)')
+
+DELIVERED_STATUSES = ('Delivered', 'Returned')
+
+# Events a reconnecting stream may be behind by without being replayed
+REPLAY_GRACE_SECONDS = 2
+
+live_bp = Blueprint('live', __name__)
+
+_subscribers = set()
+_lock = threading.Lock()
+_history = deque(maxlen=200)
+# Events after this moment are all in _history (or none were missed)
+_complete_since = time.time()
+_listener = None
+# Ordinary requests running at once in this worker, at most WEB_THREADS
+_request_slots = None
+
+
+class Subscriber:
+    def __init__(self, size, shop_id=None):
+        self.queue = queue.Queue(maxsize=size)
+        self.overflowed = False
+        self.shop_id = shop_id
+
+    def put(self, item):
+        # Each page only follows its own shop
+        if self.shop_id is not None and item.get('shop_id') != self.shop_id:
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.overflowed = True
+
+
+def _event_id(item):
+    return f"{item['at']:.6f}:{item['id']}"
+
+
+def _dispatch(item):
+    """Hand an event to every stream of this process and remember it for reconnects"""
+    global _complete_since
+    with _lock:
+        if len(_history) == _history.maxlen:
+            _complete_since = _history[0]['at']
+        _history.append(item)
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        subscriber.put(item)
+
+
+def _gap(reason):
+    """Events may have been lost (listener reconnect): streams must reload their page"""
+    global _complete_since
+    logger.warning(f'Live events interrupted ({reason}); connected pages will reload')
+    with _lock:
+        _complete_since = time.time()
+        _history.clear()
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        subscriber.overflowed = True
+
+
+def _battery_event(session, battery, kind):
+    state = inspect(battery)
+    status_history = state.attrs.status.history
+    price_history = state.attrs.service_price.history
+    old_status = status_history.deleted[0] if status_history.deleted else battery.status
+    old_price = price_history.deleted[0] if price_history.deleted else battery.service_price
+    if kind == 'status' and old_status == battery.status and old_price == battery.service_price:
+        return None
+    if kind == 'status' and battery.status in DELIVERED_STATUSES and old_status not in DELIVERED_STATUSES:
+        kind = 'delivered'
+
+    item = {
+        'type': kind,
+        'id': battery.id,
+        'shop_id': battery.shop_id,
+        'battery_id': battery.battery_id,
+        'status': battery.status,
+        'old_status': None if kind == 'added' else old_status,
+        'service_price': battery.service_price or 0,
+        'old_service_price': 0 if kind == 'added' else old_price or 0,
+        'pickup_charge': (battery.pickup_charge or 0) if battery.is_pickup else 0,
+        'at': time.time(),
+    }
+    if kind == 'added':
+        customer = session.connection().execute(
+            text('SELECT name, mobile FROM customer WHERE id = :id'), {'id': battery.customer_id}
+        ).first()
+        if customer:
+            item.update(customer=customer.name, mobile=customer.mobile)
+    return item
+
+
+def _after_flush(session, flush_context):
+    items = []
+    for obj, kind in [(obj, 'added') for obj in session.new] + [(obj, 'status') for obj in session.dirty]:
+        if getattr(obj, '__tablename__', None) == 'battery':
+            item = _battery_event(session, obj, kind)
+            if item:
+                items.append(item)
+    if not items:
+        return
+    if session.connection().dialect.name == 'postgresql':
+        # Delivered by Postgres on commit, to every worker's listener
+        for item in items:
+            session.connection().execute(NOTIFY_SQL, {'channel': CHANNEL, 'payload': json.dumps(item)})
+    else:
+        session.info.setdefault('live_events', []).extend(items)
+
+
+def _after_commit(session):
+    for item in session.info.pop('live_events', []):
+        _dispatch(item)
+
+
+def _after_rollback(session):
+    session.info.pop('live_events', None)
+
+
+def _listen(app):
+    """Receive NOTIFYs on a dedicated connection and dispatch them, reconnecting on errors"""
+    global _complete_since
+    first = True
+    while True:
+        connection = None
+        try:
+            with app.app_context():
+                connection = app.extensions['sqlalchemy'].engine.raw_connection()
+            # Not returned to the pool: the listener keeps it for the life of the process
+            connection.detach()
+            dbapi_connection = connection.dbapi_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANNEL}')
+            if first:
+                with _lock:
+                    _complete_since = time.time()
+            else:
+                _gap('listener reconnected')
+            first = False
+            while True:
+                if select.select([dbapi_connection], [], [], 30) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    try:
+                        _dispatch(json.loads(notify.payload))
+                    except ValueError:
+                        logger.warning(f'Ignoring malformed live event: {notify.payload!r}')
+        except Exception as e:
+            logger.warning(f'Live event listener failed: {e}')
+            if connection is not None:
+                try:
+                    connection.close()
+                except Exception:
+                    pass
+            first = False
+            time.sleep(5)
+
+
+def _ensure_listener():
+    # Started lazily so a preloaded master process never owns the listener
+    global _listener
+    if current_app.extensions['sqlalchemy'].engine.dialect.name != 'postgresql':
+        return
+    with _lock:
+        if _listener is None:
+            _listener = threading.Thread(
+                target=_listen, args=(current_app._get_current_object(),),
+                name='live-listener', daemon=True
+            )
+            _listener.start()
+
+
+def _replay(last_event_id, shop_id=None):
+    """Events of the shop after ``last_event_id``, or None when some of them are no longer known"""
+    try:
+        last_at = float(last_event_id.split(':')[0])
+    except ValueError:
+        return None
+    with _lock:
+        if last_at - REPLAY_GRACE_SECONDS < _complete_since:
+            return None
+        # Within the grace window the page drops events it has already applied
+        return [item for item in _history if item['at'] >= last_at - REPLAY_GRACE_SECONDS
+                and (shop_id is None or item.get('shop_id') == shop_id)]
+
+
+def _format(event_name, data, event_id=None):
+    lines = [f'event: {event_name}']
+    if event_id:
+        lines.append(f'id: {event_id}')
+    lines.append(f'data: {data}')
+    return '\n'.join(lines) + '\n\n'
+
+
+@live_bp.route('/live/events')
+@login_required
+def events():
+    if not current_app.config.get('LIVE_UPDATES_ENABLED', True):
+        return Response(status=204)
+    _ensure_listener()
+
+    # Imported here: this module is loaded by app.py before the models
+    from shops import current_shop_id
+    shop_id = current_shop_id()
+    subscriber = Subscriber(current_app.config.get('LIVE_QUEUE_SIZE', 100), shop_id)
+    with _lock:
+        if len(_subscribers) >= current_app.config.get('LIVE_MAX_STREAMS', 16):
+            logger.info('All live event streams of this worker are in use; refusing another')
+            return Response(status=204)
+        _subscribers.add(subscriber)
+
+    last_event_id = request.headers.get('Last-Event-ID')
+    missed = _replay(last_event_id, shop_id) if last_event_id else []
+    heartbeat = current_app.config.get('LIVE_HEARTBEAT_SECONDS', 20)
+    deadline = time.monotonic() + current_app.config.get('LIVE_STREAM_SECONDS', 600)
+
+    # Runs after the request context (and its database session) is gone
+    def stream():
+        yield 'retry: 3000\n\n'
+        if missed is None:
+            yield _format('reload', '{}')
+            return
+        for item in missed:
+            yield _format('battery', json.dumps(item), _event_id(item))
+        while time.monotonic() < deadline:
+            if subscriber.overflowed:
+                yield _format('reload', '{}')
+                return
+            try:
+                item = subscriber.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                # Also how a closed browser tab is noticed
+                yield ': ping\n\n'
+                continue
+            yield _format('battery', json.dumps(item), _event_id(item))
+
+    def unsubscribe():
+        with _lock:
+            _subscribers.discard(subscriber)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    # The server closes the response when the stream ends or the browser goes away
+    response.call_on_close(unsubscribe)
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx and similar proxies from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _take_request_slot():
+    if request.endpoint != 'live.events':
+        _request_slots.acquire()
+        g.request_slot = True
+
+
+def _return_request_slot(exc):
+    if g.pop('request_slot', False):
+        _request_slots.release()
+
+
+def init_live(app):
+    """Publish battery changes from every session once live updates are enabled, and keep
+    other requests to WEB_THREADS of the worker's threads; call before init_profiler"""
+    global _request_slots
+    if not app.config.get('LIVE_UPDATES_ENABLED', True):
+        return
+    if _request_slots is None:
+        _request_slots = threading.BoundedSemaphore(app.config.get('WEB_THREADS', 4))
+        app.before_request(_take_request_slot)
+        app.teardown_request(_return_request_slot)
+    for name, listener in (('after_flush', _after_flush), ('after_commit', _after_commit),
+                           ('after_rollback', _after_rollback)):
+        if not event.contains(RoutingSession, name, listener):
+            event.listen(RoutingSession, name, listener)
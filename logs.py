@@ -0,0 +1,213 @@
+"""
+Logging: levels per logger, JSON records, and writing off the request path.
+
+``configure_logging()`` (at the top of app.py, before anything logs) routes
+every record through a ``QueueHandler`` on the root logger. Request threads
+only put the record on an in-memory queue; a ``QueueListener`` thread
+formats it and writes it to stderr (or LOG_FILE). If the queue is full
+(LOG_QUEUE_SIZE records waiting) further records are dropped and counted
+rather than making the request wait; the count is logged with the next record
+that fits.
+
+Each record is one JSON object per line (LOG_FORMAT=json, the default):
+
+    {"ts": "2025-06-01T10:15:02.114Z", "level": "WARNING", "logger": "replica",
+     "message": "...", "request_id": "3f9c0a7d12e44b08", "user_id": "2",
+     "route": "main.search", "method": "GET", "path": "/search", "pid": 12}
+
+The request fields are captured in the request thread as the record is
+queued. The request ID comes from an ``X-Request-ID`` header set by a proxy,
+or is made up, and is sent back in the response's ``X-Request-ID``.
+
+LOG_LEVEL sets the root level (INFO; DEBUG with FLASK_DEBUG=1) and
+LOG_LEVELS individual loggers, e.g. ``sqlalchemy.engine=INFO,replica=DEBUG``.
+SQLAlchemy, which logs every statement at INFO, stays at WARNING unless
+LOG_LEVELS says otherwise.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from flask import g, has_request_context, request, session
+
+# Loggers too chatty for the root level, unless LOG_LEVELS names them
+QUIET_LOGGERS = {'sqlalchemy': 'WARNING'}
+
+# What an incoming X-Request-ID may look like before it is trusted
+REQUEST_ID_PATTERN = re.compile(r'[A-Za-z0-9._-]{1,64}')
+
+# LogRecord attributes that are not extra= fields
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'request'}
+
+_listener = None
+_queue_handler = None
+
+
+def parse_levels(value):
+    """``name=LEVEL,name=LEVEL`` -> {name: LEVEL}"""
+    levels = {}
+    for item in (value or '').split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the request fields added by RequestQueueHandler"""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds')[:-6] + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        request_fields = getattr(record, 'request', None)
+        if request_fields:
+            data.update(request_fields)
+        data['pid'] = record.process
+        data['thread'] = record.threadName
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in data:
+                data[key] = value
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            data['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(data, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Plain lines for development, with the request ID when there is one"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s%(request_id)s: %(message)s')
+
+    def format(self, record):
+        request_fields = getattr(record, 'request', None) or {}
+        record.request_id = f" [{request_fields['request_id']}]" if 'request_id' in request_fields else ''
+        return super().format(record)
+
+
+class RequestQueueHandler(logging.handlers.QueueHandler):
+    """Queues records without waiting; formatting is left to the listener thread"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        # Runs in the logging thread: resolve the message now (its arguments may change later)
+        # and capture the request, but leave the formatting to the listener
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if has_request_context():
+            record.request = {
+                'request_id': g.get('request_id'),
+                # From the session, so logging never loads the user from the database
+                'user_id': session.get('_user_id'),
+                'route': request.endpoint,
+                'method': request.method,
+                'path': request.path,
+            }
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+            return
+        if self.dropped:
+            with self._dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                note = logging.makeLogRecord({'name': 'logs', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                                              'msg': f'Dropped {dropped} log records while the log queue was full'})
+                try:
+                    self.queue.put_nowait(note)
+                except queue.Full:
+                    pass
+
+
+def _output_handler():
+    path = os.environ.get('LOG_FILE')
+    # Follows logrotate moving the file
+    handler = logging.handlers.WatchedFileHandler(path) if path else logging.StreamHandler(sys.stderr)
+    default_format = 'text' if os.environ.get('FLASK_DEBUG') == '1' else 'json'
+    if os.environ.get('LOG_FORMAT', default_format).lower() == 'text':
+        handler.setFormatter(TextFormatter())
+    else:
+        handler.setFormatter(JsonFormatter())
+    return handler
+
+
+def _start_listener():
+    global _listener
+    log_queue = queue.Queue(int(os.environ.get('LOG_QUEUE_SIZE', 10000)))
+    _queue_handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, _output_handler(), respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_listener_after_fork():
+    # The listener thread of the parent (e.g. the preloading gunicorn master) does not exist in
+    # the forked worker, and its queue may have been mid-put; give the child its own
+    if _queue_handler is not None:
+        _start_listener()
+
+
+def _stop_listener():
+    if _listener is not None:
+        # Writes out what is still queued
+        _listener.stop()
+
+
+def configure_logging():
+    """Send all logging through the queue and set the levels from LOG_LEVEL and LOG_LEVELS"""
+    global _queue_handler
+    if _queue_handler is not None:
+        return
+    default_level = 'DEBUG' if os.environ.get('FLASK_DEBUG') == '1' else 'INFO'
+    root = logging.getLogger()
+    root.setLevel(os.environ.get('LOG_LEVEL', default_level).upper())
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    _queue_handler = RequestQueueHandler(None)
+    root.addHandler(_queue_handler)
+    _start_listener()
+
+    for name, level in dict(QUIET_LOGGERS, **parse_levels(os.environ.get('LOG_LEVELS'))).items():
+        logging.getLogger(name).setLevel(level)
+
+    os.register_at_fork(after_in_child=_restart_listener_after_fork)
+    atexit.register(_stop_listener)
+
+
+def _assign_request_id():
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if REQUEST_ID_PATTERN.fullmatch(request_id) else uuid.uuid4().hex[:16]
+
+
+def _send_request_id(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+
+def init_logging(app):
+    """Give every request an ID for its log records and send it back in X-Request-ID; call before the other init_*"""
+    app.before_request(_assign_request_id)
+    app.after_request(_send_request_id)
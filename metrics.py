@@ -0,0 +1,314 @@
+"""
+Per-route latency and SQL metrics exposed in Prometheus text format.
+
+Request timing comes from before_request/teardown_request hooks and SQL
+counts from SQLAlchemy cursor events, both attributed to the Flask endpoint
+of the current request. Each worker process keeps its own histograms and
+periodically writes a snapshot to ``instance/metrics/<pid>.json``; the
+``/metrics`` endpoint merges the snapshots of all live workers, so the
+numbers cover the whole gunicorn server whichever worker answers the scrape.
+When a recycled worker's snapshot is cleaned up, its numbers are added to
+``retired.json`` first, so the server's totals never go backwards (which
+Prometheus would take for a counter reset).
+"""
+import fcntl
+import hmac
+import json
+import os
+import threading
+import time
+
+from flask import Blueprint, Response, abort, current_app, g, has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 250, 1000)
+QUANTILES = (0.5, 0.95, 0.99)
+
+HELP = {
+    'http_requests_total': ('counter', 'Requests handled, by endpoint, method and status'),
+    'http_request_duration_seconds': ('histogram', 'Request latency by endpoint'),
+    'http_request_duration_quantile_seconds': ('gauge', 'Latency quantiles estimated from the histogram buckets'),
+    'http_request_sql_queries': ('histogram', 'SQL statements issued per request by endpoint'),
+    'http_request_sql_duration_seconds': ('histogram', 'Time spent in SQL per request by endpoint'),
+    'login_attempts_total': ('counter', 'Login attempts by result (success, failure, throttled)'),
+    'login_throttled_total': ('counter', 'Login attempts refused by the throttle, by the bucket that was empty'),
+    'password_rehashes_total': ('counter', 'Stored password hashes upgraded to the configured method at login'),
+}
+
+metrics_bp = Blueprint('metrics', __name__)
+
+
+class MetricsRegistry:
+    """Thread-safe counters and cumulative histograms keyed by (name, labels)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {'buckets': list(buckets), 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(hist['buckets']):
+                if value <= bound:
+                    hist['counts'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), dict(hist, counts=list(hist['counts']))]
+                               for (name, labels), hist in self.histograms.items()],
+            }
+
+
+registry = MetricsRegistry()
+# Totals of workers that have exited, kept next to the live snapshots
+RETIRED_SNAPSHOT = 'retired.json'
+_last_flush = 0.0
+
+
+def merge_snapshots(snapshots):
+    counters = {}
+    histograms = {}
+    for snap in snapshots:
+        for name, labels, value in snap.get('counters', []):
+            key = (name, tuple(tuple(item) for item in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, hist in snap.get('histograms', []):
+            key = (name, tuple(tuple(item) for item in labels))
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = dict(hist, counts=list(hist['counts']))
+            else:
+                merged['counts'] = [a + b for a, b in zip(merged['counts'], hist['counts'])]
+                merged['sum'] += hist['sum']
+                merged['count'] += hist['count']
+    return counters, histograms
+
+
+def estimate_quantile(hist, q):
+    """Linear interpolation inside the bucket holding the quantile, like histogram_quantile()"""
+    if not hist['count']:
+        return 0.0
+    rank = q * hist['count']
+    lower_bound, lower_count = 0.0, 0
+    for bound, count in zip(hist['buckets'], hist['counts']):
+        if count >= rank:
+            if count == lower_count:
+                return bound
+            return lower_bound + (bound - lower_bound) * (rank - lower_count) / (count - lower_count)
+        lower_bound, lower_count = bound, count
+    return hist['buckets'][-1]
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    escaped = [f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in items]
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_prometheus(counters, histograms):
+    lines = []
+    by_name = {}
+    for (name, labels), value in counters.items():
+        by_name.setdefault(name, []).append(('counter', labels, value))
+    for (name, labels), hist in histograms.items():
+        by_name.setdefault(name, []).append(('histogram', labels, hist))
+
+    for name in sorted(by_name):
+        kind, help_text = HELP.get(name, ('untyped', name))
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for _, labels, value in sorted(by_name[name], key=lambda item: item[1]):
+            if kind == 'histogram':
+                for bound, count in zip(value['buckets'], value['counts']):
+                    lines.append(f'{name}_bucket{_format_labels(labels, [("le", bound)])} {count}')
+                lines.append(f'{name}_bucket{_format_labels(labels, [("le", "+Inf")])} {value["count"]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {value["sum"]:.6f}')
+                lines.append(f'{name}_count{_format_labels(labels)} {value["count"]}')
+            else:
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+
+    quantile_name = 'http_request_duration_quantile_seconds'
+    latency = sorted((labels, hist) for (name, labels), hist in histograms.items()
+                     if name == 'http_request_duration_seconds')
+    if latency:
+        kind, help_text = HELP[quantile_name]
+        lines.append(f'# HELP {quantile_name} {help_text}')
+        lines.append(f'# TYPE {quantile_name} {kind}')
+        for labels, hist in latency:
+            for q in QUANTILES:
+                lines.append(f'{quantile_name}{_format_labels(labels, [("quantile", q)])} {estimate_quantile(hist, q):.6f}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def _metrics_dir():
+    path = os.path.join(current_app.instance_path, 'metrics')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def flush_snapshot(force=False):
+    """Write this process's metrics for /metrics in other workers to merge"""
+    global _last_flush
+    now = time.monotonic()
+    if not force and now - _last_flush < current_app.config.get('METRICS_FLUSH_SECONDS', 5):
+        return
+    _last_flush = now
+    path = os.path.join(_metrics_dir(), f'{os.getpid()}.json')
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp_path, path)
+
+
+def pid_alive(pid):
+    """Whether a process (e.g. a gunicorn worker that wrote a snapshot) still exists"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _load_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _retire_snapshot(metrics_dir, path):
+    """Fold a dead worker's snapshot into retired.json and remove it (under the collect lock)"""
+    dead = _load_snapshot(path)
+    if dead is not None:
+        retired_path = os.path.join(metrics_dir, RETIRED_SNAPSHOT)
+        counters, histograms = merge_snapshots([_load_snapshot(retired_path) or {}, dead])
+        retired = {
+            'counters': [[name, [list(item) for item in labels], value] for (name, labels), value in counters.items()],
+            'histograms': [[name, [list(item) for item in labels], hist] for (name, labels), hist in histograms.items()],
+        }
+        tmp_path = f'{retired_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(retired, f)
+        os.replace(tmp_path, retired_path)
+    os.remove(path)
+
+
+def collect_snapshots():
+    snapshots = []
+    metrics_dir = _metrics_dir()
+    with open(os.path.join(metrics_dir, 'collect.lock'), 'w') as lock_file:
+        # One scrape at a time, so a snapshot being retired is counted exactly once
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        for filename in os.listdir(metrics_dir):
+            pid = int(filename[:-5]) if filename.endswith('.json') and filename[:-5].isdigit() else None
+            if pid is not None and pid != os.getpid() and not pid_alive(pid):
+                _retire_snapshot(metrics_dir, os.path.join(metrics_dir, filename))
+        for filename in os.listdir(metrics_dir):
+            if not filename.endswith('.json'):
+                continue
+            snapshot = _load_snapshot(os.path.join(metrics_dir, filename))
+            if snapshot is not None:
+                snapshots.append(snapshot)
+    return snapshots
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get('query_start_time')
+    if not start_times:
+        return
+    elapsed = time.perf_counter() - start_times.pop()
+    if has_request_context() and '_metrics_start' in g:
+        g._metrics_sql_count += 1
+        g._metrics_sql_time += elapsed
+
+
+def _before_request():
+    g._metrics_start = time.perf_counter()
+    g._metrics_sql_count = 0
+    g._metrics_sql_time = 0.0
+
+
+def _after_request(response):
+    g._metrics_status = response.status_code
+    return response
+
+
+def _teardown_request(exc):
+    start = g.pop('_metrics_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or 'unmatched'
+    if endpoint in current_app.config.get('METRICS_SKIP_ENDPOINTS', ()):
+        return
+    status = g.get('_metrics_status', 500 if exc else 200)
+    labels = {'endpoint': endpoint, 'method': request.method}
+
+    registry.inc('http_requests_total', dict(labels, status=str(status)))
+    registry.observe('http_request_duration_seconds', labels, elapsed, LATENCY_BUCKETS)
+    registry.observe('http_request_sql_queries', labels, g.get('_metrics_sql_count', 0), QUERY_COUNT_BUCKETS)
+    registry.observe('http_request_sql_duration_seconds', labels, g.get('_metrics_sql_time', 0.0), LATENCY_BUCKETS)
+
+    try:
+        flush_snapshot()
+    except OSError:
+        pass
+
+
+def init_metrics(app):
+    """Install the request hooks and SQL listeners when METRICS_ENABLED is set"""
+    if not app.config.get('METRICS_ENABLED', True):
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _metrics_allowed():
+    if request.remote_addr in current_app.config.get('METRICS_ALLOWED_IPS', ()):
+        return True
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return True
+    return current_user.is_authenticated and current_user.role == 'admin'
+
+
+@metrics_bp.route('/metrics')
+def metrics():
+    if not current_app.config.get('METRICS_ENABLED', True):
+        abort(404)
+    if not _metrics_allowed():
+        abort(403)
+
+    flush_snapshot(force=True)
+    counters, histograms = merge_snapshots(collect_snapshots())
+    return Response(render_prometheus(counters, histograms), mimetype='text/plain; version=0.0.4')
@@ -1,7 +1,48 @@
 from app import db
 from flask_login import UserMixin
 from datetime import datetime
-from sqlalchemy import func
+from sqlalchemy import func, select, update
+from sqlalchemy.orm import declared_attr
+
+# Shop of the rows that predate shops, and of new rows created outside a request or job
+DEFAULT_SHOP_ID = 1
+
+def _default_shop_id():
+    from shops import current_shop_id
+    return current_shop_id() or DEFAULT_SHOP_ID
+
+class ShopScoped:
+    """Rows of one shop; ORM queries in a request or job only see the current shop's (shops.py)"""
+    
+    @declared_attr
+    def shop_id(cls):
+        return db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=False, default=_default_shop_id)
+
+class Shop(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    code = db.Column(db.String(20), unique=True, nullable=False)  # short name, e.g. MAIN
+    name = db.Column(db.String(100), nullable=False)  # printed on receipts and bills
+    battery_id_prefix = db.Column(db.String(10), unique=True, nullable=False)  # unique, so battery IDs are too
+    battery_id_start = db.Column(db.Integer, nullable=False, default=1)
+    battery_id_padding = db.Column(db.Integer, nullable=False, default=4)
+    last_battery_number = db.Column(db.Integer, nullable=False, default=0)  # battery ID counter
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def format_battery_id(self, number):
+        return f"{self.battery_id_prefix}{number:0{self.battery_id_padding}d}"
+    
+    def reserve_battery_numbers(self, count=1):
+        """Take the next ``count`` battery numbers of this shop and return the first.
+        
+        The counter row stays locked until the caller's transaction ends, so
+        concurrent intakes at one shop never get the same number.
+        """
+        table = Shop.__table__
+        db.session.execute(update(table).where(table.c.id == self.id)
+                           .values(last_battery_number=table.c.last_battery_number + count))
+        last = db.session.execute(select(table.c.last_battery_number).where(table.c.id == self.id)).scalar()
+        return last - count + 1
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -11,18 +52,32 @@ class User(UserMixin, db.Model):
     full_name = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     active = db.Column(db.Boolean, default=True)
+    modified_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    shop_id = db.Column(db.Integer, db.ForeignKey('shop.id'), nullable=True)  # None for head office: every shop
+    
+    shop = db.relationship('Shop')
 
-class Customer(db.Model):
+class Customer(ShopScoped, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    mobile = db.Column(db.String(15), nullable=False)
+    mobile = db.Column(db.String(15), nullable=False)  # normalised digits, see customers.normalize_mobile
     mobile_secondary = db.Column(db.String(15), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    modified_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Relationship with batteries
     batteries = db.relationship('Battery', backref='customer', lazy=True)
 
-class Battery(db.Model):
+# Mobiles are stored normalised and unique within a shop (customers.upsert_customer)
+db.Index('uq_customer_shop_mobile', Customer.shop_id, Customer.mobile, unique=True)
+# Prefix indexes for intake autocomplete (customers.autocomplete_customers), on Postgres only: on SQLite
+# GLOB already uses uq_customer_shop_mobile for mobiles, and cannot use an index on lower(name)
+db.Index('ix_customer_shop_mobile_prefix', Customer.shop_id, Customer.mobile,
+         postgresql_ops={'mobile': 'text_pattern_ops'}).ddl_if(dialect='postgresql')
+db.Index('ix_customer_shop_name_prefix', Customer.shop_id, func.lower(Customer.name).label('name_lower'),
+         postgresql_ops={'name_lower': 'text_pattern_ops'}).ddl_if(dialect='postgresql')
+
+class Battery(ShopScoped, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     battery_id = db.Column(db.String(20), unique=True, nullable=False)  # BAT0001, BAT0002, etc.
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
@@ -34,45 +89,53 @@ class Battery(db.Model):
     service_price = db.Column(db.Float, default=0.0)
     pickup_charge = db.Column(db.Float, default=0.0)  # Extra charge for pickup service
     is_pickup = db.Column(db.Boolean, default=False)  # Whether battery was picked up by employees
+    modified_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # Bumped by every ORM update, which only applies while it still matches (see transitions.py)
+    version = db.Column(db.Integer, nullable=False, default=1)
     
     # Relationship with status history and staff notes
     status_history = db.relationship('BatteryStatusHistory', backref='battery', lazy=True, cascade='all, delete-orphan')
     staff_notes = db.relationship('BatteryStaffNote', backref='battery', lazy=True, cascade='all, delete-orphan')
     
+    __table_args__ = (
+        # Used by archival (across shops) to find closed batteries past the cutoff
+        db.Index('ix_battery_status_inward_date', 'status', 'inward_date'),
+        # Status filters and the lists ordered by intake date, within a shop
+        db.Index('ix_battery_shop_status_inward_date', 'shop_id', 'status', 'inward_date'),
+        db.Index('ix_battery_shop_inward_date', 'shop_id', 'inward_date'),
+    )
+    __mapper_args__ = {'version_id_col': version}
+    
+    is_archived = False
+    
     @staticmethod
-    def generate_next_battery_id():
-        """Generate the next sequential battery ID using system settings"""
-        from app import db
-        
-        prefix = SystemSettings.get_setting('battery_id_prefix', 'BAT')
-        start_num = int(SystemSettings.get_setting('battery_id_start', '1'))
-        padding = int(SystemSettings.get_setting('battery_id_padding', '4'))
-        
-        last_battery = Battery.query.order_by(Battery.id.desc()).first()
-        if last_battery:
-            # Extract number from last battery ID (e.g., BAT0001 -> 1)
-            try:
-                last_num = int(last_battery.battery_id[len(prefix):])
-                next_num = last_num + 1
-            except (ValueError, IndexError):
-                next_num = start_num
-        else:
-            next_num = start_num
-        
-        return f"{prefix}{next_num:0{padding}d}"
+    def generate_next_battery_id(shop_id=None):
+        """Take the next sequential battery ID of the shop (the current one by default)"""
+        shop = db.session.get(Shop, shop_id or _default_shop_id())
+        return shop.format_battery_id(shop.reserve_battery_numbers())
 
-class BatteryStatusHistory(db.Model):
+class BatteryStatusHistory(ShopScoped, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     battery_id = db.Column(db.Integer, db.ForeignKey('battery.id'), nullable=False)
     status = db.Column(db.String(20), nullable=False)
     comments = db.Column(db.Text)
     updated_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # when the status was set
+    modified_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)  # last change to the row
+    write_key = db.Column(db.String(32))  # the intake or status update that made it (see write_queue.py)
     
     # Relationship
     user = db.relationship('User', backref='status_updates')
+    
+    # Window functions over each battery's history, and the day ranges analytics.py refreshes
+    __table_args__ = (
+        db.Index('ix_battery_status_history_battery_updated', 'battery_id', 'updated_at'),
+        db.Index('ix_battery_status_history_updated_at', 'updated_at'),
+        db.Index('ix_battery_status_history_shop_updated_at', 'shop_id', 'updated_at'),
+        db.Index('uq_battery_status_history_write_key', 'write_key', unique=True),
+    )
 
-class BatteryStaffNote(db.Model):
+class BatteryStaffNote(ShopScoped, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     battery_id = db.Column(db.Integer, db.ForeignKey('battery.id'), nullable=False)
     note = db.Column(db.Text, nullable=False)
@@ -80,9 +143,15 @@ class BatteryStaffNote(db.Model):
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_resolved = db.Column(db.Boolean, default=False)
+    modified_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    write_key = db.Column(db.String(32))  # the note write that made it (see write_queue.py)
     
     # Relationship
     user = db.relationship('User', backref='staff_notes')
+    
+    __table_args__ = (
+        db.Index('uq_battery_staff_note_write_key', 'write_key', unique=True),
+    )
 
 class SystemSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -108,3 +177,109 @@ class SystemSettings(db.Model):
             from app import db
             db.session.add(setting)
         return setting
+
+class Job(db.Model):
+    id = db.Column(db.String(32), primary_key=True)  # uuid4 hex
+    kind = db.Column(db.String(50), nullable=False)  # export_csv, backup, restore, yearly_report
+    status = db.Column(db.String(20), default='queued', nullable=False)  # queued, running, finished, failed
+    progress = db.Column(db.Integer, default=0)  # 0-100
+    message = db.Column(db.String(255))
+    params = db.Column(db.Text)  # JSON encoded handler arguments
+    result_path = db.Column(db.String(255))  # file under instance/jobs
+    result_name = db.Column(db.String(255))  # download filename
+    result_mimetype = db.Column(db.String(100))
+    created_by = db.Column(db.Integer, nullable=False)  # user id; not a FK so restore can replace users
+    shop_id = db.Column(db.Integer)  # shop the job runs in; None for all shops (backups, restore)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    expires_at = db.Column(db.DateTime)
+
+# Rows deleted from the tables incremental backups track (backups.py)
+class DeletedRow(db.Model):
+    __tablename__ = 'deleted_row'
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+# Archive tables: closed batteries moved out of the hot tables by archive.py.
+# Columns mirror Battery, BatteryStatusHistory and BatteryStaffNote and rows keep their ids.
+class ArchivedBattery(ShopScoped, db.Model):
+    __tablename__ = 'battery_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    battery_id = db.Column(db.String(20), unique=True, nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False, index=True)
+    battery_type = db.Column(db.String(100), nullable=False)
+    voltage = db.Column(db.String(10), nullable=False)
+    capacity = db.Column(db.String(10), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    inward_date = db.Column(db.DateTime, index=True)
+    service_price = db.Column(db.Float, default=0.0)
+    pickup_charge = db.Column(db.Float, default=0.0)
+    is_pickup = db.Column(db.Boolean, default=False)
+    modified_at = db.Column(db.DateTime, index=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (db.Index('ix_battery_archive_shop_inward_date', 'shop_id', 'inward_date'),)
+    
+    customer = db.relationship('Customer')
+    status_history = db.relationship('ArchivedBatteryStatusHistory', lazy=True, order_by='ArchivedBatteryStatusHistory.id')
+    staff_notes = db.relationship('ArchivedBatteryStaffNote', lazy=True)
+    
+    is_archived = True
+
+class ArchivedBatteryStatusHistory(ShopScoped, db.Model):
+    __tablename__ = 'battery_status_history_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    battery_id = db.Column(db.Integer, db.ForeignKey('battery_archive.id'), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False)
+    comments = db.Column(db.Text)
+    updated_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    updated_at = db.Column(db.DateTime, index=True)
+    modified_at = db.Column(db.DateTime, index=True)
+    write_key = db.Column(db.String(32))
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    user = db.relationship('User')
+
+class ArchivedBatteryStaffNote(ShopScoped, db.Model):
+    __tablename__ = 'battery_staff_note_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    battery_id = db.Column(db.Integer, db.ForeignKey('battery_archive.id'), nullable=False, index=True)
+    note = db.Column(db.Text, nullable=False)
+    note_type = db.Column(db.String(50))
+    created_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime)
+    is_resolved = db.Column(db.Boolean, default=False)
+    modified_at = db.Column(db.DateTime, index=True)
+    write_key = db.Column(db.String(32))
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    user = db.relationship('User')
+
+# Daily summaries materialised from the status history by analytics.py
+class TurnaroundDaily(ShopScoped, db.Model):
+    __tablename__ = 'turnaround_daily'
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)  # day the measured interval ended
+    metric = db.Column(db.String(40), nullable=False)  # intake_to_ready, ready_to_delivered, in:<status>
+    bucket = db.Column(db.Integer, nullable=False)  # index into analytics.BUCKET_HOURS
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total_hours = db.Column(db.Float, nullable=False, default=0.0)
+    
+    __table_args__ = (db.UniqueConstraint('shop_id', 'day', 'metric', 'bucket', name='uq_turnaround_daily'),)
+
+class TechnicianDaily(ShopScoped, db.Model):
+    __tablename__ = 'technician_daily'
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)  # not a FK so restore can replace users
+    updates = db.Column(db.Integer, nullable=False, default=0)  # status changes recorded
+    ready = db.Column(db.Integer, nullable=False, default=0)
+    not_repairable = db.Column(db.Integer, nullable=False, default=0)
+    delivered = db.Column(db.Integer, nullable=False, default=0)  # delivered or returned
+    repair_hours = db.Column(db.Float, nullable=False, default=0.0)  # previous status to Ready, summed
+    
+    __table_args__ = (db.UniqueConstraint('shop_id', 'day', 'user_id', name='uq_technician_daily'),)
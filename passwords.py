@@ -0,0 +1,184 @@
+"""
+Password hashing and login throttling.
+
+Checking a password costs tens of milliseconds of CPU by design, so
+``auth.login`` takes a token from two buckets before it hashes anything: one
+per username (LOGIN_USER_BURST attempts, then one more every
+LOGIN_USER_REFILL_SECONDS) and one per client address (LOGIN_IP_BURST, one
+more every LOGIN_IP_REFILL_SECONDS). An attempt either bucket has no token
+for is refused at once with a 429, without touching the database or hashing.
+The buckets live in a small SQLite file in WAL mode (LOGIN_THROTTLE_PATH,
+shared by the workers on this server); a successful login refills the
+username's bucket.
+
+Usernames that don't exist are checked against a dummy hash made with the
+same method, so a wrong username takes as long as a wrong password.
+
+New hashes use PASSWORD_HASH_METHOD (any method werkzeug accepts, e.g.
+``scrypt:32768:8:1`` or ``pbkdf2:sha256:600000``). A stored hash made with a
+different method or cost still works, and is replaced with one at the
+configured cost the next time its user logs in.
+
+The address is ``request.remote_addr``: the connecting peer's with the
+default PROXY_HOPS=0, or the one ProxyFix takes from X-Forwarded-For when
+PROXY_HOPS names the trusted proxies in front of the app (app.py). It must
+equal their number: set higher, clients pick their own bucket with the
+header; set lower, they all share the proxy's.
+"""
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, has_app_context
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from app import db
+from metrics import registry
+
+logger = logging.getLogger('passwords')
+
+DEFAULT_METHOD = 'scrypt'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bucket (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Seconds between sweeps of buckets that have filled up again
+PRUNE_SECONDS = 600
+
+# method -> a hash of a random password, for checking unknown usernames against
+_dummy_hashes = {}
+_local = threading.local()
+_last_prune = 0.0
+
+
+def _method():
+    if has_app_context():
+        return current_app.config.get('PASSWORD_HASH_METHOD') or DEFAULT_METHOD
+    return DEFAULT_METHOD
+
+
+def hash_password(password):
+    """Hash a password at the configured cost"""
+    return generate_password_hash(password, method=_method())
+
+
+def _dummy_hash(method):
+    if method not in _dummy_hashes:
+        _dummy_hashes[method] = generate_password_hash(os.urandom(16).hex(), method=method)
+    return _dummy_hashes[method]
+
+
+def needs_rehash(password_hash):
+    """Whether a stored hash was made with another method or cost than the configured one"""
+    # werkzeug spells out the defaults in the hash (scrypt -> scrypt:32768:8:1), so compare with one it made
+    return password_hash.split('$', 1)[0] != _dummy_hash(_method()).split('$', 1)[0]
+
+
+def check_password(user, password):
+    """Whether ``password`` is ``user``'s (False for no user, after as much work); upgrades the hash if due"""
+    if user is None or not user.password_hash:
+        check_password_hash(_dummy_hash(_method()), password)
+        return False
+    if not check_password_hash(user.password_hash, password):
+        return False
+    if needs_rehash(user.password_hash):
+        user.password_hash = hash_password(password)
+        db.session.commit()
+        registry.inc('password_rehashes_total', {})
+        logger.info(f'Rehashed the password of {user.username} with {_method()}')
+    return True
+
+
+def _connect():
+    path = current_app.config.get('LOGIN_THROTTLE_PATH') or os.path.join(current_app.instance_path,
+                                                                         'login_throttle.sqlite')
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=2, isolation_level=None)
+        # A lost bucket update only means an attempt more, so no fsync per login
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.executescript(SCHEMA)
+        _local.conn, _local.path = conn, path
+    return conn
+
+
+def _buckets(username, address):
+    config = current_app.config
+    # Keyed case-insensitively so User, USER and user share one bucket
+    return [
+        ('user', f'user:{username.strip().lower()[:150]}',
+         config.get('LOGIN_USER_BURST', 5), config.get('LOGIN_USER_REFILL_SECONDS', 60)),
+        ('ip', f'ip:{address}', config.get('LOGIN_IP_BURST', 20), config.get('LOGIN_IP_REFILL_SECONDS', 6)),
+    ]
+
+
+def _prune(conn, now):
+    global _last_prune
+    if now - _last_prune < PRUNE_SECONDS:
+        return
+    _last_prune = now
+    longest = max(burst * refill for _, _, burst, refill in _buckets('', ''))
+    conn.execute('DELETE FROM bucket WHERE updated_at < ?', (now - longest,))
+
+
+def take_attempt(username, address):
+    """Take a login attempt from the username's and the address's buckets.
+
+    Returns 0 when the attempt may go ahead, else the seconds until it could.
+    Refused attempts take nothing, so they don't push that time back further.
+    """
+    if not current_app.config.get('LOGIN_THROTTLE_ENABLED', True):
+        return 0
+    buckets = _buckets(username, address or 'unknown')
+    now = time.time()
+    try:
+        conn = _connect()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            levels = []
+            wait = 0
+            for scope, key, burst, refill in buckets:
+                row = conn.execute('SELECT tokens, updated_at FROM bucket WHERE key = ?', (key,)).fetchone()
+                tokens = burst if row is None else min(burst, row[0] + (now - row[1]) / refill)
+                if tokens < 1:
+                    wait = max(wait, math.ceil((1 - tokens) * refill))
+                    registry.inc('login_throttled_total', {'scope': scope})
+                levels.append((key, tokens))
+            if not wait:
+                conn.executemany('INSERT OR REPLACE INTO bucket (key, tokens, updated_at) VALUES (?, ?, ?)',
+                                 [(key, tokens - 1, now) for key, tokens in levels])
+            _prune(conn, now)
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+    except sqlite3.Error as e:
+        # Not worth locking everyone out over
+        logger.warning(f'Login throttle unavailable, allowing the attempt: {e}')
+        return 0
+    return wait
+
+
+def reset_attempts(username):
+    """Refill the username's bucket after it logged in"""
+    if not current_app.config.get('LOGIN_THROTTLE_ENABLED', True):
+        return
+    try:
+        _connect().execute('DELETE FROM bucket WHERE key = ?', (_buckets(username, '')[0][1],))
+    except sqlite3.Error as e:
+        logger.warning(f'Could not reset the login throttle for {username}: {e}')
+
+
+def init_passwords(app):
+    """Make the dummy hash at boot, so the first unknown username isn't the one that pays for it"""
+    _dummy_hash(app.config.get('PASSWORD_HASH_METHOD') or DEFAULT_METHOD)
@@ -0,0 +1,174 @@
+"""
+On-demand per-request profiler.
+
+When PROFILING_ENABLED is set, an admin can profile a single request by
+adding ``?_profile=1`` to the URL or sending an ``X-Profile: 1`` header, and
+PROFILE_SAMPLE_RATE profiles that fraction of all requests. A profiled
+request runs under cProfile with its SQL statements recorded alongside; the
+``.pstats`` file, a top-N text summary and a small JSON description are
+saved under ``instance/profiles``. With PROFILING_ENABLED off no hooks or
+listeners are installed at all.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from flask import current_app, g, has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+# cProfile cannot run in two threads at once on newer Pythons, so profile one request at a time
+_profile_lock = threading.Lock()
+
+
+def get_profiles_dir():
+    path = os.path.join(current_app.instance_path, 'profiles')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _requested_by_admin():
+    if request.args.get('_profile') != '1' and request.headers.get('X-Profile') != '1':
+        return False
+    return current_user.is_authenticated and current_user.role == 'admin'
+
+
+def _before_request():
+    if request.endpoint == 'static':
+        return
+    if _requested_by_admin():
+        trigger = 'admin'
+    elif random.random() < current_app.config.get('PROFILE_SAMPLE_RATE', 0.0):
+        trigger = 'sampled'
+    else:
+        return
+
+    if not _profile_lock.acquire(blocking=False):
+        return
+    g._profile = {
+        'profiler': cProfile.Profile(),
+        'trigger': trigger,
+        'sql': [],
+        'start': time.perf_counter(),
+    }
+    g._profile['profiler'].enable()
+
+
+def _teardown_request(exc):
+    state = g.pop('_profile', None)
+    if state is None:
+        return
+    try:
+        state['profiler'].disable()
+        _save_profile(state, time.perf_counter() - state['start'])
+    finally:
+        _profile_lock.release()
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and '_profile' in g:
+        conn.info.setdefault('profile_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if not (has_request_context() and '_profile' in g):
+        return
+    start_times = conn.info.get('profile_query_start')
+    if not start_times:
+        return
+    g._profile['sql'].append({
+        'statement': statement,
+        'duration_ms': round((time.perf_counter() - start_times.pop()) * 1000, 2),
+    })
+
+
+def _save_profile(state, elapsed):
+    profiles_dir = get_profiles_dir()
+    endpoint = request.endpoint or 'unmatched'
+    name = f"{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}_{endpoint.replace('.', '-')}_{uuid.uuid4().hex[:6]}"
+    top_n = current_app.config.get('PROFILE_TOP_N', 40)
+
+    state['profiler'].dump_stats(os.path.join(profiles_dir, f'{name}.pstats'))
+
+    summary = io.StringIO()
+    summary.write(f'{request.method} {request.full_path.rstrip("?")}  ({elapsed * 1000:.1f} ms)\n\n')
+    stats = pstats.Stats(state['profiler'], stream=summary)
+    stats.strip_dirs().sort_stats('cumulative').print_stats(top_n)
+    summary.write(f'\nSQL statements ({len(state["sql"])}, '
+                  f'{sum(q["duration_ms"] for q in state["sql"]):.1f} ms):\n')
+    for query in state['sql']:
+        summary.write(f'\n[{query["duration_ms"]} ms]\n{query["statement"]}\n')
+    with open(os.path.join(profiles_dir, f'{name}.txt'), 'w', encoding='utf-8') as f:
+        f.write(summary.getvalue())
+
+    meta = {
+        'name': name,
+        'recorded_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'endpoint': endpoint,
+        'method': request.method,
+        'path': request.path,
+        'user': current_user.username if current_user.is_authenticated else None,
+        'trigger': state['trigger'],
+        'duration_ms': round(elapsed * 1000, 1),
+        'sql_count': len(state['sql']),
+        'sql_ms': round(sum(q['duration_ms'] for q in state['sql']), 1),
+    }
+    with open(os.path.join(profiles_dir, f'{name}.json'), 'w') as f:
+        json.dump(meta, f)
+
+    _prune_profiles(profiles_dir, current_app.config.get('PROFILE_KEEP', 100))
+
+
+def _prune_profiles(profiles_dir, keep):
+    names = sorted(filename[:-5] for filename in os.listdir(profiles_dir) if filename.endswith('.json'))
+    for name in names[:-keep] if keep else []:
+        for ext in ('.json', '.txt', '.pstats'):
+            path = os.path.join(profiles_dir, name + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def list_profiles():
+    """Saved profiles, newest first"""
+    profiles = []
+    profiles_dir = get_profiles_dir()
+    for filename in os.listdir(profiles_dir):
+        if not filename.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(profiles_dir, filename)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    profiles.sort(key=lambda meta: meta['name'], reverse=True)
+    return profiles
+
+
+def get_profile_file(name, ext):
+    """Path of a saved profile file, or None if the name is invalid or missing"""
+    if not PROFILE_NAME_RE.match(name) or ext not in ('.txt', '.pstats', '.json'):
+        return None
+    path = os.path.join(get_profiles_dir(), name + ext)
+    return path if os.path.exists(path) else None
+
+
+def init_profiler(app):
+    """Install the profiling hooks only when PROFILING_ENABLED is set"""
+    if not app.config.get('PROFILING_ENABLED', False):
+        return
+    app.before_request(_before_request)
+    app.teardown_request(_teardown_request)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
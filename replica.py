@@ -0,0 +1,178 @@
+"""
+Optional read replica for heavy read-only routes and jobs.
+
+When DATABASE_REPLICA_URL is set, the replica is configured as the
+``replica`` bind and views decorated with ``@read_only`` (or code running
+inside ``use_replica()``) send their queries to it. Flushes always go to the
+primary. The replica is skipped, and the primary used instead, when:
+
+- it failed a health check or a connection within the last
+  REPLICA_CHECK_SECONDS,
+- it is replaying WAL more than REPLICA_MAX_LAG_SECONDS behind (Postgres), or
+- the browser session wrote something in the last REPLICA_STICKY_SECONDS, so
+  a user always sees their own changes.
+
+Without DATABASE_REPLICA_URL all of this is a no-op.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_app_context, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, text
+
+logger = logging.getLogger('replica')
+
+REPLICA_BIND = 'replica'
+
+# Tables written by the app itself rather than by the user
+INTERNAL_TABLES = {'job'}
+
+# Seconds the replica is behind the primary; 0 when it has replayed everything it received
+LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+_health = {'healthy': True, 'checked_at': 0.0, 'lag': None}
+# Reentrant: a failed health-check connection also reports itself through _handle_error
+_health_lock = threading.RLock()
+
+
+class RoutingSession(Session):
+    """Sends reads to the replica while ``g._db_replica`` is set"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get('_db_replica'):
+            engine = self._db.engines.get(REPLICA_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _get_replica_engine():
+    return current_app.extensions['sqlalchemy'].engines.get(REPLICA_BIND)
+
+
+def _replication_lag(conn):
+    if conn.dialect.name != 'postgresql':
+        # Nothing to measure for other databases (e.g. a second local SQLite file)
+        return None
+    return float(conn.execute(LAG_SQL).scalar() or 0)
+
+
+def _mark_down(reason):
+    with _health_lock:
+        was_healthy = _health['healthy']
+        _health.update(healthy=False, checked_at=time.monotonic())
+    if was_healthy:
+        logger.warning(f'Read replica unavailable ({reason}); using the primary')
+
+
+def replica_healthy():
+    """Whether the replica is reachable and within REPLICA_MAX_LAG_SECONDS, checked at most every REPLICA_CHECK_SECONDS"""
+    engine = _get_replica_engine()
+    if engine is None:
+        return False
+
+    interval = current_app.config.get('REPLICA_CHECK_SECONDS', 5)
+    if time.monotonic() - _health['checked_at'] < interval:
+        return _health['healthy']
+    # One thread re-checks; the others keep using the last result meanwhile
+    if not _health_lock.acquire(blocking=False):
+        return _health['healthy']
+    try:
+        _health['checked_at'] = time.monotonic()
+        try:
+            with engine.connect() as conn:
+                lag = _replication_lag(conn)
+        except Exception as e:
+            healthy, lag, reason = False, None, e
+        else:
+            max_lag = current_app.config.get('REPLICA_MAX_LAG_SECONDS', 10)
+            healthy = lag is None or lag <= max_lag
+            reason = f'{lag:.1f}s behind, limit {max_lag}s' if lag is not None else None
+        if healthy and not _health['healthy']:
+            logger.info('Read replica is available again')
+        elif not healthy and _health['healthy']:
+            logger.warning(f'Read replica unavailable ({reason}); using the primary')
+        _health.update(healthy=healthy, lag=lag)
+    finally:
+        _health_lock.release()
+    return healthy
+
+
+def wrote_recently():
+    """Whether the current browser session changed data within REPLICA_STICKY_SECONDS"""
+    if not has_request_context():
+        return False
+    wrote_at = session.get('_db_wrote_at')
+    return bool(wrote_at) and time.time() - wrote_at < current_app.config.get('REPLICA_STICKY_SECONDS', 15)
+
+
+@contextmanager
+def use_replica(primary_only=False):
+    """Route this app context's reads to the replica when it is safe to"""
+    previous = g.get('_db_replica', False)
+    g._db_replica = not primary_only and not wrote_recently() and replica_healthy()
+    try:
+        yield g._db_replica
+    finally:
+        g._db_replica = previous
+
+
+def read_only(view):
+    """Mark a view as read-only so its queries may be served by the replica"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with use_replica():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def _before_flush(db_session, flush_context, instances):
+    if not has_request_context():
+        return
+    for obj in list(db_session.new) + list(db_session.dirty) + list(db_session.deleted):
+        if getattr(obj, '__tablename__', None) not in INTERNAL_TABLES:
+            g._db_wrote = True
+            return
+
+
+def _after_request(response):
+    if g.pop('_db_wrote', False):
+        session['_db_wrote_at'] = time.time()
+    return response
+
+
+def _handle_error(context):
+    # A dropped or refused replica connection takes it out of rotation at once
+    if context.is_disconnect or context.connection is None:
+        _mark_down(context.original_exception)
+        if has_app_context() and g.get('_db_replica'):
+            g._db_replica_failed = True
+
+
+def replica_failed():
+    """Whether the replica failed during the current request, so a read can be retried on the primary"""
+    return has_app_context() and g.get('_db_replica_failed', False)
+
+
+def init_replica(app):
+    """Install the routing hooks when a replica bind is configured"""
+    if REPLICA_BIND not in app.config.get('SQLALCHEMY_BINDS', {}):
+        return
+    with app.app_context():
+        engine = _get_replica_engine()
+    if not event.contains(engine, 'handle_error', _handle_error):
+        event.listen(engine, 'handle_error', _handle_error)
+    if not event.contains(RoutingSession, 'before_flush', _before_flush):
+        event.listen(RoutingSession, 'before_flush', _before_flush)
+    app.after_request(_after_request)
+    logger.info(f'Read replica configured: {engine.url.render_as_string(hide_password=True)}')
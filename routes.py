@@ -1,15 +1,28 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, make_response, jsonify, send_file
+from flask import Blueprint, render_template, request, redirect, url_for, flash, make_response, jsonify, send_file, abort, current_app
 from flask_login import login_required, current_user
 from app import db
-from models import User, Customer, Battery, BatteryStatusHistory, SystemSettings, BatteryStaffNote
-from werkzeug.security import generate_password_hash
-from datetime import datetime
+from models import User, Customer, Battery, BatteryStatusHistory, BatteryStaffNote, Job, Shop
+from backups import get_watermark
+from jobs import submit_job, can_submit, get_jobs_dir, get_result_file, job_to_dict
+from slow_queries import get_recent_slow_queries, clear_slow_queries
+from profiler import list_profiles, get_profile_file
+from replica import read_only
+from archive import get_battery, get_hot_battery, search_archived, archived_status_counts
+from customers import autocomplete_customers, customer_to_dict, normalize_mobile, upsert_customer
+from analytics import ensure_fresh, last_refreshed, report_range, technician_throughput, turnaround_summary
+from shops import get_current_shop, prefix_error, select_shop
+from transitions import StatusConflict, change_status, commit_change, parse_version
+from write_queue import apply_or_queue, database_down, get_entry, list_entries, provisional_id, retry_entry, works_offline, write_handler
+from passwords import hash_password
+from datetime import datetime, timedelta
 from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
 import csv
 import io
 import json
 import tempfile
 import os
+import uuid
 
 main_bp = Blueprint('main', __name__)
 
@@ -29,6 +42,12 @@ def dashboard():
     delivered_batteries = Battery.query.filter(Battery.status.in_(['Delivered', 'Returned'])).count()
     not_repairable_batteries = Battery.query.filter_by(status='Not Repairable').count()
     
+    # Archived batteries are all closed; count them so the totals don't drop after archival
+    archived = archived_status_counts()
+    total_batteries += sum(archived.values())
+    delivered_batteries += archived.get('Delivered', 0) + archived.get('Returned', 0)
+    not_repairable_batteries += archived.get('Not Repairable', 0)
+    
     # Calculate revenue statistics including pickup charges
     service_revenue = db.session.query(func.sum(Battery.service_price)).filter_by(status='Ready').scalar() or 0
     pickup_revenue = db.session.query(func.sum(Battery.pickup_charge)).filter(
@@ -48,10 +67,56 @@ def dashboard():
                          not_repairable_batteries=not_repairable_batteries,
                          recent_batteries=recent_batteries,
                          total_revenue=float(total_revenue),
-                         avg_service_price=float(avg_service_price))
+                         service_revenue=float(service_revenue),
+                         pickup_revenue=float(pickup_revenue),
+                         avg_service_price=float(avg_service_price),
+                         today=datetime.utcnow().date().isoformat())
+
+def _queued_result(entry_id, message, fallback):
+    """202 for API clients, otherwise a flash and a redirect, for a write queued while the database is down"""
+    message = f'{message} {provisional_id(entry_id)} and will be entered as soon as the database is reachable again.'
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'message': message, 'queued': provisional_id(entry_id)}), 202
+    flash(message, 'warning')
+    return redirect(fallback)
+
+@write_handler('intake')
+def record_intake(user_id, customer_name, mobile, mobile_secondary, battery_type, voltage, capacity, is_pickup,
+                  pickup_charge, write_key=None):
+    # Find the customer by mobile or create them, in one statement so concurrent intakes can't duplicate
+    customer_id = upsert_customer(customer_name, mobile, mobile_secondary)
+    
+    # Generate battery ID
+    battery_id = Battery.generate_next_battery_id()
+    
+    # Create battery record
+    battery = Battery()
+    battery.battery_id = battery_id
+    battery.customer_id = customer_id
+    battery.battery_type = battery_type
+    battery.voltage = voltage
+    battery.capacity = capacity
+    battery.status = 'Received'
+    battery.is_pickup = is_pickup
+    battery.pickup_charge = pickup_charge
+    db.session.add(battery)
+    db.session.flush()  # Get battery record ID
+    
+    # Add initial status history
+    status_history = BatteryStatusHistory()
+    status_history.battery_id = battery.id
+    status_history.status = 'Received'
+    status_history.comments = f'Battery received from customer{" - Pickup service" if is_pickup else ""}'
+    status_history.updated_by = user_id
+    status_history.write_key = write_key
+    db.session.add(status_history)
+    
+    db.session.commit()
+    return battery
 
 @main_bp.route('/battery/entry', methods=['GET', 'POST'])
 @login_required
+@works_offline
 def battery_entry():
     if current_user.role not in ['shop_staff', 'admin']:
         flash('Access denied. This feature is only available to shop staff and admin.', 'error')
@@ -71,43 +136,20 @@ def battery_entry():
             flash('All fields are required.', 'error')
             return render_template('battery_entry.html')
         
+        if not normalize_mobile(mobile):
+            flash('Please enter a valid mobile number.', 'error')
+            return render_template('battery_entry.html')
+        
         try:
-            # Check if customer exists or create new one
-            customer = Customer.query.filter_by(mobile=mobile).first()
-            if not customer:
-                customer = Customer()
-                customer.name = customer_name
-                customer.mobile = mobile
-                customer.mobile_secondary = mobile_secondary
-                db.session.add(customer)
-                db.session.flush()  # Get customer ID
-            
-            # Generate battery ID
-            battery_id = Battery.generate_next_battery_id()
-            
-            # Create battery record
-            battery = Battery()
-            battery.battery_id = battery_id
-            battery.customer_id = customer.id
-            battery.battery_type = battery_type
-            battery.voltage = voltage
-            battery.capacity = capacity
-            battery.status = 'Received'
-            battery.is_pickup = is_pickup
-            battery.pickup_charge = pickup_charge
-            db.session.add(battery)
-            db.session.flush()  # Get battery record ID
-            
-            # Add initial status history
-            status_history = BatteryStatusHistory()
-            status_history.battery_id = battery.id
-            status_history.status = 'Received'
-            status_history.comments = f'Battery received from customer{" - Pickup service" if is_pickup else ""}'
-            status_history.updated_by = current_user.id
-            db.session.add(status_history)
-            
-            db.session.commit()
-            flash(f'Battery {battery_id} has been successfully registered.', 'success')
+            battery, queued = apply_or_queue('intake', current_user.id, {
+                'customer_name': customer_name, 'mobile': mobile, 'mobile_secondary': mobile_secondary,
+                'battery_type': battery_type, 'voltage': voltage, 'capacity': capacity,
+                'is_pickup': is_pickup, 'pickup_charge': pickup_charge
+            })
+            if queued:
+                return _queued_result(queued, 'The database is unreachable. The battery was saved as',
+                                      url_for('main.battery_entry'))
+            flash(f'Battery {battery.battery_id} has been successfully registered.', 'success')
             return redirect(url_for('main.receipt', battery_id=battery.id))
             
         except Exception as e:
@@ -116,6 +158,17 @@ def battery_entry():
     
     return render_template('battery_entry.html')
 
+@main_bp.route('/customers/autocomplete')
+@login_required
+def customer_autocomplete():
+    if current_user.role not in ['shop_staff', 'admin']:
+        return jsonify([]), 403
+    
+    term = request.args.get('q', '').strip()
+    if len(term) < 2:
+        return jsonify([])
+    return jsonify([customer_to_dict(customer) for customer in autocomplete_customers(term)])
+
 @main_bp.route('/technician/panel', methods=['GET', 'POST'])
 @login_required
 def technician_panel():
@@ -177,8 +230,30 @@ def technician_panel():
     
     return render_template('technician_panel.html', batteries=batteries, search_query=search_query, show_full_details=show_full_details)
 
+def _status_result(battery, message, category, fallback, conflict=False):
+    """JSON (409 on a conflict) for API clients, otherwise a flash and a redirect to ``fallback``"""
+    if request.accept_mimetypes.best == 'application/json':
+        data = {'message': message, 'id': battery.id, 'battery_id': battery.battery_id,
+                'status': battery.status, 'version': battery.version}
+        return jsonify(data), 409 if conflict else 200
+    flash(message, category)
+    return redirect(fallback)
+
+@write_handler('status')
+def record_status_update(user_id, battery_id, status, comments, service_price, version, write_key=None):
+    battery = Battery.query.get_or_404(battery_id)
+    history = change_status(battery, status, user_id, comments, version)
+    history.write_key = write_key
+    
+    if service_price:
+        battery.service_price = float(service_price)
+    
+    commit_change(battery)
+    return battery
+
 @main_bp.route('/battery/update', methods=['POST'])
 @login_required
+@works_offline
 def update_battery_status():
     if current_user.role not in ['technician', 'shop_staff', 'admin']:
         flash('Access denied.', 'error')
@@ -189,23 +264,22 @@ def update_battery_status():
     comments = request.form.get('comments', '')
     service_price = request.form.get('service_price', 0)
     
+    if not database_down():
+        Battery.query.get_or_404(battery_id)
     try:
-        battery = Battery.query.get_or_404(battery_id)
-        battery.status = new_status
-        
-        if service_price:
-            battery.service_price = float(service_price)
-        
-        # Add status history
-        status_history = BatteryStatusHistory()
-        status_history.battery_id = battery.id
-        status_history.status = new_status
-        status_history.comments = comments
-        status_history.updated_by = current_user.id
-        db.session.add(status_history)
-        db.session.commit()
-        
-        flash(f'Battery {battery.battery_id} status updated to {new_status}.', 'success')
+        battery, queued = apply_or_queue('status', current_user.id, {
+            'battery_id': battery_id, 'status': new_status, 'comments': comments, 'service_price': service_price,
+            'version': parse_version(request.form.get('version'))
+        })
+        if queued:
+            return _queued_result(queued, 'The database is unreachable. The status update was saved as',
+                                  url_for('main.technician_panel'))
+        return _status_result(battery, f'Battery {battery.battery_id} status updated to {new_status}.', 'success',
+                              url_for('main.technician_panel'))
+    except StatusConflict as e:
+        db.session.rollback()
+        return _status_result(Battery.query.get_or_404(battery_id), str(e), 'warning',
+                              url_for('main.technician_panel'), conflict=True)
     except Exception as e:
         db.session.rollback()
         flash(f'Error updating battery status: {str(e)}', 'error')
@@ -214,12 +288,15 @@ def update_battery_status():
 
 @main_bp.route('/search', methods=['GET', 'POST'])
 @login_required
+@read_only
 def search():
     results = []
     search_query = ''
+    include_archived = False
     
     if request.method == 'POST':
         search_query = request.form.get('search_query', '').strip()
+        include_archived = request.form.get('include_archived') == '1'
         
         if search_query:
             # Search by battery ID or customer mobile
@@ -231,16 +308,18 @@ def search():
                 )
             ).all()
             results = batteries
+            if include_archived:
+                results = results + search_archived(search_query)
     
-    return render_template('search.html', results=results, search_query=search_query)
+    return render_template('search.html', results=results, search_query=search_query, include_archived=include_archived)
 
 @main_bp.route('/receipt/<int:battery_id>')
 @login_required
 def receipt(battery_id):
-    battery = Battery.query.get_or_404(battery_id)
+    battery = get_battery(battery_id)
     
     def get_shop_name():
-        return SystemSettings.get_setting('shop_name', 'Battery Repair Service')
+        return get_current_shop().name
     
     return render_template('receipt.html', battery=battery, get_shop_name=get_shop_name)
 
@@ -253,50 +332,62 @@ def bill(battery_id):
         return redirect(url_for('main.search'))
     
     def get_shop_name():
-        return SystemSettings.get_setting('shop_name', 'Battery Repair Service')
+        return get_current_shop().name
     
     return render_template('bill.html', battery=battery, get_shop_name=get_shop_name)
 
+@main_bp.route('/print/<kind>')
+@login_required
+def print_batch(kind):
+    """Receipts or bills for many batteries as one print-paginated page.
+
+    Batteries are chosen by ``ids`` (comma separated, or repeated ``id``),
+    ``status`` and an intake date range (``date_from``/``date_to``,
+    YYYY-MM-DD); bills are only printed for Ready batteries. Everything is
+    loaded up front in a fixed number of queries, however many are printed.
+    """
+    if kind not in ('receipts', 'bills'):
+        abort(404)
+
+    ids = [part for value in request.args.getlist('ids') + request.args.getlist('id') for part in value.split(',')]
+    status = request.args.get('status', '').strip()
+    try:
+        ids = [int(part) for part in ids if part.strip()]
+        date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d') if request.args.get('date_from') else None
+        date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d') if request.args.get('date_to') else None
+    except ValueError:
+        flash('Invalid battery IDs or dates to print.', 'error')
+        return redirect(url_for('main.dashboard'))
+    if not (ids or status or date_from or date_to):
+        flash('Choose the batteries to print by ID, status or intake date.', 'error')
+        return redirect(url_for('main.dashboard'))
+
+    query = Battery.query.options(joinedload(Battery.customer))
+    if kind == 'bills':
+        query = query.options(selectinload(Battery.status_history).joinedload(BatteryStatusHistory.user))
+        query = query.filter(Battery.status == 'Ready')
+    if ids:
+        query = query.filter(Battery.id.in_(ids))
+    if status:
+        query = query.filter(Battery.status == status)
+    if date_from:
+        query = query.filter(Battery.inward_date >= date_from)
+    if date_to:
+        query = query.filter(Battery.inward_date < date_to + timedelta(days=1))
+
+    limit = current_app.config.get('PRINT_BATCH_LIMIT', 200)
+    batteries = query.order_by(Battery.inward_date, Battery.id).limit(limit + 1).all()
+    truncated = len(batteries) > limit
+
+    return render_template('print/batch.html', kind=kind, batteries=batteries[:limit], truncated=truncated,
+                           limit=limit, shop_name=get_current_shop().name)
+
 @main_bp.route('/export/csv')
 @login_required
 def export_csv():
     try:
-        batteries = Battery.query.join(Customer).all()
-        
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # Write header
-        writer.writerow([
-            'Battery ID', 'Customer Name', 'Mobile', 'Battery Type', 
-            'Voltage', 'Capacity', 'Status', 'Inward Date', 
-            'Service Price', 'Last Updated'
-        ])
-        
-        # Write data
-        for battery in batteries:
-            last_update = battery.status_history[-1].updated_at if battery.status_history else battery.inward_date
-            writer.writerow([
-                battery.battery_id,
-                battery.customer.name,
-                battery.customer.mobile,
-                battery.battery_type,
-                battery.voltage,
-                battery.capacity,
-                battery.status,
-                battery.inward_date.strftime('%Y-%m-%d %H:%M'),
-                battery.service_price,
-                last_update.strftime('%Y-%m-%d %H:%M')
-            ])
-        
-        output.seek(0)
-        
-        response = make_response(output.getvalue())
-        response.headers['Content-Disposition'] = f'attachment; filename=battery_records_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        response.headers['Content-type'] = 'text/csv'
-        
-        return response
-        
+        job = submit_job('export_csv', current_user.id)
+        return redirect(url_for('main.job_status', job_id=job.id))
     except Exception as e:
         flash(f'Error exporting data: {str(e)}', 'error')
         return redirect(url_for('main.dashboard'))
@@ -304,18 +395,33 @@ def export_csv():
 @main_bp.route('/battery/<int:battery_id>/details')
 @login_required
 def battery_details(battery_id):
-    battery = Battery.query.get_or_404(battery_id)
-    notes = BatteryStaffNote.query.filter_by(battery_id=battery.id).order_by(BatteryStaffNote.created_at.desc()).all()
+    battery = get_battery(battery_id)
+    notes = sorted(battery.staff_notes, key=lambda note: note.created_at, reverse=True)
     return render_template('battery_details.html', battery=battery, notes=notes)
 
+@write_handler('note')
+def record_staff_note(user_id, battery_id, note, note_type='followup', write_key=None):
+    battery = get_hot_battery(battery_id)
+    staff_note = BatteryStaffNote()
+    staff_note.battery_id = battery.id
+    staff_note.note = note
+    staff_note.note_type = note_type
+    staff_note.created_by = user_id
+    staff_note.write_key = write_key
+    db.session.add(staff_note)
+    db.session.commit()
+    return battery
+
 @main_bp.route('/battery/<int:battery_id>/add_note', methods=['POST'])
 @login_required
+@works_offline
 def add_staff_note(battery_id):
     if current_user.role not in ['shop_staff', 'admin']:
         flash('Access denied. Only staff and admin can add notes.', 'error')
         return redirect(url_for('main.dashboard'))
     
-    battery = Battery.query.get_or_404(battery_id)
+    if not database_down():
+        get_hot_battery(battery_id)
     note_text = request.form.get('note')
     note_type = request.form.get('note_type', 'followup')
     
@@ -324,13 +430,11 @@ def add_staff_note(battery_id):
         return redirect(url_for('main.battery_details', battery_id=battery_id))
     
     try:
-        note = BatteryStaffNote()
-        note.battery_id = battery.id
-        note.note = note_text
-        note.note_type = note_type
-        note.created_by = current_user.id
-        db.session.add(note)
-        db.session.commit()
+        _, queued = apply_or_queue('note', current_user.id,
+                                   {'battery_id': battery_id, 'note': note_text, 'note_type': note_type})
+        if queued:
+            return _queued_result(queued, 'The database is unreachable. The note was saved as',
+                                  url_for('main.battery_details', battery_id=battery_id))
         flash('Note added successfully.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -347,26 +451,19 @@ def mark_battery_delivered(battery_id):
     
     battery = Battery.query.get_or_404(battery_id)
     
-    if battery.status != 'Ready':
-        flash('Only batteries with Ready status can be marked as delivered.', 'error')
-        return redirect(url_for('main.search'))
-    
     delivery_type = request.form.get('delivery_type', 'delivered')  # delivered or returned
     comments = request.form.get('comments', '')
     
     try:
-        battery.status = 'Delivered' if delivery_type == 'delivered' else 'Returned'
-        
-        # Add status history
-        status_history = BatteryStatusHistory()
-        status_history.battery_id = battery.id
-        status_history.status = battery.status
-        status_history.comments = comments
-        status_history.updated_by = current_user.id
-        db.session.add(status_history)
-        db.session.commit()
-        
-        flash(f'Battery {battery.battery_id} marked as {battery.status.lower()}.', 'success')
+        status = 'Delivered' if delivery_type == 'delivered' else 'Returned'
+        change_status(battery, status, current_user.id, comments, parse_version(request.form.get('version')))
+        commit_change(battery)
+        return _status_result(battery, f'Battery {battery.battery_id} marked as {battery.status.lower()}.', 'success',
+                              url_for('main.search'))
+    except StatusConflict as e:
+        db.session.rollback()
+        return _status_result(battery, str(e), 'warning', url_for('main.battery_details', battery_id=battery_id),
+                              conflict=True)
     except Exception as e:
         db.session.rollback()
         flash(f'Error updating battery status: {str(e)}', 'error')
@@ -399,12 +496,14 @@ def not_repairable_batteries():
 
 @main_bp.route('/battery/<int:battery_id>/quick_note', methods=['POST'])
 @login_required
+@works_offline
 def add_quick_note(battery_id):
     if current_user.role not in ['shop_staff', 'admin']:
         flash('Access denied. Only staff and admin can add notes.', 'error')
         return redirect(url_for('main.dashboard'))
     
-    battery = Battery.query.get_or_404(battery_id)
+    if not database_down():
+        get_hot_battery(battery_id)
     note_text = request.form.get('note')
     
     if not note_text:
@@ -412,13 +511,10 @@ def add_quick_note(battery_id):
         return redirect(request.referrer or url_for('main.dashboard'))
     
     try:
-        note = BatteryStaffNote()
-        note.battery_id = battery.id
-        note.note = note_text
-        note.note_type = 'followup'
-        note.created_by = current_user.id
-        db.session.add(note)
-        db.session.commit()
+        _, queued = apply_or_queue('note', current_user.id, {'battery_id': battery_id, 'note': note_text})
+        if queued:
+            return _queued_result(queued, 'The database is unreachable. The note was saved as',
+                                  request.referrer or url_for('main.dashboard'))
         flash('Note added successfully.', 'success')
     except Exception as e:
         db.session.rollback()
@@ -433,13 +529,7 @@ def reopen_for_warranty(battery_id):
         flash('Access denied. Only staff and admin can reopen batteries for warranty.', 'error')
         return redirect(url_for('main.dashboard'))
     
-    battery = Battery.query.get_or_404(battery_id)
-    
-    # Only allow reopening if battery was Ready/Delivered/Returned
-    if battery.status not in ['Ready', 'Delivered', 'Returned']:
-        flash('Only completed batteries can be reopened for warranty.', 'error')
-        return redirect(request.referrer or url_for('main.dashboard'))
-    
+    battery = get_hot_battery(battery_id)
     warranty_reason = request.form.get('warranty_reason')
     
     if not warranty_reason:
@@ -447,18 +537,11 @@ def reopen_for_warranty(battery_id):
         return redirect(request.referrer or url_for('main.dashboard'))
     
     try:
-        # Change status back to Pending for re-work
+        # Change status back to Pending for re-work; only allow reopening if battery was Ready/Delivered/Returned
         old_status = battery.status
-        battery.status = 'Pending'
-        db.session.add(battery)
-        
-        # Add status history
-        status_history = BatteryStatusHistory()
-        status_history.battery_id = battery.id
-        status_history.status = 'Pending'
-        status_history.comments = f'Reopened for warranty - Previous status: {old_status}. Reason: {warranty_reason}'
-        status_history.updated_by = current_user.id
-        db.session.add(status_history)
+        change_status(battery, 'Pending', current_user.id,
+                      f'Reopened for warranty - Previous status: {old_status}. Reason: {warranty_reason}',
+                      parse_version(request.form.get('version')), from_statuses=('Ready', 'Delivered', 'Returned'))
         
         # Add a warranty note
         warranty_note = BatteryStaffNote()
@@ -468,8 +551,12 @@ def reopen_for_warranty(battery_id):
         warranty_note.created_by = current_user.id
         db.session.add(warranty_note)
         
-        db.session.commit()
-        flash(f'Battery {battery.battery_id} reopened for warranty work.', 'success')
+        commit_change(battery)
+        return _status_result(battery, f'Battery {battery.battery_id} reopened for warranty work.', 'success',
+                              request.referrer or url_for('main.dashboard'))
+    except StatusConflict as e:
+        db.session.rollback()
+        return _status_result(battery, str(e), 'warning', request.referrer or url_for('main.dashboard'), conflict=True)
     except Exception as e:
         db.session.rollback()
         flash(f'Error reopening battery: {str(e)}', 'error')
@@ -507,6 +594,7 @@ def all_batteries():
 
 @main_bp.route('/all_bills')
 @login_required
+@read_only
 def all_bills():
     if current_user.role not in ['shop_staff', 'admin']:
         flash('Access denied. Only staff and admin can view all bills.', 'error')
@@ -550,8 +638,11 @@ def admin_users():
         flash('Access denied. Admin access required.', 'error')
         return redirect(url_for('main.dashboard'))
     
-    users = User.query.all()
-    return render_template('admin/users.html', users=users)
+    # Admins bound to a shop manage that shop's users; head office admins manage everyone
+    users = User.query.options(joinedload(User.shop))
+    if current_user.shop_id:
+        users = users.filter(User.shop_id == current_user.shop_id)
+    return render_template('admin/users.html', users=users.all())
 
 @main_bp.route('/admin/users/add', methods=['GET', 'POST'])
 @login_required
@@ -560,27 +651,32 @@ def admin_add_user():
         flash('Access denied. Admin access required.', 'error')
         return redirect(url_for('main.dashboard'))
     
+    # Head office admins may bind the user to any shop, or none; other admins only to their own
+    shops = Shop.query.order_by(Shop.name).all() if not current_user.shop_id else []
+    
     if request.method == 'POST':
         username = request.form.get('username')
         full_name = request.form.get('full_name')
         role = request.form.get('role')
         password = request.form.get('password')
+        shop_id = current_user.shop_id or request.form.get('shop_id', type=int)
         
         if not all([username, full_name, role, password]):
             flash('All fields are required.', 'error')
-            return render_template('admin/add_user.html')
+            return render_template('admin/add_user.html', shops=shops)
         
         if User.query.filter_by(username=username).first():
             flash('Username already exists.', 'error')
-            return render_template('admin/add_user.html')
+            return render_template('admin/add_user.html', shops=shops)
         
         try:
             user = User()
             user.username = username
             user.full_name = full_name
             user.role = role
+            user.shop_id = shop_id
             if password:
-                user.password_hash = generate_password_hash(password)
+                user.password_hash = hash_password(password)
             db.session.add(user)
             db.session.commit()
             flash(f'User {username} created successfully.', 'success')
@@ -589,7 +685,7 @@ def admin_add_user():
             db.session.rollback()
             flash(f'Error creating user: {str(e)}', 'error')
     
-    return render_template('admin/add_user.html')
+    return render_template('admin/add_user.html', shops=shops)
 
 @main_bp.route('/admin/users/<int:user_id>/toggle', methods=['POST'])
 @login_required
@@ -599,6 +695,8 @@ def admin_toggle_user(user_id):
         return redirect(url_for('main.dashboard'))
     
     user = User.query.get_or_404(user_id)
+    if current_user.shop_id and user.shop_id != current_user.shop_id:
+        abort(404)
     if user.id == current_user.id:
         flash('Cannot deactivate your own account.', 'error')
         return redirect(url_for('main.admin_users'))
@@ -621,31 +719,193 @@ def admin_settings():
         flash('Access denied. Admin access required.', 'error')
         return redirect(url_for('main.dashboard'))
     
+    # The settings of the current shop
+    shop = get_current_shop()
     if request.method == 'POST':
         shop_name = request.form.get('shop_name')
-        battery_prefix = request.form.get('battery_id_prefix')
-        battery_start = request.form.get('battery_id_start')
-        battery_padding = request.form.get('battery_id_padding')
+        battery_prefix = request.form.get('battery_id_prefix', '').strip()
+        battery_start = request.form.get('battery_id_start', type=int)
+        battery_padding = request.form.get('battery_id_padding', type=int)
         
-        try:
-            SystemSettings.set_setting('shop_name', shop_name)
-            SystemSettings.set_setting('battery_id_prefix', battery_prefix)
-            SystemSettings.set_setting('battery_id_start', battery_start)
-            SystemSettings.set_setting('battery_id_padding', battery_padding)
-            db.session.commit()
-            flash('Settings updated successfully.', 'success')
-        except Exception as e:
-            db.session.rollback()
-            flash(f'Error updating settings: {str(e)}', 'error')
+        error = prefix_error(battery_prefix, shop.id)
+        if error:
+            flash(error, 'error')
+        else:
+            try:
+                shop.name = shop_name
+                shop.battery_id_prefix = battery_prefix
+                shop.battery_id_start = battery_start or 1
+                shop.battery_id_padding = battery_padding or 4
+                # A higher starting number skips ahead; the counter never goes back
+                shop.last_battery_number = max(shop.last_battery_number, shop.battery_id_start - 1)
+                db.session.commit()
+                flash('Settings updated successfully.', 'success')
+            except Exception as e:
+                db.session.rollback()
+                flash(f'Error updating settings: {str(e)}', 'error')
     
     settings = {
-        'shop_name': SystemSettings.get_setting('shop_name', 'Battery Repair Service'),
-        'battery_id_prefix': SystemSettings.get_setting('battery_id_prefix', 'BAT'),
-        'battery_id_start': SystemSettings.get_setting('battery_id_start', '1'),
-        'battery_id_padding': SystemSettings.get_setting('battery_id_padding', '4')
+        'shop_name': shop.name,
+        'battery_id_prefix': shop.battery_id_prefix,
+        'battery_id_start': str(shop.battery_id_start),
+        'battery_id_padding': str(shop.battery_id_padding),
+        'next_battery_id': shop.format_battery_id(shop.last_battery_number + 1)
     }
     
-    return render_template('admin/settings.html', settings=settings)
+    return render_template('admin/settings.html', settings=settings, shop=shop)
+
+@main_bp.route('/admin/shops', methods=['GET', 'POST'])
+@login_required
+def admin_shops():
+    if current_user.role != 'admin' or current_user.shop_id:
+        flash('Access denied. Head office admin access required.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    if request.method == 'POST':
+        code = request.form.get('code', '').strip().upper()
+        name = request.form.get('name', '').strip()
+        battery_prefix = request.form.get('battery_id_prefix', '').strip()
+        
+        error = prefix_error(battery_prefix)
+        if not all([code, name, battery_prefix]):
+            flash('All fields are required.', 'error')
+        elif Shop.query.filter_by(code=code).first():
+            flash('Shop code already exists.', 'error')
+        elif error:
+            flash(error, 'error')
+        else:
+            try:
+                shop = Shop()
+                shop.code = code
+                shop.name = name
+                shop.battery_id_prefix = battery_prefix
+                db.session.add(shop)
+                db.session.commit()
+                flash(f'Shop {name} created successfully.', 'success')
+                return redirect(url_for('main.admin_shops'))
+            except Exception as e:
+                db.session.rollback()
+                flash(f'Error creating shop: {str(e)}', 'error')
+    
+    shops = Shop.query.order_by(Shop.name).all()
+    return render_template('admin/shops.html', shops=shops)
+
+@main_bp.route('/admin/shops/<int:shop_id>/toggle', methods=['POST'])
+@login_required
+def admin_toggle_shop(shop_id):
+    if current_user.role != 'admin' or current_user.shop_id:
+        flash('Access denied.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    shop = Shop.query.get_or_404(shop_id)
+    shop.is_active = not shop.is_active
+    try:
+        db.session.commit()
+        status = 'reopened' if shop.is_active else 'closed'
+        flash(f'Shop {shop.name} has been {status}.', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Error updating shop: {str(e)}', 'error')
+    
+    return redirect(url_for('main.admin_shops'))
+
+@main_bp.route('/shop/switch', methods=['POST'])
+@login_required
+def switch_shop():
+    # Users bound to a shop always work in it
+    if current_user.shop_id:
+        flash('Access denied.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    shop = Shop.query.filter_by(id=request.form.get('shop_id', type=int), is_active=True).first()
+    if shop is None:
+        flash('Unknown shop.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    select_shop(shop.id)
+    flash(f'Now working in {shop.name}.', 'success')
+    return redirect(url_for('main.dashboard'))
+
+@main_bp.route('/admin/slow_queries', methods=['GET', 'POST'])
+@login_required
+def admin_slow_queries():
+    if current_user.role != 'admin':
+        flash('Access denied. Admin access required.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    if request.method == 'POST':
+        clear_slow_queries()
+        flash('Slow query log cleared.', 'success')
+        return redirect(url_for('main.admin_slow_queries'))
+    
+    entries = get_recent_slow_queries()
+    return render_template('admin/slow_queries.html', entries=entries,
+                         threshold_ms=current_app.config.get('SLOW_QUERY_MS', 0),
+                         explain_enabled=current_app.config.get('SLOW_QUERY_EXPLAIN', False))
+
+@main_bp.route('/admin/write_queue', methods=['GET', 'POST'])
+@login_required
+@works_offline
+def admin_write_queue():
+    if current_user.role != 'admin':
+        flash('Access denied. Admin access required.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    if request.method == 'POST':
+        entry_id = request.form.get('entry_id', type=int)
+        entry = get_entry(entry_id) if entry_id is not None else None
+        # Head office sees the writes of every shop; admins bound to a shop only that shop's
+        if entry is None or (current_user.shop_id and entry['shop_id'] != current_user.shop_id):
+            abort(404)
+        retry_entry(entry_id)
+        flash(f'{provisional_id(entry_id)} queued again.', 'success')
+        return redirect(url_for('main.admin_write_queue'))
+    
+    return render_template('admin/write_queue.html', entries=list_entries(current_user.shop_id or None),
+                         database_down=database_down(),
+                         replay_seconds=current_app.config.get('WRITE_QUEUE_REPLAY_SECONDS', 5))
+
+@main_bp.route('/admin/profiles')
+@login_required
+def admin_profiles():
+    if current_user.role != 'admin':
+        flash('Access denied. Admin access required.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    return render_template('admin/profiles.html', profiles=list_profiles(),
+                         profiling_enabled=current_app.config.get('PROFILING_ENABLED', False),
+                         sample_rate=current_app.config.get('PROFILE_SAMPLE_RATE', 0.0))
+
+@main_bp.route('/admin/profiles/<name>')
+@login_required
+def admin_profile_detail(name):
+    if current_user.role != 'admin':
+        flash('Access denied. Admin access required.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    summary_path = get_profile_file(name, '.txt')
+    meta_path = get_profile_file(name, '.json')
+    if not summary_path or not meta_path:
+        abort(404)
+    
+    with open(summary_path, encoding='utf-8') as f:
+        summary = f.read()
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return render_template('admin/profile_detail.html', profile=meta, summary=summary)
+
+@main_bp.route('/admin/profiles/<name>/download')
+@login_required
+def admin_profile_download(name):
+    if current_user.role != 'admin':
+        flash('Access denied. Admin access required.', 'error')
+        return redirect(url_for('main.dashboard'))
+    
+    path = get_profile_file(name, '.pstats')
+    if not path:
+        abort(404)
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=f'{name}.pstats')
 
 @main_bp.route('/admin/backup')
 @login_required
@@ -655,203 +915,60 @@ def admin_backup():
         return redirect(url_for('main.dashboard'))
     
     try:
-        # Create comprehensive backup data
-        backup_data = {
-            'timestamp': datetime.now().isoformat(),
-            'users': [],
-            'customers': [],
-            'batteries': [],
-            'status_history': [],
-            'settings': []
-        }
-        
-        # Export users (without passwords for security)
-        for user in User.query.all():
-            backup_data['users'].append({
-                'username': user.username,
-                'full_name': user.full_name,
-                'role': user.role,
-                'created_at': user.created_at.isoformat() if user.created_at else None,
-                'is_active': user.is_active
-            })
-        
-        # Export customers
-        for customer in Customer.query.all():
-            backup_data['customers'].append({
-                'id': customer.id,
-                'name': customer.name,
-                'mobile': customer.mobile,
-                'created_at': customer.created_at.isoformat() if customer.created_at else None
-            })
-        
-        # Export batteries
-        for battery in Battery.query.all():
-            backup_data['batteries'].append({
-                'id': battery.id,
-                'battery_id': battery.battery_id,
-                'customer_id': battery.customer_id,
-                'battery_type': battery.battery_type,
-                'voltage': battery.voltage,
-                'capacity': battery.capacity,
-                'status': battery.status,
-                'inward_date': battery.inward_date.isoformat() if battery.inward_date else None,
-                'service_price': battery.service_price
-            })
-        
-        # Export status history
-        for history in BatteryStatusHistory.query.all():
-            backup_data['status_history'].append({
-                'id': history.id,
-                'battery_id': history.battery_id,
-                'status': history.status,
-                'comments': history.comments,
-                'updated_by': history.updated_by,
-                'updated_at': history.updated_at.isoformat() if history.updated_at else None
-            })
-        
-        # Export settings
-        for setting in SystemSettings.query.all():
-            backup_data['settings'].append({
-                'setting_key': setting.setting_key,
-                'setting_value': setting.setting_value,
-                'updated_at': setting.updated_at.isoformat() if setting.updated_at else None
-            })
-        
-        # Create JSON response
-        backup_json = json.dumps(backup_data, indent=2)
-        
-        response = make_response(backup_json)
-        response.headers['Content-Disposition'] = f'attachment; filename=battery_erp_backup_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-        response.headers['Content-Type'] = 'application/json'
-        
-        return response
-        
+        # An incremental backup holds what changed since the latest backup (full when there is none)
+        # Users bound to a shop back up (and keep the watermark of) their own shop only
+        since = get_watermark(current_user.shop_id) if request.args.get('incremental') else None
+        job = submit_job('backup', current_user.id, since=since)
+        return redirect(url_for('main.job_status', job_id=job.id))
     except Exception as e:
         flash(f'Error creating backup: {str(e)}', 'error')
         return redirect(url_for('main.dashboard'))
 
+@main_bp.route('/admin/snapshot')
+@login_required
+def admin_snapshot():
+    # Covers every shop, so not for admins bound to one
+    if current_user.role != 'admin' or current_user.shop_id:
+        flash('Access denied. Head office admin access required.', 'error')
+        return redirect(url_for('main.dashboard'))
+
+    job = submit_job('snapshot', current_user.id)
+    return redirect(url_for('main.job_status', job_id=job.id))
+
 @main_bp.route('/admin/restore', methods=['GET', 'POST'])
 @login_required
 def admin_restore():
-    if current_user.role != 'admin':
-        flash('Access denied. Admin access required.', 'error')
+    # Covers every shop, so not for admins bound to one
+    if current_user.role != 'admin' or current_user.shop_id:
+        flash('Access denied. Head office admin access required.', 'error')
         return redirect(url_for('main.dashboard'))
     
     if request.method == 'POST':
-        if 'backup_file' not in request.files:
-            flash('No file selected.', 'error')
-            return render_template('admin/restore.html')
-        
-        file = request.files['backup_file']
-        if file.filename == '':
+        # A full backup, optionally with the incremental backups taken after it
+        files = [file for file in request.files.getlist('backup_file') if file.filename]
+        if not files:
             flash('No file selected.', 'error')
             return render_template('admin/restore.html')
         
-        if file and file.filename and file.filename.endswith('.json'):
+        if all(file.filename.endswith('.json') for file in files):
+            confirm = request.form.get('confirm_restore')
+            if confirm != 'CONFIRM':
+                flash('Please type "CONFIRM" to proceed with restore.', 'error')
+                return render_template('admin/restore.html')
+            
             try:
-                backup_data = json.loads(file.read().decode('utf-8'))
-                
-                # Clear existing data (be careful!)
-                confirm = request.form.get('confirm_restore')
-                if confirm != 'CONFIRM':
-                    flash('Please type "CONFIRM" to proceed with restore.', 'error')
-                    return render_template('admin/restore.html')
-                
-                # Implement actual restore functionality
-                try:
-                    # Backup current admin user before clearing data
-                    admin_user_backup = {
-                        'username': current_user.username,
-                        'password_hash': current_user.password_hash,
-                        'role': current_user.role,
-                        'full_name': current_user.full_name
-                    }
-                    
-                    # Clear existing data (preserve current admin)
-                    BatteryStatusHistory.query.delete()
-                    Battery.query.delete()
-                    Customer.query.delete()
-                    SystemSettings.query.delete()
-                    # Don't delete current admin user
-                    User.query.filter(User.id != current_user.id).delete()
-                    
-                    db.session.commit()
-                    
-                    # Restore customers
-                    customer_id_mapping = {}
-                    for customer_data in backup_data.get('customers', []):
-                        customer = Customer()
-                        customer.name = customer_data['name']
-                        customer.mobile = customer_data['mobile']
-                        if customer_data.get('created_at'):
-                            customer.created_at = datetime.fromisoformat(customer_data['created_at'])
-                        db.session.add(customer)
-                        db.session.flush()
-                        customer_id_mapping[customer_data['id']] = customer.id
-                    
-                    # Restore batteries
-                    battery_id_mapping = {}
-                    for battery_data in backup_data.get('batteries', []):
-                        battery = Battery()
-                        battery.battery_id = battery_data['battery_id']
-                        battery.customer_id = customer_id_mapping.get(battery_data['customer_id'])
-                        battery.battery_type = battery_data['battery_type']
-                        battery.voltage = battery_data['voltage']
-                        battery.capacity = battery_data['capacity']
-                        battery.status = battery_data['status']
-                        battery.service_price = battery_data.get('service_price', 0.0)
-                        if battery_data.get('inward_date'):
-                            battery.inward_date = datetime.fromisoformat(battery_data['inward_date'])
-                        db.session.add(battery)
-                        db.session.flush()
-                        battery_id_mapping[battery_data['id']] = battery.id
-                    
-                    # Restore users (except passwords)
-                    for user_data in backup_data.get('users', []):
-                        if user_data['username'] != current_user.username:  # Don't overwrite current admin
-                            user = User()
-                            user.username = user_data['username']
-                            user.full_name = user_data['full_name']
-                            user.role = user_data['role']
-                            user.password_hash = generate_password_hash('password123')
-                            user.active = user_data.get('is_active', True)
-                            if user_data.get('created_at'):
-                                user.created_at = datetime.fromisoformat(user_data['created_at'])
-                            db.session.add(user)
-                    
-                    # Restore status history
-                    for history_data in backup_data.get('status_history', []):
-                        if battery_id_mapping.get(history_data['battery_id']):
-                            history = BatteryStatusHistory()
-                            history.battery_id = battery_id_mapping[history_data['battery_id']]
-                            history.status = history_data['status']
-                            history.comments = history_data.get('comments', '')
-                            history.updated_by = current_user.id  # Assign to current admin
-                            if history_data.get('updated_at'):
-                                history.updated_at = datetime.fromisoformat(history_data['updated_at'])
-                            db.session.add(history)
-                    
-                    # Restore system settings
-                    for setting_data in backup_data.get('settings', []):
-                        setting = SystemSettings()
-                        setting.setting_key = setting_data['setting_key']
-                        setting.setting_value = setting_data['setting_value']
-                        if setting_data.get('updated_at'):
-                            setting.updated_at = datetime.fromisoformat(setting_data['updated_at'])
-                        db.session.add(setting)
-                    
-                    db.session.commit()
-                    flash('Data restored successfully! Note: Restored user passwords have been reset to "password123".', 'success')
-                    return redirect(url_for('main.dashboard'))
-                    
-                except Exception as restore_error:
-                    db.session.rollback()
-                    flash(f'Error during restore: {str(restore_error)}', 'error')
-                
+                # The restore itself runs as a background job reading the saved uploads
+                upload_paths = []
+                for file in files:
+                    upload_path = os.path.join(get_jobs_dir(), f'{uuid.uuid4().hex}.upload')
+                    file.save(upload_path)
+                    upload_paths.append(os.path.basename(upload_path))
+                job = submit_job('restore', current_user.id, upload_paths=upload_paths)
+                return redirect(url_for('main.job_status', job_id=job.id))
             except Exception as e:
                 flash(f'Error reading backup file: {str(e)}', 'error')
         else:
-            flash('Please upload a valid JSON backup file.', 'error')
+            flash('Please upload valid JSON backup files.', 'error')
     
     return render_template('admin/restore.html')
 
@@ -872,6 +989,7 @@ def finished_batteries():
 
 @main_bp.route('/reports/monthly')
 @login_required
+@read_only
 def monthly_report():
     from sqlalchemy import func, extract
     
@@ -902,52 +1020,121 @@ def monthly_report():
                          total_revenue=float(monthly_revenue),
                          month_name=datetime.now().strftime('%B %Y'))
 
+# Earliest year the yearly report is offered for
+YEARLY_REPORT_FIRST_YEAR = 2000
+
 @main_bp.route('/reports/yearly')
 @login_required
 def yearly_report():
-    from sqlalchemy import func, extract
-    
-    # Get current year data
-    current_year = datetime.now().year
+    year = request.args.get('year', datetime.now().year, type=int)
+    include_archived = request.args.get('include_archived', '1') == '1'
+    if not YEARLY_REPORT_FIRST_YEAR <= year <= datetime.now().year:
+        flash(f'Choose a year from {YEARLY_REPORT_FIRST_YEAR} to {datetime.now().year}.', 'error')
+        return redirect(url_for('main.dashboard'))
     
-    yearly_batteries = Battery.query.filter(
-        extract('year', Battery.inward_date) == current_year
-    ).all()
+    try:
+        job = submit_job('yearly_report', current_user.id, year=year, include_archived=include_archived)
+        return redirect(url_for('main.job_status', job_id=job.id))
+    except Exception as e:
+        flash(f'Error generating report: {str(e)}', 'error')
+        return redirect(url_for('main.dashboard'))
+
+REPORT_RANGES = [7, 30, 90, 365]
+
+def _report_days():
+    days = request.args.get('days', 30, type=int)
+    return days if days in REPORT_RANGES else 30
+
+@main_bp.route('/reports/turnaround')
+@login_required
+def turnaround_report():
+    if current_user.role != 'admin':
+        flash('Access denied. Admin access required.', 'error')
+        return redirect(url_for('main.dashboard'))
     
-    yearly_completed = Battery.query.filter(
-        Battery.status == 'Ready',
-        extract('year', Battery.inward_date) == current_year
-    ).count()
+    days = _report_days()
+    ensure_fresh()
+    first_day, last_day = report_range(days)
+    return render_template('reports/turnaround.html',
+                         metrics=turnaround_summary(first_day, last_day),
+                         days=days,
+                         ranges=REPORT_RANGES,
+                         first_day=first_day,
+                         last_day=last_day,
+                         refreshed_at=last_refreshed())
+
+@main_bp.route('/reports/throughput')
+@login_required
+def throughput_report():
+    if current_user.role != 'admin':
+        flash('Access denied. Admin access required.', 'error')
+        return redirect(url_for('main.dashboard'))
     
-    yearly_revenue = db.session.query(func.sum(Battery.service_price)).filter(
-        Battery.status == 'Ready',
-        extract('year', Battery.inward_date) == current_year
-    ).scalar() or 0
+    days = _report_days()
+    ensure_fresh()
+    first_day, last_day = report_range(days)
+    return render_template('reports/throughput.html',
+                         users=technician_throughput(first_day, last_day),
+                         days=days,
+                         ranges=REPORT_RANGES,
+                         first_day=first_day,
+                         last_day=last_day,
+                         refreshed_at=last_refreshed())
+
+# Background jobs
+def _get_visible_job(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.created_by != current_user.id and current_user.role != 'admin':
+        abort(404)
+    # Head office sees the jobs of every shop; users bound to a shop only that shop's
+    if current_user.shop_id and job.shop_id != current_user.shop_id:
+        abort(404)
+    return job
+
+@main_bp.route('/jobs/submit', methods=['POST'])
+@login_required
+def submit_background_job():
+    kind = request.form.get('kind', '')
+    if kind == 'restore' or not can_submit(kind, current_user):
+        flash('Access denied.', 'error')
+        return redirect(url_for('main.dashboard'))
     
-    # Get monthly breakdown
-    monthly_breakdown = []
-    for month in range(1, 13):
-        month_revenue = db.session.query(func.sum(Battery.service_price)).filter(
-            Battery.status == 'Ready',
-            extract('month', Battery.inward_date) == month,
-            extract('year', Battery.inward_date) == current_year
-        ).scalar() or 0
-        
-        month_count = Battery.query.filter(
-            Battery.status == 'Ready',
-            extract('month', Battery.inward_date) == month,
-            extract('year', Battery.inward_date) == current_year
-        ).count()
-        
-        monthly_breakdown.append({
-            'month': datetime(current_year, month, 1).strftime('%B'),
-            'revenue': float(month_revenue),
-            'count': month_count
-        })
+    params = {}
+    if kind == 'yearly_report':
+        params['year'] = request.form.get('year', datetime.now().year, type=int)
     
-    return render_template('reports/yearly.html', 
-                         batteries=yearly_batteries,
-                         completed_count=yearly_completed,
-                         total_revenue=float(yearly_revenue),
-                         year=current_year,
-                         monthly_breakdown=monthly_breakdown)
+    try:
+        job = submit_job(kind, current_user.id, **params)
+        return redirect(url_for('main.job_status', job_id=job.id))
+    except Exception as e:
+        flash(f'Error starting job: {str(e)}', 'error')
+        return redirect(url_for('main.dashboard'))
+
+@main_bp.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    job = _get_visible_job(job_id)
+    return render_template('job_status.html', job=job)
+
+@main_bp.route('/jobs/<job_id>/status')
+@login_required
+def job_status_json(job_id):
+    job = _get_visible_job(job_id)
+    data = job_to_dict(job)
+    if job.status == 'finished' and job.result_path:
+        data['download_url'] = url_for('main.job_download', job_id=job.id)
+        data['inline'] = job.result_mimetype == 'text/html'
+    return jsonify(data)
+
+@main_bp.route('/jobs/<job_id>/download')
+@login_required
+def job_download(job_id):
+    job = _get_visible_job(job_id)
+    path = get_result_file(job) if job.status == 'finished' else None
+    if not path:
+        flash('This result is not available. It may still be running or has expired.', 'error')
+        return redirect(url_for('main.job_status', job_id=job.id))
+    
+    inline = job.result_mimetype == 'text/html'
+    return send_file(path, mimetype=job.result_mimetype, as_attachment=not inline,
+                     download_name=job.result_name)
@@ -0,0 +1,70 @@
+"""
+Production serving profile shared by gunicorn_config.py and app.py.
+
+Worker and thread counts are read here once so the gunicorn config and the
+database pool sizing in app.py always agree on how many concurrent requests
+a single process can run.
+"""
+import multiprocessing
+import os
+
+
+def get_worker_count():
+    """Number of gunicorn worker processes (WEB_WORKERS, default cores * 2 + 1, at most 8)"""
+    workers = os.environ.get("WEB_WORKERS")
+    if workers:
+        return max(1, int(workers))
+    return min(multiprocessing.cpu_count() * 2 + 1, 8)
+
+
+def get_thread_count():
+    """Request threads per worker process (WEB_THREADS, default 4)"""
+    return max(1, int(os.environ.get("WEB_THREADS", 4)))
+
+
+def get_live_stream_count():
+    """Extra threads per worker for live event streams (LIVE_MAX_STREAMS, default 16; 0 when live updates are off)"""
+    if os.environ.get("LIVE_UPDATES_ENABLED", "1") != "1":
+        return 0
+    return max(0, int(os.environ.get("LIVE_MAX_STREAMS", 16)))
+
+
+def get_pool_settings(workers=None, threads=None, job_workers=None):
+    """Size the per-process SQLAlchemy pool against the Postgres connection limit.
+
+    Each process needs one connection per request thread plus one per
+    background job thread. The connections left under DB_MAX_CONNECTIONS
+    (after DB_RESERVED_CONNECTIONS for psql, backups and migrations) are
+    shared out between worker processes; whatever a process does not need
+    for its steady state becomes overflow for bursts.
+    """
+    workers = workers or get_worker_count()
+    threads = threads or get_thread_count()
+    if job_workers is None:
+        job_workers = int(os.environ.get("JOB_WORKERS", 2))
+
+    max_connections = int(os.environ.get("DB_MAX_CONNECTIONS", 100))
+    reserved = int(os.environ.get("DB_RESERVED_CONNECTIONS", 10))
+    per_process = max(1, (max_connections - reserved) // workers)
+
+    pool_size = max(1, min(threads + job_workers, per_process))
+    max_overflow = max(0, per_process - pool_size)
+    return {"pool_size": pool_size, "max_overflow": max_overflow}
+
+
+def get_engine_options(database_url):
+    """SQLAlchemy engine options for the configured database"""
+    options = {
+        "pool_recycle": 300,
+        # Disconnects are handled when they happen (see handle_stale_connection in
+        # app.py) instead of paying a round trip on every checkout. Set
+        # DB_POOL_PRE_PING=1 to restore the old behaviour.
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING") == "1",
+    }
+    if database_url.startswith("postgresql"):
+        options.update(get_pool_settings())
+        # Reuse the most recently returned connection so idle ones can be recycled
+        options["pool_use_lifo"] = True
+        # Give up on an unreachable server quickly, so writes fall back to the local queue (write_queue.py)
+        options["connect_args"] = {"connect_timeout": int(os.environ.get("DB_CONNECT_TIMEOUT", 5))}
+    return options
@@ -0,0 +1,161 @@
+"""
+Several shops (branches) served from one deployment.
+
+Customers, batteries (hot and archived) with their status history and staff
+notes, and the analytics summaries belong to a shop (``ShopScoped`` in
+models.py). Each request works in one shop: the one the user is bound to,
+or for head office users (no shop) the one picked in the navbar, kept in the
+browser session. Jobs run in the shop they were started from, except
+backups, snapshots and restores, which cover the whole deployment.
+
+While there is a current shop, a ``do_orm_execute`` hook adds
+``with_loader_criteria(ShopScoped, shop_id == current)`` to every ORM
+SELECT, UPDATE and DELETE, so the queries in routes.py need no shop filters
+of their own, and new rows default to the current shop. A query with
+``execution_options(all_shops=True)`` sees every shop. Core statements on
+the tables (archival, the analytics refresh, backups) and CLI commands are
+not scoped. The indexes those scoped queries use lead with ``shop_id``.
+
+Each shop has its own name, battery ID prefix and counter (its ``shop``
+row). Battery IDs stay unique across shops because prefixes are unique and
+do not end in a digit.
+"""
+import re
+from contextlib import contextmanager
+
+from flask import g, has_app_context, has_request_context, session
+from flask_login import current_user
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import with_loader_criteria
+
+from app import db
+from replica import RoutingSession
+from models import Shop, ShopScoped, Battery, ArchivedBattery, DEFAULT_SHOP_ID
+from write_queue import database_down
+
+SESSION_KEY = 'shop_id'
+
+# Settings that became columns of the shop row (schema version 7)
+SHOP_SETTINGS = ('shop_name', 'battery_id_prefix', 'battery_id_start', 'battery_id_padding')
+
+# Letters, digits and dashes, ending in a letter or dash so the number after it is unambiguous
+PREFIX_PATTERN = re.compile(r'[A-Za-z0-9-]*[A-Za-z-]')
+
+
+def _request_shop_id():
+    if not current_user.is_authenticated:
+        return None
+    if current_user.shop_id:
+        return current_user.shop_id
+    # Head office: the shop picked in the navbar, at first the oldest active one
+    shop_id = session.get(SESSION_KEY)
+    if shop_id is None:
+        shop_id = db.session.execute(
+            select(Shop.id).where(Shop.is_active == True).order_by(Shop.id).limit(1)
+        ).scalar() or DEFAULT_SHOP_ID
+        session[SESSION_KEY] = shop_id
+    return shop_id
+
+
+def current_shop_id():
+    """The shop the current request or job works in; None for all shops (CLI, logged out)"""
+    if not has_app_context():
+        return None
+    if 'shop_id' not in g and has_request_context():
+        # Unscoped meanwhile, so loading the user to find their shop can't come back here
+        g.shop_id = None
+        try:
+            g.shop_id = _request_shop_id()
+        except Exception:
+            g.pop('shop_id', None)
+            raise
+    return g.get('shop_id')
+
+
+def get_current_shop():
+    """The current shop's row, or None for all shops (or while the database is down)"""
+    shop_id = current_shop_id()
+    return db.session.get(Shop, shop_id) if shop_id and not database_down() else None
+
+
+def switchable_shops():
+    """Active shops the current user may switch to: all of them for head office, none otherwise"""
+    if not has_request_context() or not current_user.is_authenticated or current_user.shop_id or database_down():
+        return []
+    return Shop.query.filter(Shop.is_active == True).order_by(Shop.name).all()
+
+
+def select_shop(shop_id):
+    """Make ``shop_id`` the head office user's shop for the rest of the browser session"""
+    session[SESSION_KEY] = shop_id
+    g.shop_id = shop_id
+
+
+@contextmanager
+def use_shop(shop_id):
+    """Scope this app context's queries to a shop (None: all shops)"""
+    had_shop, previous = 'shop_id' in g, g.get('shop_id')
+    g.shop_id = shop_id
+    try:
+        yield
+    finally:
+        if had_shop:
+            g.shop_id = previous
+        else:
+            g.pop('shop_id', None)
+
+
+def prefix_error(prefix, shop_id=None):
+    """Why ``prefix`` can't be the battery ID prefix of shop ``shop_id``, or None if it can"""
+    if not prefix or len(prefix) > 10 or not PREFIX_PATTERN.fullmatch(prefix):
+        return 'The battery ID prefix must be up to 10 letters, digits or dashes, not ending in a digit.'
+    clash = Shop.query.filter(Shop.battery_id_prefix == prefix, Shop.id != shop_id).first()
+    if clash:
+        return f'The battery ID prefix {prefix} is already used by {clash.name}.'
+    return None
+
+
+def sync_battery_counter(conn, shop_id):
+    """Move a shop's battery ID counter past its newest battery (hot or archived), on ``conn``"""
+    shop = Shop.__table__
+    row = conn.execute(select(shop.c.battery_id_prefix, shop.c.battery_id_start, shop.c.last_battery_number)
+                       .where(shop.c.id == shop_id)).first()
+    if row is None:
+        return
+    last_number = max(row.last_battery_number or 0, (row.battery_id_start or 1) - 1)
+    for model in (Battery, ArchivedBattery):
+        table = model.__table__
+        newest = conn.execute(select(table.c.battery_id).where(table.c.shop_id == shop_id)
+                              .order_by(table.c.id.desc()).limit(1)).scalar()
+        # e.g. BAT0041 -> 41; IDs in an older format are left alone
+        if newest and newest.startswith(row.battery_id_prefix) and newest[len(row.battery_id_prefix):].isdigit():
+            last_number = max(last_number, int(newest[len(row.battery_id_prefix):]))
+    conn.execute(update(shop).where(shop.c.id == shop_id).values(last_battery_number=last_number))
+
+
+def _scope_to_shop(execute_state):
+    if not (execute_state.is_select or execute_state.is_update or execute_state.is_delete):
+        return
+    # Lazy and deferred loads carry the criteria of the query that loaded their parent
+    if execute_state.is_column_load or execute_state.is_relationship_load:
+        return
+    if execute_state.execution_options.get('all_shops'):
+        return
+    # Statements known not to touch shop rows skip finding the shop; some wrappers (Query.count()) list no mappers
+    mappers = execute_state.all_mappers
+    if mappers and not any(issubclass(mapper.class_, ShopScoped) for mapper in mappers):
+        return
+    shop_id = current_shop_id()
+    if shop_id is None:
+        return
+    execute_state.statement = execute_state.statement.options(
+        with_loader_criteria(ShopScoped, lambda cls: cls.shop_id == shop_id, include_aliases=True)
+    )
+
+
+def init_shops(app):
+    """Scope ORM queries to the current shop and offer the shop to templates"""
+    if not event.contains(RoutingSession, 'do_orm_execute', _scope_to_shop):
+        event.listen(RoutingSession, 'do_orm_execute', _scope_to_shop)
+    app.jinja_env.globals['current_shop'] = get_current_shop
+    app.jinja_env.globals['switchable_shops'] = switchable_shops
@@ -0,0 +1,205 @@
+"""
+Slow-query recorder with optional EXPLAIN capture.
+
+Statements slower than SLOW_QUERY_MS are logged with their bound-parameter
+shapes (types only, never values), originating route and duration. With
+SLOW_QUERY_EXPLAIN enabled the plan is captured afterwards on a separate
+connection by a background thread, so the request that ran the statement
+does not wait for it. Each worker keeps the most recent entries in a bounded
+ring buffer, mirrored to ``instance/slow_queries/<pid>.json`` so the admin
+page can show entries from every worker. Files of workers that have exited
+(e.g. recycled after max_requests) are folded into ``retired.json``, which
+keeps the most recent SLOW_QUERY_BUFFER of them, when the page is loaded.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import pid_alive
+
+logger = logging.getLogger('slow_queries')
+
+RETIRED_FILE = 'retired.json'
+
+_settings = {'threshold': 0.2, 'explain': False, 'directory': None}
+_entries = deque(maxlen=200)
+_lock = threading.Lock()
+_explain_executor = None
+
+
+def describe_parameters(parameters):
+    """Reduce bound parameters to their shape so no customer data is stored"""
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (list, tuple, dict)):
+            return {'executemany': len(parameters), 'row': describe_parameters(parameters[0])}
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def _explain_sql(dialect_name, statement):
+    if dialect_name == 'postgresql':
+        return f'EXPLAIN (ANALYZE off) {statement}'
+    if dialect_name == 'sqlite':
+        return f'EXPLAIN QUERY PLAN {statement}'
+    return None
+
+
+def _capture_plan(engine, statement, parameters, entry):
+    sql = _explain_sql(engine.dialect.name, statement)
+    if sql is None:
+        return
+    try:
+        with engine.connect().execution_options(skip_slow_query_log=True) as conn:
+            rows = conn.exec_driver_sql(sql, parameters).fetchall()
+            conn.rollback()
+        entry['plan'] = '\n'.join(' '.join(str(col) for col in row) for row in rows)
+    except Exception as e:
+        entry['plan'] = f'EXPLAIN failed: {e}'
+    _persist()
+
+
+def _persist():
+    directory = _settings['directory']
+    if not directory:
+        return
+    with _lock:
+        data = list(_entries)
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    tmp_path = f'{path}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.debug(f'Could not write slow query log: {e}')
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('slow_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start_times = conn.info.get('slow_query_start')
+    if not start_times:
+        return
+    elapsed = time.perf_counter() - start_times.pop()
+    if elapsed < _settings['threshold'] or conn.get_execution_options().get('skip_slow_query_log'):
+        return
+
+    entry = {
+        'recorded_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'duration_ms': round(elapsed * 1000, 1),
+        'statement': statement,
+        'parameters': describe_parameters(parameters),
+        'route': (request.endpoint or request.path) if has_request_context() else 'background',
+        'path': request.path if has_request_context() else None,
+        'pid': os.getpid(),
+        'plan': None,
+    }
+    logger.warning(f"Slow query ({entry['duration_ms']} ms) in {entry['route']}: {statement}")
+
+    with _lock:
+        _entries.append(entry)
+
+    is_select = statement.lstrip().upper().startswith(('SELECT', 'WITH'))
+    if _settings['explain'] and is_select and not executemany:
+        _get_explain_executor().submit(_capture_plan, conn.engine, statement, parameters, entry)
+    else:
+        _persist()
+
+
+def _get_explain_executor():
+    global _explain_executor
+    with _lock:
+        if _explain_executor is None:
+            _explain_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='explain')
+        return _explain_executor
+
+
+def init_slow_query_log(app):
+    """Install the engine listeners when SLOW_QUERY_MS is greater than zero"""
+    global _entries
+    threshold_ms = app.config.get('SLOW_QUERY_MS', 200)
+    if not threshold_ms or threshold_ms <= 0:
+        return
+
+    _settings['threshold'] = threshold_ms / 1000.0
+    _settings['explain'] = app.config.get('SLOW_QUERY_EXPLAIN', False)
+    _settings['directory'] = os.path.join(app.instance_path, 'slow_queries')
+    os.makedirs(_settings['directory'], exist_ok=True)
+    _entries = deque(_entries, maxlen=app.config.get('SLOW_QUERY_BUFFER', 200))
+
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _retire(directory, filename):
+    """Fold an exited worker's entries into retired.json and remove its file (under the collect lock)"""
+    path = os.path.join(directory, filename)
+    if filename.endswith('.json'):
+        dead = _load(path)
+        if dead:
+            retired_path = os.path.join(directory, RETIRED_FILE)
+            entries = (_load(retired_path) or []) + dead
+            entries.sort(key=lambda entry: entry['recorded_at'], reverse=True)
+            tmp_path = f'{retired_path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(entries[:_entries.maxlen], f)
+            os.replace(tmp_path, retired_path)
+    os.remove(path)
+
+
+def get_recent_slow_queries(limit=200):
+    """Most recent entries across all workers, newest first"""
+    with _lock:
+        entries = list(_entries)
+    directory = _settings['directory']
+    if directory and os.path.isdir(directory):
+        with open(os.path.join(directory, 'collect.lock'), 'w') as lock_file:
+            # One page load at a time, so an exited worker's entries are folded in exactly once
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            for filename in os.listdir(directory):
+                pid = filename.split('.', 1)[0]
+                if filename.endswith(('.json', '.json.tmp')) and pid.isdigit() and int(pid) != os.getpid() \
+                        and not pid_alive(int(pid)):
+                    try:
+                        _retire(directory, filename)
+                    except OSError as e:
+                        logger.debug(f'Could not retire slow query log {filename}: {e}')
+            for filename in os.listdir(directory):
+                if not filename.endswith('.json') or filename == f'{os.getpid()}.json':
+                    continue
+                entries.extend(_load(os.path.join(directory, filename)) or [])
+    entries.sort(key=lambda entry: entry['recorded_at'], reverse=True)
+    return entries[:limit]
+
+
+def clear_slow_queries():
+    with _lock:
+        _entries.clear()
+    directory = _settings['directory']
+    if directory and os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            if filename.endswith('.json'):
+                os.remove(os.path.join(directory, filename))
@@ -0,0 +1,131 @@
+"""
+Consistent SQLite snapshots of the ERP tables, for analysis and hand-off.
+
+The snapshot is an ordinary SQLite file with every table of the app and its
+indexes, so it opens in any SQLite tool (or ``DATABASE_URL=sqlite:///...``)
+without a load step. From Postgres all tables are read inside one
+``REPEATABLE READ READ ONLY`` transaction, so they reflect a single moment
+even while the shop keeps working, and rows are streamed from a server-side
+cursor and inserted in batches of SNAPSHOT_BATCH_SIZE; indexes are built
+after the data is in. On the SQLite fallback the database file is copied
+with SQLite's online backup API instead.
+
+Password hashes are blanked and background job records are left out, as in
+the JSON backup.
+
+Download one from Admin > SQLite Snapshot, or write one from cron with
+``flask snapshot /backups/erp.sqlite``.
+"""
+import logging
+import os
+import sqlite3
+
+import click
+from flask import current_app
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from app import db
+from replica import INTERNAL_TABLES
+
+logger = logging.getLogger('snapshot')
+
+
+def _scrub(conn):
+    for table in INTERNAL_TABLES:
+        conn.execute(text(f'DELETE FROM "{table}"'))
+    conn.execute(text('UPDATE "user" SET password_hash = \'\''))
+
+
+def _copy_sqlite(engine, path, progress):
+    raw = engine.raw_connection()
+    try:
+        target = sqlite3.connect(path)
+        try:
+            # Copies pages a few at a time, so writers are only briefly held up
+            raw.dbapi_connection.backup(
+                target, pages=1024,
+                progress=lambda status, remaining, total: progress(int(90 * (total - remaining) / max(total, 1)),
+                                                                   'Copying database')
+            )
+        finally:
+            target.close()
+    finally:
+        raw.close()
+
+    target_engine = create_engine(f'sqlite:///{path}')
+    try:
+        with target_engine.begin() as conn:
+            _scrub(conn)
+        with target_engine.connect() as conn:
+            conn.execution_options(isolation_level='AUTOCOMMIT').execute(text('VACUUM'))
+    finally:
+        target_engine.dispose()
+
+
+def _copy_tables(engine, path, batch_size, progress):
+    tables = [table for table in db.metadata.sorted_tables if table.name not in INTERNAL_TABLES]
+    target_engine = create_engine(f'sqlite:///{path}')
+    try:
+        with engine.connect() as source, target_engine.connect() as target:
+            # A throwaway file until it is complete: no journal, no fsyncs
+            target.exec_driver_sql('PRAGMA journal_mode = OFF')
+            target.exec_driver_sql('PRAGMA synchronous = OFF')
+            for table in db.metadata.sorted_tables:
+                target.execute(CreateTable(table))
+
+            if source.dialect.name == 'postgresql':
+                source.execution_options(isolation_level='REPEATABLE READ')
+            with source.begin():
+                if source.dialect.name == 'postgresql':
+                    # The first query fixes the snapshot every later table is read from
+                    source.exec_driver_sql('SET TRANSACTION READ ONLY')
+                for number, table in enumerate(tables):
+                    progress(int(80 * number / len(tables)), f'Copying {table.name}')
+                    result = source.execute(
+                        select(table).order_by(*table.primary_key.columns),
+                        execution_options={'yield_per': batch_size}
+                    )
+                    for rows in result.partitions():
+                        target.execute(table.insert(), [dict(row._mapping) for row in rows])
+
+            progress(85, 'Building indexes')
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    target.execute(CreateIndex(index))
+            _scrub(target)
+            target.commit()
+    finally:
+        target_engine.dispose()
+
+
+def write_snapshot(path, batch_size=None, progress=None):
+    """Write a snapshot of the database the current session reads from to ``path``"""
+    batch_size = batch_size or current_app.config.get('SNAPSHOT_BATCH_SIZE', 5000)
+    progress = progress or (lambda pct, message: None)
+    # The replica, inside use_replica() (e.g. in a read-only job)
+    engine = db.session.get_bind()
+
+    if os.path.exists(path):
+        os.remove(path)
+    try:
+        if engine.dialect.name == 'sqlite':
+            _copy_sqlite(engine, path, progress)
+        else:
+            _copy_tables(engine, path, batch_size, progress)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    logger.info(f'Wrote database snapshot {path} ({os.path.getsize(path)} bytes)')
+    return os.path.getsize(path)
+
+
+def register_snapshot_commands(app):
+    @app.cli.command('snapshot')
+    @click.argument('path', type=click.Path(dir_okay=False, writable=True))
+    @click.option('--batch-size', type=int, help='Default: SNAPSHOT_BATCH_SIZE')
+    def snapshot_command(path, batch_size):
+        """Write a consistent, indexed SQLite copy of the database to PATH."""
+        size = write_snapshot(path, batch_size, progress=lambda pct, message: click.echo(f'  {pct:3d}% {message}'))
+        click.echo(f'Wrote {path} ({size // 1024} KB).')
@@ -0,0 +1,25 @@
+// Live battery events (see live.py). Calls onBattery(event) once per event, with
+// replays after a reconnect filtered out, and reloads the page when the server
+// says events were lost.
+function connectLiveUpdates(url, onBattery) {
+    if (!window.EventSource) {
+        return null;
+    }
+    const seen = new Set();
+    const source = new EventSource(url);
+    source.addEventListener('battery', function(e) {
+        if (seen.has(e.lastEventId)) {
+            return;
+        }
+        seen.add(e.lastEventId);
+        if (seen.size > 500) {
+            seen.delete(seen.values().next().value);
+        }
+        onBattery(JSON.parse(e.data));
+    });
+    source.addEventListener('reload', function() {
+        source.close();
+        window.location.reload();
+    });
+    return source;
+}
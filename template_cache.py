@@ -0,0 +1,53 @@
+"""
+Compiled template cache for production serving.
+
+Jinja compiles each template to Python code the first time it is rendered,
+so without help every worker process pays for ``base.html`` and each page
+on its first hit after a deploy or restart. Here:
+
+- compiled templates are written to ``instance/template_cache`` (Jinja's
+  FileSystemBytecodeCache, which writes atomically), so a template is
+  compiled once and every other worker, and the next boot, loads the
+  bytecode; entries are keyed by the template source, so an edited template
+  is simply compiled again;
+- with TEMPLATE_WARMUP every template is loaded at boot. gunicorn preloads
+  the app in the master, so the forked workers (including the ones recycled
+  by max_requests) start with all of them already in memory.
+
+Templates are only checked for changes when TEMPLATES_AUTO_RELOAD is on
+(default: in debug mode only). ``tools/bench_startup.py`` compares cold and
+warm first-request latency.
+"""
+import logging
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache, TemplateError
+
+logger = logging.getLogger('template_cache')
+
+
+def warm_templates(app):
+    """Load (compile, or read from the bytecode cache) every HTML template. Returns how many."""
+    count = 0
+    for name in app.jinja_env.list_templates(extensions=['html']):
+        try:
+            app.jinja_env.get_template(name)
+            count += 1
+        except TemplateError:
+            # Rendering it will fail the same way; the rest should still be warmed
+            logger.exception(f'Could not compile template {name}')
+    return count
+
+
+def init_template_cache(app):
+    """Attach the bytecode cache and warm the templates according to the TEMPLATE_* settings"""
+    if app.config.get('TEMPLATE_CACHE_ENABLED', True):
+        directory = os.path.join(app.instance_path, 'template_cache')
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    if app.config.get('TEMPLATE_WARMUP', True):
+        started = time.perf_counter()
+        count = warm_templates(app)
+        logger.info(f'Warmed {count} templates in {(time.perf_counter() - started) * 1000:.0f} ms')
@@ -0,0 +1,38 @@
+"""
+Tests run against a throwaway SQLite database, created and bootstrapped when
+the app is imported; the write queue and login throttle files go next to it.
+"""
+import os
+import tempfile
+
+import pytest
+
+_tmp_dir = tempfile.mkdtemp(prefix='battery_erp_tests_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'test.db')}"
+os.environ['WRITE_QUEUE_PATH'] = os.path.join(_tmp_dir, 'write_queue.sqlite')
+os.environ['LOGIN_THROTTLE_PATH'] = os.path.join(_tmp_dir, 'login_throttle.sqlite')
+os.environ.setdefault('TEMPLATE_WARMUP', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+from app import app as flask_app, db  # noqa: E402
+from models import User  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    with flask_app.app_context():
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def staff(app):
+    return User.query.filter_by(username='staff').first()
+
+
+@pytest.fixture
+def intake(app, staff):
+    """A freshly received battery"""
+    from routes import record_intake
+    return record_intake(staff.id, 'Test Customer', '9800000001', '', 'Inverter', '12V', '150Ah',
+                         is_pickup=False, pickup_charge=0.0)
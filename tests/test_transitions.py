@@ -0,0 +1,56 @@
+import pytest
+
+from app import db
+from models import Battery, BatteryStatusHistory
+from transitions import StatusConflict, change_status, commit_change
+
+
+def _other_session():
+    # A second session on its own connection, like another request thread
+    return db.session.session_factory()
+
+
+def test_status_moves_and_bumps_the_version(intake, staff):
+    version = intake.version
+    change_status(intake, 'Pending', staff.id, version=version)
+    commit_change(intake)
+    assert intake.status == 'Pending'
+    assert intake.version == version + 1
+
+
+def test_received_battery_can_be_updated_without_moving_on(intake, staff):
+    change_status(intake, 'Received', staff.id, 'price agreed', version=intake.version)
+    commit_change(intake)
+    assert intake.status == 'Received'
+
+
+def test_disallowed_transition_is_refused(intake, staff):
+    with pytest.raises(StatusConflict):
+        change_status(intake, 'Delivered', staff.id)
+
+
+def test_form_rendered_with_an_old_version_is_refused(intake, staff):
+    with pytest.raises(StatusConflict):
+        change_status(intake, 'Pending', staff.id, version=intake.version - 1)
+
+
+def test_concurrent_update_loses_instead_of_overwriting(intake, staff):
+    battery_id = intake.id
+    # This request has loaded the battery; another one moves it on meanwhile
+    other = _other_session()
+    try:
+        rival = other.get(Battery, battery_id)
+        rival.status = 'Ready'
+        other.commit()
+    finally:
+        other.close()
+
+    history_before = BatteryStatusHistory.query.filter_by(battery_id=battery_id).count()
+    # Still the version this session loaded, so only the UPDATE's WHERE version = ? can catch it
+    change_status(intake, 'Pending', staff.id)
+    with pytest.raises(StatusConflict):
+        commit_change(intake)
+
+    db.session.expire_all()
+    assert db.session.get(Battery, battery_id).status == 'Ready'
+    assert BatteryStatusHistory.query.filter_by(battery_id=battery_id).count() == history_before
@@ -0,0 +1,99 @@
+import pytest
+
+from app import db
+from models import Battery, BatteryStatusHistory
+import write_queue
+from write_queue import enqueue, list_entries, replay_pending
+
+INTAKE = {'customer_name': 'Queued Customer', 'mobile': '9800000002', 'mobile_secondary': '', 'battery_type': 'Car',
+          'voltage': '12V', 'capacity': '65Ah', 'is_pickup': False, 'pickup_charge': 0.0}
+
+
+@pytest.fixture(autouse=True)
+def empty_queue(app):
+    write_queue._connect().execute('DELETE FROM queued_write')
+    write_queue.mark_database_up()
+    yield
+
+
+def _entries():
+    return {entry['id']: entry for entry in list_entries()}
+
+
+def test_replay_applies_queued_writes_in_order(intake, staff):
+    # Replaying ends with a fresh session, so keep what is needed afterwards
+    battery_id = intake.id
+    intake_id = enqueue('intake', staff.id, INTAKE)
+    status_id = enqueue('status', staff.id, {'battery_id': intake.id, 'status': 'Pending', 'comments': 'queued',
+                                             'service_price': '', 'version': intake.version})
+
+    assert replay_pending() == 2
+
+    entries = _entries()
+    assert entries[intake_id]['state'] == 'applied'
+    assert entries[status_id]['state'] == 'applied'
+    assert Battery.query.filter_by(battery_id=entries[intake_id]['battery_id']).one().status == 'Received'
+    assert db.session.get(Battery, battery_id).status == 'Pending'
+
+
+def test_conflicting_write_is_marked_failed(intake, staff):
+    entry_id = enqueue('status', staff.id, {'battery_id': intake.id, 'status': 'Pending', 'comments': '',
+                                            'service_price': '', 'version': intake.version - 1})
+
+    assert replay_pending() == 0
+    assert _entries()[entry_id]['state'] == 'failed'
+
+
+def test_write_committed_before_the_connection_dropped_is_not_entered_twice(intake, staff):
+    from routes import record_status_update
+    battery_id, battery_code = intake.id, intake.battery_id
+    params = {'battery_id': battery_id, 'status': 'Pending', 'comments': 'once', 'service_price': '',
+              'version': intake.version}
+    # The first attempt committed, but its caller only saw the connection drop and queued it
+    record_status_update(staff.id, write_key='k' * 32, **params)
+    entry_id = enqueue('status', staff.id, params, write_key='k' * 32)
+
+    assert replay_pending() == 0
+
+    entry = _entries()[entry_id]
+    assert entry['state'] == 'applied'
+    assert entry['battery_id'] == battery_code
+    assert BatteryStatusHistory.query.filter_by(battery_id=battery_id, comments='once').count() == 1
+
+
+def _shop(code):
+    from models import Shop
+    shop = Shop.query.filter_by(code=code).first()
+    if shop is None:
+        shop = Shop(code=code, name=f'{code} Shop', battery_id_prefix=code[:4])
+        db.session.add(shop)
+        db.session.commit()
+    return shop.id
+
+
+def test_admins_bound_to_a_shop_only_see_and_retry_its_writes(app, staff):
+    from models import User
+    from shops import use_shop
+    shop_id, other_shop_id = _shop('QOWN'), _shop('QOTH')
+    admin = User.query.filter_by(username='queue_admin').first()
+    if admin is None:
+        admin = User(username='queue_admin', password_hash='-', role='admin', full_name='Queue Admin',
+                     shop_id=shop_id)
+        db.session.add(admin)
+        db.session.commit()
+    admin_id = admin.id
+    with use_shop(shop_id):
+        own_id = enqueue('intake', staff.id, dict(INTAKE, customer_name='Own Shop Customer'))
+    with use_shop(other_shop_id):
+        other_id = enqueue('intake', staff.id, dict(INTAKE, customer_name='Other Shop Customer'))
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin_id)
+        session['_fresh'] = True
+
+    page = client.get('/admin/write_queue').get_data(as_text=True)
+    assert 'Own Shop Customer' in page
+    assert 'Other Shop Customer' not in page
+    assert client.post('/admin/write_queue', data={'entry_id': other_id}).status_code == 404
+    assert client.post('/admin/write_queue', data={'entry_id': own_id}).status_code == 302
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Route-level benchmark suite.
+
+Exercises every GET route of the main blueprint (plus search POSTs and the
+export/backup/report background jobs, run synchronously) through the Flask
+test client against DATABASE_URL, and reports latency percentiles, SQL
+queries per request and peak Python memory per route. Results are saved as
+JSON so runs can be compared against a baseline.
+
+    DATABASE_URL=sqlite:////tmp/bench.db python tools/seed_data.py --batteries 100000
+    DATABASE_URL=sqlite:////tmp/bench.db python tools/bench_routes.py --output before.json
+    ... change code ...
+    DATABASE_URL=sqlite:////tmp/bench.db python tools/bench_routes.py --baseline before.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.engine import Engine  # noqa: E402
+
+from app import app, db  # noqa: E402
+from models import Battery  # noqa: E402
+import jobs  # noqa: E402
+
+# Endpoints that only redirect, need a job/profile name, or change data
+SKIP_ENDPOINTS = {
+    'main.index', 'main.staff_backup', 'main.export_csv', 'main.admin_backup', 'main.yearly_report',
+    'main.job_status', 'main.job_status_json', 'main.job_download',
+    'main.admin_profile_detail', 'main.admin_profile_download',
+}
+
+SEARCH_CASES = [
+    ('POST search (name)', '/search', {'search_query': 'Kumar'}),
+    ('POST search (battery id)', '/search', {'search_query': 'BAT00012'}),
+    ('POST technician_panel (mobile)', '/technician/panel', {'search_query': '98'}),
+]
+
+JOB_CASES = [
+    ('job export_csv', 'export_csv', {}),
+    ('job backup', 'backup', {}),
+    ('job yearly_report', 'yearly_report', {'year': datetime.now().year}),
+]
+
+_query_count = [0]
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    _query_count[0] += 1
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class BenchJobContext:
+    """Stands in for jobs.JobContext so handlers can run without a job row"""
+
+    def __init__(self, user_id, result_path):
+        self.id = 'bench'
+        self.user_id = user_id
+        self.result_path = result_path
+
+    def report(self, progress, message=None):
+        pass
+
+
+def discover_cases(sample_ids):
+    cases = []
+    for rule in sorted(app.url_map.iter_rules(), key=lambda r: r.rule):
+        if not rule.endpoint.startswith('main.') or rule.endpoint in SKIP_ENDPOINTS:
+            continue
+        if 'GET' not in rule.methods or not set(rule.arguments) <= {'battery_id'}:
+            continue
+        path = rule.rule
+        if 'battery_id' in rule.arguments:
+            sample = sample_ids['ready'] if rule.endpoint == 'main.bill' else sample_ids['any']
+            if sample is None:
+                continue
+            path = path.replace('<int:battery_id>', str(sample))
+        cases.append((f'GET {rule.endpoint}', 'GET', path, None))
+    for name, path, data in SEARCH_CASES:
+        cases.append((name, 'POST', path, data))
+    return cases
+
+
+def run_request(client, method, path, data):
+    response = client.open(path, method=method, data=data)
+    response.get_data()
+    return response.status_code
+
+
+def run_job(kind, params, user_id):
+    fd, result_path = tempfile.mkstemp(suffix='.bench')
+    os.close(fd)
+    try:
+        with app.app_context():
+            jobs.JOB_HANDLERS[kind]['func'](BenchJobContext(user_id, result_path), **params)
+        return 200
+    finally:
+        os.remove(result_path)
+
+
+def measure(func, iterations):
+    func()  # warm up caches and template compilation
+    timings, queries = [], []
+    status = None
+    for _ in range(iterations):
+        _query_count[0] = 0
+        start = time.perf_counter()
+        status = func()
+        timings.append((time.perf_counter() - start) * 1000)
+        queries.append(_query_count[0])
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'status': status,
+        'iterations': iterations,
+        'mean_ms': round(statistics.mean(timings), 2),
+        'p50_ms': round(percentile(timings, 50), 2),
+        'p95_ms': round(percentile(timings, 95), 2),
+        'p99_ms': round(percentile(timings, 99), 2),
+        'queries': round(statistics.mean(queries), 1),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    print(f'\n{"route":<42} {"p50 ms":>10} {"base":>10} {"change":>8} {"queries":>8} {"base":>6}')
+    for name, result in results['routes'].items():
+        base = baseline.get('routes', {}).get(name)
+        if not base:
+            print(f'{name:<42} {result["p50_ms"]:>10} {"-":>10} {"new":>8} {result["queries"]:>8} {"-":>6}')
+            continue
+        change = (result['p50_ms'] - base['p50_ms']) / base['p50_ms'] * 100 if base['p50_ms'] else 0
+        print(f'{name:<42} {result["p50_ms"]:>10} {base["p50_ms"]:>10} {change:>+7.1f}% '
+              f'{result["queries"]:>8} {base["queries"]:>6}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--only', help='Only run cases whose name contains this text')
+    parser.add_argument('--skip-jobs', action='store_true', help='Skip the export/backup/report jobs')
+    parser.add_argument('--output', help='Where to save the JSON results')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    event.listen(Engine, 'before_cursor_execute', _count_query)
+    client = app.test_client()
+    login = client.post('/login', data={'username': args.username, 'password': args.password})
+    if login.status_code != 302:
+        raise SystemExit(f'Login as {args.username} failed')
+
+    with app.app_context():
+        from models import User
+        user_id = User.query.filter_by(username=args.username).first().id
+        battery_count = Battery.query.count()
+        ready = Battery.query.filter_by(status='Ready').order_by(Battery.id.desc()).first()
+        middle = db.session.get(Battery, max(1, battery_count // 2)) or Battery.query.first()
+        sample_ids = {'ready': ready.id if ready else None, 'any': middle.id if middle else None}
+        dialect = db.engine.dialect.name
+
+    cases = [(name, lambda m=method, p=path, d=data: run_request(client, m, p, d))
+             for name, method, path, data in discover_cases(sample_ids)]
+    if not args.skip_jobs:
+        cases += [(name, lambda k=kind, p=params: run_job(k, p, user_id)) for name, kind, params in JOB_CASES]
+    if args.only:
+        cases = [(name, func) for name, func in cases if args.only in name]
+
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'commit': git_commit(),
+            'database': dialect,
+            'batteries': battery_count,
+            'iterations': args.iterations,
+        },
+        'routes': {},
+    }
+
+    print(f'Benchmarking {len(cases)} cases against {battery_count:,} batteries ({dialect})')
+    print(f'{"route":<42} {"status":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"queries":>8} {"peak KB":>10}')
+    for name, func in cases:
+        result = measure(func, args.iterations)
+        results['routes'][name] = result
+        print(f'{name:<42} {result["status"]:>6} {result["p50_ms"]:>9} {result["p95_ms"]:>9} '
+              f'{result["p99_ms"]:>9} {result["queries"]:>8} {result["peak_kb"]:>10}', flush=True)
+
+    output = args.output or os.path.join(
+        app.instance_path, 'benchmarks', f'routes_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'\nSaved results to {output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
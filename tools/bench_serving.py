@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Compare serving profiles by hammering a running instance with concurrent clients.
+
+Each client logs in with its own session and requests the given paths in a
+loop until the duration is up. Prints throughput, error count and latency
+percentiles so two runs (e.g. the old --reload profile and gunicorn_config.py)
+can be compared side by side. Uses only the standard library.
+
+    python tools/bench_serving.py --url http://localhost:5000 --clients 16 --duration 30
+    python tools/bench_serving.py --path /delivered_batteries --accept-encoding gzip
+
+Latency is measured to the last byte of the body; mean_bytes is what went
+over the wire (bodies are not decompressed).
+"""
+import argparse
+import http.cookiejar
+import json
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+DEFAULT_PATHS = ['/dashboard', '/technician/panel', '/search', '/finished_batteries', '/all_batteries']
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def make_client(base_url, username, password):
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    data = urllib.parse.urlencode({'username': username, 'password': password}).encode()
+    opener.open(base_url + '/login', data=data, timeout=30).read()
+    return opener
+
+
+def run_client(opener, base_url, paths, deadline, results, lock, accept_encoding=None):
+    latencies = []
+    sizes = []
+    errors = 0
+    headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+    i = 0
+    while time.monotonic() < deadline:
+        path = paths[i % len(paths)]
+        i += 1
+        start = time.monotonic()
+        try:
+            with opener.open(urllib.request.Request(base_url + path, headers=headers), timeout=60) as response:
+                size = len(response.read())
+        except (urllib.error.URLError, OSError):
+            errors += 1
+            continue
+        latencies.append((time.monotonic() - start) * 1000)
+        sizes.append(size)
+    with lock:
+        results['latencies'].extend(latencies)
+        results['sizes'].extend(sizes)
+        results['errors'] += errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--path', action='append', dest='paths', help='Path to request (repeatable)')
+    parser.add_argument('--accept-encoding', help='Accept-Encoding to send, e.g. "gzip" or "gzip, br" (default: none)')
+    parser.add_argument('--label', default='', help='Name for this run in the JSON output')
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip('/')
+    paths = args.paths or DEFAULT_PATHS
+    openers = [make_client(base_url, args.username, args.password) for _ in range(args.clients)]
+
+    results = {'latencies': [], 'sizes': [], 'errors': 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=run_client, args=(opener, base_url, paths, deadline, results, lock, args.accept_encoding))
+        for opener in openers
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies = results['latencies']
+    summary = {
+        'label': args.label,
+        'clients': args.clients,
+        'duration_s': round(elapsed, 2),
+        'requests': len(latencies),
+        'errors': results['errors'],
+        'requests_per_s': round(len(latencies) / elapsed, 2) if elapsed else 0,
+        'mean_ms': round(statistics.mean(latencies), 2) if latencies else 0,
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'accept_encoding': args.accept_encoding or '',
+        'mean_bytes': round(statistics.mean(results['sizes'])) if results['sizes'] else 0,
+    }
+
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        for key, value in summary.items():
+            print(f'{key:>16}: {value}')
+
+
+if __name__ == '__main__':
+    main()
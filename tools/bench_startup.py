@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark: first-request latency of a fresh process, cold versus warm.
+
+Each scenario runs in a new Python process (like a freshly forked or
+restarted worker) that imports the app, logs in through the Flask test
+client and requests every path once, then once more. The first pass pays
+for whatever is not ready yet; the second pass is the steady state.
+
+- cold: no bytecode cache, no warm-up; every template is compiled on its first hit
+- bytecode: templates loaded from instance/template_cache on first hit
+- warm: the production default; every template loaded at boot (from the bytecode cache)
+
+    DATABASE_URL=sqlite:////tmp/bench.db python tools/seed_data.py --batteries 1000
+    DATABASE_URL=sqlite:////tmp/bench.db python tools/bench_startup.py
+
+instance/template_cache is cleared first so the bytecode scenarios start
+from a cache filled by a single earlier process.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_PATHS = ['/dashboard', '/technician/panel', '/search', '/finished_batteries', '/all_batteries',
+                 '/delivered_batteries', '/all_bills', '/reports/monthly', '/admin/users', '/admin/settings']
+
+SCENARIOS = [
+    ('cold', {'TEMPLATE_CACHE_ENABLED': '0', 'TEMPLATE_WARMUP': '0'}),
+    ('bytecode', {'TEMPLATE_CACHE_ENABLED': '1', 'TEMPLATE_WARMUP': '0'}),
+    ('warm', {'TEMPLATE_CACHE_ENABLED': '1', 'TEMPLATE_WARMUP': '1'}),
+]
+
+
+def child(paths, username, password):
+    """Runs in the scenario's own process; prints its timings as JSON"""
+    started = time.perf_counter()
+    sys.path.insert(0, ROOT)
+    from main import app
+    boot_ms = (time.perf_counter() - started) * 1000
+
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': password})
+    passes = []
+    for _ in range(2):
+        timings = {}
+        for path in paths:
+            request_started = time.perf_counter()
+            response = client.get(path)
+            timings[path] = round((time.perf_counter() - request_started) * 1000, 1)
+            if response.status_code != 200:
+                timings[path] = None
+        passes.append(timings)
+    print(json.dumps({'boot_ms': round(boot_ms, 1), 'first': passes[0], 'second': passes[1]}))
+
+
+def run_scenario(settings, args):
+    env = dict(os.environ, **settings)
+    command = [sys.executable, os.path.abspath(__file__), '--child', '--username', args.username,
+               '--password', args.password] + [arg for path in args.paths for arg in ('--path', path)]
+    output = subprocess.run(command, env=env, cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def total(timings):
+    return round(sum(value for value in timings.values() if value is not None), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='admin123')
+    parser.add_argument('--path', action='append', dest='paths', help='Path to request (repeatable)')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+    args.paths = args.paths or DEFAULT_PATHS
+
+    if args.child:
+        child(args.paths, args.username, args.password)
+        return
+
+    shutil.rmtree(os.path.join(ROOT, 'instance', 'template_cache'), ignore_errors=True)
+    # One process fills the bytecode cache, as the first worker after a deploy would
+    run_scenario({'TEMPLATE_CACHE_ENABLED': '1', 'TEMPLATE_WARMUP': '1'}, args)
+
+    results = {name: run_scenario(settings, args) for name, settings in SCENARIOS}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f'{"scenario":<10} {"boot ms":>9} {"first pass ms":>14} {"second pass ms":>15}')
+    for name, result in results.items():
+        print(f'{name:<10} {result["boot_ms"]:>9.1f} {total(result["first"]):>14.1f} {total(result["second"]):>15.1f}')
+    print()
+    print(f'{"first hit ms":<22}' + ''.join(f'{name:>10}' for name in results))
+    for path in args.paths:
+        cells = ''.join(f'{"-" if result["first"][path] is None else result["first"][path]:>10}' for result in results.values())
+        print(f'{path:<22}{cells}')
+
+
+if __name__ == '__main__':
+    main()
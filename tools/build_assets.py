@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Build the fingerprinted, precompressed static assets served from /assets.
+
+Every file under static/ (except static/dist) is minified if it is CSS or
+JavaScript that is not already minified, written to static/dist under a name
+with a content hash (offline-styles.css -> offline-styles.3f2a9c1b7e.css),
+and text files are precompressed to .gz and, when the brotli module is
+installed, .br. url() references inside stylesheets are rewritten to the
+hashed names. static/dist/manifest.json maps the original names to the
+hashed ones for assets.asset_url.
+
+--fetch first downloads the vendored Bootstrap and Font Awesome files listed
+in assets.VENDOR_ASSETS (with the fonts their stylesheets reference) into
+static/vendor. Commit static/vendor afterwards so builds work offline.
+
+The build fails while any vendored file is missing, since pages built
+without them lose their styling and modals offline; --allow-missing builds
+anyway, for development without network access.
+
+    python tools/build_assets.py --fetch
+    python tools/build_assets.py
+
+Restart the app after a build so it reads the new manifest.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import urllib.parse
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from assets import DIST_DIR, MANIFEST_NAME, VENDOR_ASSETS  # noqa: E402
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static')
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.map', '.ttf', '.eot')
+URL_RE = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def fetch(refresh=False):
+    """Download the vendored assets (and the files their stylesheets reference) into static/"""
+    pending = list(VENDOR_ASSETS.items())
+    while pending:
+        name, url = pending.pop(0)
+        path = os.path.join(STATIC_DIR, name)
+        if refresh or not os.path.exists(path):
+            print(f'  fetching {url}')
+            try:
+                with urllib.request.urlopen(url, timeout=60) as response:
+                    data = response.read()
+            except OSError as e:
+                sys.exit(f'Could not fetch {url}: {e}')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+        if name.endswith('.css'):
+            with open(path, encoding='utf-8') as f:
+                css = f.read()
+            for _, ref in URL_RE.findall(css):
+                if ref.startswith(('data:', 'http:', 'https:', '//', '#')):
+                    continue
+                ref = ref.split('?')[0].split('#')[0]
+                target = os.path.normpath(os.path.join(os.path.dirname(name), ref)).replace(os.sep, '/')
+                if target not in dict(pending) and target not in VENDOR_ASSETS:
+                    pending.append((target, urllib.parse.urljoin(url, ref)))
+
+
+def missing_vendor_assets():
+    """Vendored files (and fonts their stylesheets reference) not present under static/"""
+    missing = []
+    for name in VENDOR_ASSETS:
+        path = os.path.join(STATIC_DIR, name)
+        if not os.path.exists(path):
+            missing.append(name)
+            continue
+        if name.endswith('.css'):
+            with open(path, encoding='utf-8') as f:
+                css = f.read()
+            for _, ref in URL_RE.findall(css):
+                if ref.startswith(('data:', 'http:', 'https:', '//', '#')):
+                    continue
+                ref = ref.split('?')[0].split('#')[0]
+                target = os.path.normpath(os.path.join(os.path.dirname(name), ref)).replace(os.sep, '/')
+                if not os.path.exists(os.path.join(STATIC_DIR, target)) and target not in missing:
+                    missing.append(target)
+    return missing
+
+
+def minify_css(css):
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def minify_js(js):
+    # Conservative: drop comment-only lines, indentation and blank lines but keep
+    # line breaks, so automatic semicolon insertion still sees the same code
+    lines = (line.strip() for line in js.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//')) + '\n'
+
+
+def rewrite_urls(css, name, manifest):
+    """Point url() references in a stylesheet at the hashed files"""
+    def replace(match):
+        quote, ref = match.groups()
+        if ref.startswith(('data:', 'http:', 'https:', '//', '#')):
+            return match.group(0)
+        path, suffix = re.match(r'([^?#]*)(.*)', ref).groups()
+        target = os.path.normpath(os.path.join(os.path.dirname(name), path)).replace(os.sep, '/')
+        if target not in manifest:
+            return match.group(0)
+        hashed = os.path.relpath(manifest[target], os.path.dirname(name) or '.').replace(os.sep, '/')
+        return f'url({quote}{hashed}{suffix}{quote})'
+    return URL_RE.sub(replace, css)
+
+
+def hashed_name(name, data):
+    digest = hashlib.sha256(data).hexdigest()[:10]
+    root, ext = os.path.splitext(name)
+    if root.endswith('.min'):
+        root, ext = root[:-4], '.min' + ext
+    return f'{root}.{digest}{ext}'
+
+
+def collect():
+    """Source files under static/ by their path relative to it, stylesheets last"""
+    names = []
+    for root, dirs, files in os.walk(STATIC_DIR):
+        if os.path.relpath(root, STATIC_DIR) == '.':
+            dirs[:] = [d for d in dirs if d != DIST_DIR]
+        for filename in files:
+            if filename.startswith('.') or filename.endswith('.bak'):
+                continue
+            names.append(os.path.relpath(os.path.join(root, filename), STATIC_DIR).replace(os.sep, '/'))
+    return sorted(names, key=lambda name: (name.endswith('.css'), name))
+
+
+def build():
+    dist = os.path.join(STATIC_DIR, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    totals = {'files': 0, 'bytes': 0, 'gzip': 0, 'brotli': 0}
+
+    for name in collect():
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            data = f.read()
+        if name.endswith('.css'):
+            css = data.decode('utf-8')
+            if not name.endswith('.min.css'):
+                css = minify_css(css)
+            data = rewrite_urls(css, name, manifest).encode('utf-8')
+        elif name.endswith('.js') and not name.endswith('.min.js'):
+            data = minify_js(data.decode('utf-8')).encode('utf-8')
+
+        hashed = hashed_name(name, data)
+        path = os.path.join(dist, hashed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        manifest[name] = hashed
+        totals['files'] += 1
+        totals['bytes'] += len(data)
+
+        if name.endswith(COMPRESSIBLE):
+            variants = [('.gz', 'gzip', gzip.compress(data, 9, mtime=0))]
+            if brotli is not None:
+                variants.append(('.br', 'brotli', brotli.compress(data, quality=11)))
+            for suffix, key, compressed in variants:
+                # Only kept when it actually saves something
+                if len(compressed) < len(data):
+                    with open(path + suffix, 'wb') as f:
+                        f.write(compressed)
+                    totals[key] += len(compressed)
+
+    with open(os.path.join(dist, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest, totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fetch', action='store_true', help='Download missing vendored assets first')
+    parser.add_argument('--refresh', action='store_true', help='With --fetch, download them again even if present')
+    parser.add_argument('--allow-missing', action='store_true', help='Build even if vendored assets are missing')
+    args = parser.parse_args()
+
+    if args.fetch:
+        print('Fetching vendored assets...')
+        fetch(args.refresh)
+    missing = missing_vendor_assets()
+    if missing:
+        message = f'vendored assets missing (run with --fetch and commit static/vendor): {", ".join(missing)}'
+        if not args.allow_missing:
+            sys.exit(f'Error: {message}')
+        print(f'Warning: {message}')
+
+    manifest, totals = build()
+    print(f'Built {totals["files"]} assets into static/{DIST_DIR} ({totals["bytes"]} bytes, '
+          f'{totals["gzip"]} gzipped' + (f', {totals["brotli"]} brotli' if brotli else ', brotli not installed') + ')')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Replayable shop-day load test against a running instance.
+
+Simulates concurrent sessions doing a configurable mix of intake, technician
+search and status update, delivery, dashboard, report and export actions,
+each logged in as the seeded role that would do it (staff, technician or
+admin). Reports throughput, error rate and latency percentiles per action,
+which is what we need to size gunicorn workers and the database pool.
+
+Every session draws its actions and think times from its own seeded random
+generator, so the same --seed replays the same day. --record saves the
+actions actually issued; --replay re-issues a recorded schedule exactly.
+
+    python tools/load_test.py --url http://localhost:5000 --sessions 12 --duration 120
+    python tools/load_test.py --sessions 12 --duration 120 --record day.jsonl
+    python tools/load_test.py --replay day.jsonl
+
+Intake and delivery create and change records; run it against a scratch
+database (see tools/seed_data.py), never production.
+"""
+import argparse
+import json
+import random
+import re
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+
+from bench_serving import make_client, percentile
+
+DEFAULT_MIX = {
+    'intake': 15,
+    'tech_search': 25,
+    'tech_update': 20,
+    'delivery': 10,
+    'dashboard': 15,
+    'report': 10,
+    'export': 5,
+}
+
+ACTION_ROLES = {
+    'intake': 'staff',
+    'tech_search': 'technician',
+    'tech_update': 'technician',
+    'delivery': 'staff',
+    'dashboard': 'staff',
+    'report': 'admin',
+    'export': 'admin',
+}
+
+DEFAULT_CREDENTIALS = {
+    'admin': ('admin', 'admin123'),
+    'staff': ('staff', 'staff123'),
+    'technician': ('technician', 'tech123'),
+}
+
+BATTERY_FORM_RE = re.compile(r'name="battery_id" value="(\d+)"')
+BILL_LINK_RE = re.compile(r'/bill/(\d+)')
+JOB_ID_RE = re.compile(r'/jobs/([0-9a-f]{32})')
+ERROR_MARKER = 'alert-danger'
+
+BATTERY_TYPES = ['Car Battery', 'Bike Battery', 'Inverter Battery', 'UPS Battery']
+SEARCH_TERMS = ['BAT', 'Kumar', '98', 'Priya', 'BAT00', '9']
+
+
+class ActionError(Exception):
+    pass
+
+
+class Session:
+    def __init__(self, base_url, credentials, rng):
+        self.base_url = base_url
+        self.rng = rng
+        self.openers = {role: make_client(base_url, *credentials[role]) for role in set(ACTION_ROLES.values())}
+
+    def request(self, role, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        with self.openers[role].open(self.base_url + path, data=body, timeout=120) as response:
+            text = response.read().decode('utf-8', errors='replace')
+            return response.geturl(), text
+
+    def check(self, text):
+        if ERROR_MARKER in text:
+            raise ActionError('page reported an error')
+
+    def intake(self):
+        _, text = self.request('staff', '/battery/entry', {
+            'customer_name': f'Load Test {self.rng.randrange(10000)}',
+            'mobile': f'9{self.rng.randrange(10**8, 10**9):09d}',
+            'battery_type': self.rng.choice(BATTERY_TYPES),
+            'voltage': '12V',
+            'capacity': self.rng.choice(['35Ah', '65Ah', '100Ah']),
+        })
+        self.check(text)
+
+    def tech_search(self):
+        _, text = self.request('technician', '/technician/panel', {'search_query': self.rng.choice(SEARCH_TERMS)})
+        self.check(text)
+
+    def tech_update(self):
+        _, text = self.request('technician', '/technician/panel', {'search_query': ''})
+        ids = BATTERY_FORM_RE.findall(text)
+        if not ids:
+            return
+        _, text = self.request('technician', '/battery/update', {
+            'battery_id': self.rng.choice(ids),
+            'status': self.rng.choice(['Pending', 'Ready', 'Ready', 'Not Repairable']),
+            'comments': 'Load test update',
+            'service_price': str(self.rng.choice([350, 500, 750, 1200])),
+        })
+        self.check(text)
+
+    def delivery(self):
+        _, text = self.request('staff', '/finished_batteries')
+        ids = BILL_LINK_RE.findall(text)
+        if not ids:
+            return
+        _, text = self.request('staff', f'/battery/{self.rng.choice(ids)}/mark_delivered', {
+            'delivery_type': self.rng.choice(['delivered', 'delivered', 'returned']),
+            'comments': 'Load test delivery',
+        })
+        self.check(text)
+
+    def dashboard(self):
+        _, text = self.request('staff', '/dashboard')
+        self.check(text)
+
+    def report(self):
+        if self.rng.random() < 0.5:
+            _, text = self.request('admin', '/reports/monthly')
+            self.check(text)
+        else:
+            self.run_job('/reports/yearly')
+
+    def export(self):
+        self.run_job('/export/csv')
+
+    def run_job(self, path):
+        url, _ = self.request('admin', path)
+        match = JOB_ID_RE.search(url)
+        if not match:
+            raise ActionError(f'{path} did not start a job')
+        job_id = match.group(1)
+        deadline = time.monotonic() + 300
+        while time.monotonic() < deadline:
+            _, text = self.request('admin', f'/jobs/{job_id}/status')
+            status = json.loads(text)
+            if status['status'] == 'failed':
+                raise ActionError(f'job failed: {status.get("message")}')
+            if status['status'] == 'finished':
+                if status.get('download_url'):
+                    self.request('admin', status['download_url'])
+                return
+            time.sleep(0.5)
+        raise ActionError('job did not finish in time')
+
+
+def plan_session(rng, mix, duration, think_time):
+    """The (offset, action) schedule one session follows"""
+    actions = list(mix)
+    weights = [mix[action] for action in actions]
+    schedule = []
+    offset = rng.uniform(0, think_time)
+    while offset < duration:
+        schedule.append((round(offset, 3), rng.choices(actions, weights)[0]))
+        offset += rng.expovariate(1 / think_time) if think_time else 0.001
+    return schedule
+
+
+def run_session(index, session, schedule, started, results, lock):
+    for offset, action in schedule:
+        delay = started + offset - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        begin = time.monotonic()
+        error = None
+        try:
+            getattr(session, action)()
+        except (ActionError, urllib.error.URLError, OSError, ValueError) as e:
+            error = str(e)
+        latency = (time.monotonic() - begin) * 1000
+        with lock:
+            results.append({
+                'session': index,
+                'offset': offset,
+                'action': action,
+                'latency_ms': round(latency, 2),
+                'error': error,
+            })
+
+
+def summarise(results, elapsed):
+    summary = {}
+    for action in sorted({r['action'] for r in results}):
+        rows = [r for r in results if r['action'] == action]
+        latencies = [r['latency_ms'] for r in rows]
+        errors = sum(1 for r in rows if r['error'])
+        summary[action] = {
+            'count': len(rows),
+            'per_minute': round(len(rows) / elapsed * 60, 1),
+            'error_rate': round(errors / len(rows), 4),
+            'mean_ms': round(statistics.mean(latencies), 1),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'max_ms': round(max(latencies), 1),
+        }
+    return summary
+
+
+def parse_mix(text):
+    mix = dict(DEFAULT_MIX)
+    if text:
+        mix = {}
+        for part in text.split(','):
+            action, _, weight = part.partition('=')
+            if action.strip() not in ACTION_ROLES:
+                raise SystemExit(f'Unknown action in --mix: {action}')
+            mix[action.strip()] = float(weight or 1)
+    return {action: weight for action, weight in mix.items() if weight > 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--sessions', type=int, default=8, help='Concurrent sessions (desks)')
+    parser.add_argument('--duration', type=float, default=60, help='Seconds to run')
+    parser.add_argument('--think-time', type=float, default=2.0, help='Mean seconds between actions per session')
+    parser.add_argument('--mix', help='Action weights, e.g. intake=20,tech_search=30,export=2 '
+                                      f'(actions: {", ".join(ACTION_ROLES)})')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--record', help='Write every issued action to this JSONL file')
+    parser.add_argument('--replay', help='Re-issue the schedule from a --record file')
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+    args = parser.parse_args()
+
+    base_url = args.url.rstrip('/')
+    if args.replay:
+        schedules = {}
+        with open(args.replay) as f:
+            for line in f:
+                row = json.loads(line)
+                schedules.setdefault(row['session'], []).append((row['offset'], row['action']))
+        schedules = [sorted(schedules[index]) for index in sorted(schedules)]
+        duration = max((s[-1][0] for s in schedules if s), default=0)
+    else:
+        mix = parse_mix(args.mix)
+        schedules = [plan_session(random.Random(f'{args.seed}-{index}'), mix, args.duration, args.think_time)
+                     for index in range(args.sessions)]
+        duration = args.duration
+
+    print(f'Logging in {len(schedules)} sessions...', flush=True)
+    sessions = [Session(base_url, DEFAULT_CREDENTIALS, random.Random(f'{args.seed}-data-{index}'))
+                for index in range(len(schedules))]
+
+    results = []
+    lock = threading.Lock()
+    started = time.monotonic()
+    threads = [
+        threading.Thread(target=run_session, args=(index, session, schedule, started, results, lock))
+        for index, (session, schedule) in enumerate(zip(sessions, schedules))
+    ]
+    print(f'Running {sum(len(s) for s in schedules)} actions over {duration:.0f}s...', flush=True)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = max(time.monotonic() - started, duration, 0.001)
+
+    if args.record:
+        with open(args.record, 'w') as f:
+            for row in sorted(results, key=lambda r: (r['session'], r['offset'])):
+                f.write(json.dumps(row) + '\n')
+
+    summary = summarise(results, elapsed) if results else {}
+    total_errors = sum(1 for r in results if r['error'])
+    if args.json:
+        print(json.dumps({'elapsed_s': round(elapsed, 1), 'actions': summary}))
+        return
+
+    print(f'\n{"action":<12} {"count":>6} {"/min":>7} {"errors":>7} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9}')
+    for action, row in summary.items():
+        print(f'{action:<12} {row["count"]:>6} {row["per_minute"]:>7} {row["error_rate"] * 100:>6.1f}% '
+              f'{row["p50_ms"]:>9} {row["p95_ms"]:>9} {row["p99_ms"]:>9} {row["max_ms"]:>9}')
+    print(f'\n{len(results)} actions in {elapsed:.1f}s '
+          f'({len(results) / elapsed:.2f}/s), {total_errors} errors')
+    for row in [r for r in results if r['error']][:5]:
+        print(f'  {row["action"]}: {row["error"]}')
+
+
+if __name__ == '__main__':
+    main()
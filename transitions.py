@@ -0,0 +1,84 @@
+"""
+Battery status changes: the state machine and optimistic concurrency.
+
+Battery rows carry a ``version`` (SQLAlchemy's ``version_id_col``), so every
+ORM UPDATE of a battery is ``... WHERE id = ? AND version = ?`` and bumps
+it. If another request changed the battery after this one loaded it, no row
+matches and the flush raises StaleDataError instead of silently overwriting
+that change. No row locks are taken, so a technician and the counter
+working on different batteries never wait on each other.
+
+The forms that change a status send the version the page was rendered
+with, so a change made by someone else while the page was open (the
+counter marks a battery Delivered while the technician still has it on
+screen as Ready) is caught as well. Every change is checked against
+STATUS_TRANSITIONS first.
+"""
+from sqlalchemy.orm.attributes import flag_modified
+from sqlalchemy.orm.exc import StaleDataError
+
+from app import db
+from models import BatteryStatusHistory
+
+# Status -> statuses a battery can be moved to from it. Listing a status for itself allows
+# updating price and comments without moving on; finished batteries go back to Pending for warranty work.
+STATUS_TRANSITIONS = {
+    'Received': ('Received', 'Pending', 'Ready', 'Not Repairable'),
+    'Pending': ('Pending', 'Ready', 'Not Repairable'),
+    'Ready': ('Pending', 'Ready', 'Not Repairable', 'Delivered', 'Returned'),
+    'Delivered': ('Pending',),
+    'Returned': ('Pending',),
+    'Not Repairable': (),
+}
+
+
+class StatusConflict(Exception):
+    """The battery was changed by someone else, or can't be moved to the requested status"""
+
+
+def can_transition(battery, status):
+    return status in STATUS_TRANSITIONS.get(battery.status, ())
+
+
+def parse_version(value):
+    """The version a form was rendered with, or None when it didn't send one"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def change_status(battery, status, user_id, comments='', version=None, from_statuses=None):
+    """Move ``battery`` to ``status`` and add the history entry; the caller commits with ``commit_change()``.
+
+    Raises StatusConflict when ``version`` (what the user saw) is no longer
+    current or the state machine does not allow the move; ``from_statuses``
+    narrows the statuses the move is allowed from further.
+    """
+    if version is not None and version != battery.version:
+        raise StatusConflict(f'Battery {battery.battery_id} was changed by someone else and is now '
+                             f'{battery.status}. Please check it and try again.')
+    if not can_transition(battery, status) or (from_statuses and battery.status not in from_statuses):
+        raise StatusConflict(f'Battery {battery.battery_id} is {battery.status} and cannot be moved to {status}.')
+    battery.status = status
+    # Even a same-status update goes through the versioned UPDATE, so it can't land after a newer change
+    flag_modified(battery, 'status')
+
+    history = BatteryStatusHistory()
+    history.battery_id = battery.id
+    history.status = status
+    history.comments = comments
+    history.updated_by = user_id
+    db.session.add(history)
+    return history
+
+
+def commit_change(battery):
+    """Commit, turning a battery updated concurrently since it was loaded into StatusConflict"""
+    battery_id = battery.battery_id
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        raise StatusConflict(f'Battery {battery_id} was changed by someone else at the same time. '
+                             f'Please check it and try again.')
@@ -0,0 +1,387 @@
+"""
+Degraded mode: a local write-ahead queue for when the database is unreachable.
+
+A failed or refused connection to the primary (the engine's ``handle_error``
+hook, as for the replica) marks the database down for this worker for
+WRITE_QUEUE_RETRY_SECONDS. Meanwhile no request waits on it:
+
+- intakes, status updates and notes (the views passed to ``apply_or_queue``)
+  are journalled to a SQLite file in WAL mode (WRITE_QUEUE_PATH, shared by
+  the workers on this server) and acknowledged at once with a provisional
+  ID (``Q12``); views marked ``@works_offline`` run as usual;
+- every other page answers with the offline page (503), without trying the
+  database;
+- the logged-in user comes from a copy kept in their session cookie.
+
+While anything is waiting, new writes queue behind it, so writes reach the
+database in the order they were made. A replayer thread in each worker (one
+at a time, under a file lock) applies the queue in order every
+WRITE_QUEUE_REPLAY_SECONDS, through the same handlers the views use, and
+stops at the first connection error. A write the database rejects (e.g. a
+status change that conflicts with one made meanwhile) is marked failed and
+shown under Admin > Offline Queue, where it can be retried.
+
+A write that failed as the connection dropped may have been committed
+after all. Each write therefore gets a key before its first attempt, stored
+on the history row or note it creates (``write_key``, unique); a queued
+write whose key is already in the database is marked applied rather than
+entered a second time.
+
+    flask --app main replay-writes
+"""
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import click
+from flask import current_app, render_template, request, session
+from flask_login import UserMixin
+from sqlalchemy import event, select
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from werkzeug.exceptions import HTTPException
+
+from app import db
+from models import Battery, BatteryStatusHistory, BatteryStaffNote
+
+logger = logging.getLogger('write_queue')
+
+# kind -> function(user_id, write_key=..., **params) that applies and commits the write, returning the
+# battery; it stores write_key on the row it creates
+WRITE_HANDLERS = {}
+
+# Rows carrying the write_key of the write that created them
+KEYED_MODELS = (BatteryStatusHistory, BatteryStaffNote)
+
+# Endpoints served while the database is down besides the @works_offline views
+OFFLINE_ENDPOINTS = {'static', 'assets.asset', 'auth.logout'}
+
+USER_SESSION_KEY = 'offline_user'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queued_write (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    params TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    shop_id INTEGER,
+    created_at TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    battery_id TEXT,
+    message TEXT,
+    applied_at TEXT,
+    write_key TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_queued_write_state ON queued_write (state, id);
+"""
+
+_settings = {'retry_seconds': 15}
+_down_until = 0.0
+_local = threading.local()
+_replayer = None
+_replayer_lock = threading.Lock()
+_wake = threading.Event()
+
+
+def write_handler(kind):
+    """Register a function that applies (and commits) a write of this kind"""
+    def decorator(func):
+        WRITE_HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def works_offline(view):
+    """Mark a view as usable while the database is down (it must not query it then)"""
+    view.works_offline = True
+    return view
+
+
+def provisional_id(entry_id):
+    return f'Q{entry_id}'
+
+
+def database_down():
+    """Whether the primary failed recently, so requests should not wait on it"""
+    return time.monotonic() < _down_until
+
+
+def mark_database_down():
+    global _down_until
+    if not database_down():
+        logger.warning('Database unreachable; queueing writes locally')
+    _down_until = time.monotonic() + _settings['retry_seconds']
+
+
+def mark_database_up():
+    global _down_until
+    if _down_until:
+        logger.info('Database reachable again')
+    _down_until = 0.0
+
+
+def _connect():
+    path = current_app.config.get('WRITE_QUEUE_PATH') or os.path.join(current_app.instance_path, 'write_queue.sqlite')
+    conn = getattr(_local, 'conn', None)
+    if conn is None or _local.path != path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        # Readers never block the writer; an acknowledged write survives a crash of the process
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.executescript(SCHEMA)
+        if 'write_key' not in {row['name'] for row in conn.execute('PRAGMA table_info(queued_write)')}:
+            # Queue files from before write keys; their entries replay without one
+            conn.execute('ALTER TABLE queued_write ADD COLUMN write_key TEXT')
+        _local.conn, _local.path = conn, path
+    return conn
+
+
+def has_pending():
+    if not current_app.config.get('WRITE_QUEUE_ENABLED', True):
+        return False
+    return _connect().execute("SELECT 1 FROM queued_write WHERE state = 'pending' LIMIT 1").fetchone() is not None
+
+
+def new_write_key():
+    return uuid.uuid4().hex
+
+
+def enqueue(kind, user_id, params, write_key=None):
+    """Journal a write for the replayer; returns its queue id"""
+    from shops import current_shop_id
+    entry_id = _connect().execute(
+        'INSERT INTO queued_write (kind, params, user_id, shop_id, created_at, write_key) VALUES (?, ?, ?, ?, ?, ?)',
+        (kind, json.dumps(params), user_id, current_shop_id(), datetime.utcnow().isoformat(timespec='seconds'),
+         write_key or new_write_key())
+    ).lastrowid
+    logger.info(f'Queued {kind} write {provisional_id(entry_id)}')
+    if not database_down():
+        _wake.set()
+    return entry_id
+
+
+def apply_or_queue(kind, user_id, params):
+    """Apply a write now, or journal it when the database is down or earlier writes are still waiting.
+
+    Returns ``(battery, None)`` when applied, ``(None, queue id)`` when queued.
+    """
+    write_key = new_write_key()
+    if not current_app.config.get('WRITE_QUEUE_ENABLED', True):
+        return WRITE_HANDLERS[kind](user_id, write_key=write_key, **params), None
+    if database_down() or has_pending():
+        return None, enqueue(kind, user_id, params, write_key)
+    try:
+        return WRITE_HANDLERS[kind](user_id, write_key=write_key, **params), None
+    except DBAPIError:
+        db.session.rollback()
+        if not database_down():
+            raise
+        # Under the same key, in case the commit got through before the connection dropped
+        return None, enqueue(kind, user_id, params, write_key)
+
+
+def queue_status():
+    """For the banner in base.html: whether the database is down and how many writes are waiting"""
+    if not current_app.config.get('WRITE_QUEUE_ENABLED', True):
+        return {'offline': False, 'pending': 0}
+    pending = _connect().execute("SELECT COUNT(*) FROM queued_write WHERE state = 'pending'").fetchone()[0]
+    return {'offline': database_down(), 'pending': pending}
+
+
+def _entry(row):
+    return dict(row, params=json.loads(row['params']), provisional_id=provisional_id(row['id']))
+
+
+def list_entries(shop_id=None, limit=200):
+    """The latest queued writes, of one shop's users when ``shop_id`` is given"""
+    if shop_id is None:
+        rows = _connect().execute('SELECT * FROM queued_write ORDER BY id DESC LIMIT ?', (limit,)).fetchall()
+    else:
+        rows = _connect().execute('SELECT * FROM queued_write WHERE shop_id = ? ORDER BY id DESC LIMIT ?',
+                                  (shop_id, limit)).fetchall()
+    return [_entry(row) for row in rows]
+
+
+def get_entry(entry_id):
+    row = _connect().execute('SELECT * FROM queued_write WHERE id = ?', (entry_id,)).fetchone()
+    return _entry(row) if row is not None else None
+
+
+def retry_entry(entry_id):
+    """Put a failed write back in the queue (at its original place)"""
+    _connect().execute("UPDATE queued_write SET state = 'pending', message = NULL WHERE id = ? AND state = 'failed'",
+                       (entry_id,))
+    _wake.set()
+
+
+def _finish(entry_id, state, battery_id=None, message=None):
+    _connect().execute(
+        'UPDATE queued_write SET state = ?, attempts = attempts + 1, battery_id = ?, message = ?, applied_at = ? '
+        'WHERE id = ?',
+        (state, battery_id, message, datetime.utcnow().isoformat(timespec='seconds'), entry_id)
+    )
+
+
+def applied_battery_id(write_key):
+    """The battery ID of the write with this key if it is already in the database, else None"""
+    for model in KEYED_MODELS:
+        battery_id = db.session.execute(
+            select(Battery.battery_id).join(model, model.battery_id == Battery.id).where(model.write_key == write_key)
+        ).scalar()
+        if battery_id is not None:
+            return battery_id
+    return None
+
+
+def replay_pending():
+    """Apply queued writes in order until the queue is empty or the database fails. Returns how many were applied."""
+    from shops import use_shop
+    if not has_pending():
+        return 0
+    lock_path = os.path.join(os.path.dirname(_local.path), 'write_queue.lock')
+    with open(lock_path, 'w') as lock_file:
+        try:
+            # One replayer at a time across the workers of this server
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        applied = 0
+        while True:
+            entry = _connect().execute(
+                "SELECT * FROM queued_write WHERE state = 'pending' ORDER BY id LIMIT 1"
+            ).fetchone()
+            if entry is None:
+                break
+            write_key = entry['write_key']
+            try:
+                with use_shop(entry['shop_id']):
+                    done = applied_battery_id(write_key) if write_key else None
+                    if done is not None:
+                        # Committed just before the connection dropped
+                        mark_database_up()
+                        _finish(entry['id'], 'applied', battery_id=done, message='Already entered')
+                        continue
+                    battery = WRITE_HANDLERS[entry['kind']](entry['user_id'], write_key=write_key,
+                                                            **json.loads(entry['params']))
+            except IntegrityError as e:
+                # The first attempt of the write got its commit in meanwhile
+                db.session.rollback()
+                done = applied_battery_id(write_key) if write_key else None
+                if done is None:
+                    _finish(entry['id'], 'failed', message=str(e.orig)[:500])
+                else:
+                    _finish(entry['id'], 'applied', battery_id=done, message='Already entered')
+            except DBAPIError as e:
+                db.session.rollback()
+                if database_down():
+                    _connect().execute('UPDATE queued_write SET attempts = attempts + 1 WHERE id = ?', (entry['id'],))
+                    logger.info(f'Database still unreachable; {provisional_id(entry["id"])} stays queued')
+                    break
+                _finish(entry['id'], 'failed', message=str(e.orig)[:500])
+            except HTTPException as e:
+                db.session.rollback()
+                _finish(entry['id'], 'failed', message=e.description)
+            except Exception as e:
+                # Rejected, e.g. a status change that conflicts with one made meanwhile
+                db.session.rollback()
+                logger.warning(f'Queued write {provisional_id(entry["id"])} failed: {e}')
+                _finish(entry['id'], 'failed', message=str(e)[:500])
+            else:
+                mark_database_up()
+                _finish(entry['id'], 'applied', battery_id=battery.battery_id if battery else None)
+                applied += 1
+            finally:
+                db.session.remove()
+        if applied:
+            logger.info(f'Replayed {applied} queued writes')
+        return applied
+
+
+def _replay_loop(app):
+    while True:
+        _wake.wait(app.config.get('WRITE_QUEUE_REPLAY_SECONDS', 5))
+        _wake.clear()
+        try:
+            with app.app_context():
+                replay_pending()
+        except Exception:
+            logger.exception('Replaying queued writes failed')
+
+
+def _ensure_replayer():
+    # Started lazily so a preloaded master process never owns the replayer
+    global _replayer
+    if _replayer is not None:
+        return
+    with _replayer_lock:
+        if _replayer is None:
+            _replayer = threading.Thread(
+                target=_replay_loop, args=(current_app._get_current_object(),),
+                name='write-queue-replayer', daemon=True
+            )
+            _replayer.start()
+
+
+class OfflineUser(UserMixin):
+    """The logged-in user as last loaded from the database, while it is unreachable"""
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+
+
+def remember_user(user):
+    """Keep a copy of the user in their session for loading them while the database is down"""
+    data = {'id': user.id, 'username': user.username, 'full_name': user.full_name, 'role': user.role,
+            'shop_id': user.shop_id, 'is_active': user.is_active}
+    if session.get(USER_SESSION_KEY) != data:
+        session[USER_SESSION_KEY] = data
+
+
+def offline_user(user_id):
+    data = session.get(USER_SESSION_KEY)
+    if data and str(data['id']) == str(user_id) and data['is_active']:
+        return OfflineUser(data)
+    return None
+
+
+def _handle_error(context):
+    if context.is_disconnect or context.connection is None:
+        mark_database_down()
+
+
+def _before_request():
+    _ensure_replayer()
+    if not database_down() or request.endpoint in OFFLINE_ENDPOINTS:
+        return None
+    view = current_app.view_functions.get(request.endpoint)
+    if view is not None and getattr(view, 'works_offline', False):
+        return None
+    return render_template('offline.html'), 503
+
+
+def init_write_queue(app):
+    """Watch the primary for outages and serve the writing views from the queue during one"""
+    if not app.config.get('WRITE_QUEUE_ENABLED', True):
+        return
+    _settings['retry_seconds'] = app.config.get('WRITE_QUEUE_RETRY_SECONDS', 15)
+    if not event.contains(db.engine, 'handle_error', _handle_error):
+        event.listen(db.engine, 'handle_error', _handle_error)
+    app.before_request(_before_request)
+    app.jinja_env.globals['write_queue_status'] = queue_status
+
+
+def register_write_queue_commands(app):
+    @app.cli.command('replay-writes')
+    def replay_writes_command():
+        """Apply the writes queued while the database was unreachable."""
+        applied = replay_pending()
+        waiting = queue_status()['pending']
+        click.echo(f'Applied {applied} queued writes; {waiting} still waiting.')